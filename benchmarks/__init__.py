@@ -0,0 +1,6 @@
+"""
+End-to-end benchmarks of the nyuki workflow engine.
+
+Usage:
+    python -m benchmarks.workflows --mongo mongodb://localhost --events 1000
+"""
@@ -0,0 +1,70 @@
+import logging
+from collections import Counter
+from yarl import URL
+
+from nyuki.bus import MqttBus
+
+
+log = logging.getLogger(__name__)
+
+
+class _NullClient:
+
+    """
+    Stand-in for the MQTT client, the subscriptions stay local.
+    """
+
+    async def subscribe(self, topics):
+        pass
+
+    async def unsubscribe(self, topics):
+        pass
+
+
+class StubBus(MqttBus):
+
+    """
+    In-process bus: the messages are handed to `MqttBus._handle_message`
+    directly, without any broker.
+    Published messages loop back to the local subscriptions, the others
+    are only counted.
+    """
+
+    def __init__(self, nyuki, loop=None):
+        super().__init__(nyuki, loop)
+        # Published messages, by topic root
+        self.published = Counter()
+
+    @property
+    def connected(self):
+        return True
+
+    def configure(self, dsn, **kwargs):
+        self._dsn = URL(dsn)
+        self.client = _NullClient()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        log.info('Stub bus stopped')
+
+    def _subscribed(self, topic):
+        if topic in self._subscriptions:
+            return True
+        return any(
+            mqttregex.regex.match(topic)
+            for mqttregex in self._regex_subscriptions.values()
+        )
+
+    def receive(self, topic, data):
+        """
+        Handle a message as if it were received from the broker.
+        """
+        self._handle_message(topic, data)
+
+    async def publish(self, data, topic=None, **kwargs):
+        topic = topic or self.name
+        self.published[topic.split('/', 1)[0]] += 1
+        if self._subscribed(topic):
+            self._handle_message(topic, data)
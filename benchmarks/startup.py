@@ -0,0 +1,119 @@
+"""
+Storage startup benchmark.
+
+A local mongod is filled with task instances (10M by default) and their
+workflow instances, then `MongoStorage.index()` is timed on first startup
+(indexes built) and on the following ones (indexes present), along with a
+full validation of the collections, which now runs in the background.
+"""
+import argparse
+import asyncio
+import logging
+import time
+from pymongo import MongoClient
+from uuid import uuid4
+
+from nyuki.workflow.db.storage import MongoStorage
+from nyuki.workflow.db.utils.buckets import month
+
+from .utils import prepare_database, run_info, write_report
+
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 10000
+
+
+def fill_history(host, database, tasks, per_workflow):
+    """
+    Insert `tasks` task instances in the history bucket of the month, by
+    workflows of `per_workflow` tasks.
+    """
+    client = MongoClient(host)
+    db = client[database]
+    suffix = '{:%Y%m}'.format(month())
+    start = month()
+    workflows, batch = [], []
+    for index in range(tasks):
+        if index % per_workflow == 0:
+            wid = str(uuid4())
+            workflows.append({
+                'id': wid, 'start': start, 'end': start,
+                'state': 'finished', 'requester': None,
+                'template': {'id': 'benchmark', 'title': 'benchmark'},
+            })
+        batch.append({
+            'id': str(uuid4()), 'workflow_instance_id': wid,
+            'start': start, 'end': start, 'state': 'done',
+            'template': {'id': 't', 'name': 'python_script'},
+            'inputs': {}, 'outputs': {},
+        })
+        if len(batch) >= BATCH_SIZE:
+            db['task_instances_' + suffix].insert_many(batch, ordered=False)
+            batch = []
+        if len(workflows) >= BATCH_SIZE:
+            db['workflow_instances_' + suffix].insert_many(workflows)
+            workflows = []
+        if index and index % 1000000 == 0:
+            log.info('Inserted %s task instances', index)
+    if batch:
+        db['task_instances_' + suffix].insert_many(batch, ordered=False)
+    if workflows:
+        db['workflow_instances_' + suffix].insert_many(workflows)
+    client.close()
+
+
+async def time_index(args, validate):
+    storage = MongoStorage()
+    storage.configure(args.mongo, args.database, validate_on_start=False)
+    start = time.perf_counter()
+    await storage.index()
+    ready = time.perf_counter() - start
+    result = {'ready': ready}
+    if validate:
+        start = time.perf_counter()
+        await storage.validate()
+        result['validation'] = time.perf_counter() - start
+    storage._client.close()
+    return result
+
+
+async def run(args):
+    return {
+        # Indexes built on the first startup
+        'first': await time_index(args, validate=False),
+        'next': [
+            await time_index(args, validate=index == 0)
+            for index in range(args.repeat)
+        ],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-t', '--tasks', type=int, default=10000000,
+                        help='task instances in the history')
+    parser.add_argument('-w', '--per-workflow', type=int, default=10,
+                        help='task instances per workflow instance')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='startups timed with the indexes present')
+    parser.add_argument('--mongo', default='mongodb://localhost')
+    parser.add_argument('--database', default='nyuki_benchmark',
+                        help='dropped before each run')
+    parser.add_argument('-o', '--output', help='JSON report (default: stdout)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    prepare_database(args.mongo, args.database)
+    start = time.perf_counter()
+    fill_history(args.mongo, args.database, args.tasks, args.per_workflow)
+    log.info('History filled in %.1fs', time.perf_counter() - start)
+    loop = asyncio.get_event_loop()
+    write_report({
+        'meta': run_info(tasks=args.tasks, per_workflow=args.per_workflow),
+        'startup': loop.run_until_complete(run(args)),
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
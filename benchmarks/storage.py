@@ -0,0 +1,119 @@
+"""
+Template listing benchmark.
+
+Templates are added to a local mongod up to each of the given counts, then
+`MongoStorage.get_templates()` is timed with and without their tasks.
+Reports, per template count, the listing latency percentiles and the
+number of database commands sent for one listing.
+"""
+import argparse
+import asyncio
+import logging
+import time
+from pymongo import monitoring
+
+from nyuki.debugging import percentiles
+from nyuki.workflow.db.storage import MongoStorage
+
+from .templates import linear
+from .utils import prepare_database, run_info, write_report
+
+
+log = logging.getLogger(__name__)
+
+POINTS = (50, 90, 99)
+
+
+class CommandCounter(monitoring.CommandListener):
+
+    """
+    Count the commands sent to mongo.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def add_templates(storage, start, stop, tasks):
+    for index in range(start, stop):
+        template = linear(tasks)
+        template['id'] = '{}-{}'.format(template['id'], index)
+        await storage.upsert_draft(template)
+        await storage.publish_draft(template['id'])
+
+
+async def time_listing(storage, counter, full, repeat):
+    durations = []
+    commands = counter.count
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await storage.get_templates(full=full)
+        durations.append(time.perf_counter() - start)
+    return {
+        'full': full,
+        'commands': (counter.count - commands) / repeat,
+        'mean': sum(durations) / repeat,
+        'min': min(durations),
+        'max': max(durations),
+        **percentiles(durations, POINTS),
+    }
+
+
+async def run(args):
+    counter = CommandCounter()
+    storage = MongoStorage()
+    storage.configure(
+        args.mongo, args.database,
+        validate_on_start=False, event_listeners=[counter],
+    )
+    await storage.index()
+
+    results = []
+    total = 0
+    for count in sorted(args.counts):
+        log.info('Listing %s templates', count)
+        await add_templates(storage, total, count, args.tasks)
+        total = count
+        for full in (False, True):
+            results.append({
+                'templates': count,
+                **await time_listing(storage, counter, full, args.repeat),
+            })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--counts', default='10,100,500,1000',
+                        type=lambda value: [int(v) for v in value.split(',')],
+                        help='comma-separated template counts')
+    parser.add_argument('-t', '--tasks', type=int, default=10,
+                        help='tasks per template')
+    parser.add_argument('-r', '--repeat', type=int, default=20,
+                        help='listings timed per template count')
+    parser.add_argument('--mongo', default='mongodb://localhost')
+    parser.add_argument('--database', default='nyuki_benchmark',
+                        help='dropped before each run')
+    parser.add_argument('-o', '--output', help='JSON report (default: stdout)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    prepare_database(args.mongo, args.database)
+    loop = asyncio.get_event_loop()
+    write_report({
+        'meta': run_info(tasks=args.tasks, repeat=args.repeat),
+        'listing': loop.run_until_complete(run(args)),
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
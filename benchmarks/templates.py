@@ -0,0 +1,124 @@
+"""
+Synthetic workflow templates, each one listening on its own topic.
+The events sent to these templates carry an integer `branch` field.
+"""
+
+
+def _template(name, tasks, graph):
+    return {
+        'id': 'benchmark-{}'.format(name),
+        'title': 'Benchmark: {}'.format(name),
+        'tags': ['benchmark'],
+        'topics': ['benchmark/{}'.format(name)],
+        'policy': 'start-new',
+        'tasks': tasks,
+        'graph': graph,
+    }
+
+
+def _noop(task_id):
+    return {'id': task_id, 'name': 'python_script', 'config': {}}
+
+
+def linear(size=10):
+    """
+    A chain of `size` no-op tasks.
+    """
+    ids = ['t{}'.format(index) for index in range(size)]
+    return _template(
+        'linear',
+        [_noop(task_id) for task_id in ids],
+        {
+            task_id: [ids[index + 1]] if index + 1 < size else []
+            for index, task_id in enumerate(ids)
+        },
+    )
+
+
+def fan_out(width=10):
+    """
+    One task starting `width` parallel tasks, gathered by a join task.
+    """
+    branches = ['b{}'.format(index) for index in range(width)]
+    tasks = [_noop('split')] + [_noop(task_id) for task_id in branches]
+    tasks.append({'id': 'join', 'name': 'join', 'config': {
+        'wait_for': branches,
+    }})
+    graph = {'split': branches, 'join': []}
+    graph.update({task_id: ['join'] for task_id in branches})
+    return _template('fan-out', tasks, graph)
+
+
+def factory(size=5, rules=20):
+    """
+    A chain of `size` factory tasks applying `rules` data rules each.
+    """
+    def task_rules(index):
+        cycle = (
+            lambda i: {'type': 'set', 'fieldname': 'f{}'.format(i),
+                       'value': i},
+            lambda i: {'type': 'copy', 'fieldname': 'branch',
+                       'copy': 'c{}'.format(i)},
+            lambda i: {'type': 'arithmetic', 'fieldname': 'a{}'.format(i),
+                       'operator': '+', 'operand1': '@branch', 'operand2': i},
+            lambda i: {'type': 'unset', 'fieldname': 'c{}'.format(i - 2)},
+        )
+        return [
+            cycle[rule % len(cycle)](index * rules + rule)
+            for rule in range(rules)
+        ]
+
+    ids = ['f{}'.format(index) for index in range(size)]
+    return _template(
+        'factory',
+        [
+            {'id': task_id, 'name': 'factory', 'config': {
+                'rules': task_rules(index),
+            }}
+            for index, task_id in enumerate(ids)
+        ],
+        {
+            task_id: [ids[index + 1]] if index + 1 < size else []
+            for index, task_id in enumerate(ids)
+        },
+    )
+
+
+def selector(size=5, branches=4):
+    """
+    A chain of `size` task selectors, each one evaluating `branches`
+    conditions on the event to select the next selector (or a dead end).
+    """
+    ids = ['s{}'.format(index) for index in range(size)]
+    tasks = []
+    graph = {}
+    for index, task_id in enumerate(ids):
+        following = [ids[index + 1]] if index + 1 < size else []
+        dead_end = 'x{}'.format(index)
+        conditions = [
+            {
+                'type': 'if' if branch == 0 else 'elif',
+                'condition': '(@branch == {})'.format(branch),
+                'rules': [{'type': 'task-selector', 'tasks': following}],
+            }
+            for branch in range(branches)
+        ]
+        conditions.append({
+            'type': 'else',
+            'rules': [{'type': 'task-selector', 'tasks': [dead_end]}],
+        })
+        tasks.append({'id': task_id, 'name': 'task_selector', 'config': {
+            'rules': [{'type': 'condition-block', 'conditions': conditions}],
+        }})
+        tasks.append(_noop(dead_end))
+        graph[task_id] = following + [dead_end]
+        graph[dead_end] = []
+    return _template('selector', tasks, graph)
+
+
+SCENARIOS = {
+    'linear': linear,
+    'fan-out': fan_out,
+    'factory': factory,
+    'selector': selector,
+}
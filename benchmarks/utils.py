@@ -0,0 +1,65 @@
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pymongo import MongoClient
+
+
+def peak_rss():
+    """
+    Peak resident set size of the process so far, in bytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_info(**kwargs):
+    """
+    Describe the benchmark run, to compare the reports of several runs.
+    """
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        **kwargs,
+    }
+
+
+def prepare_database(host, database):
+    """
+    Start from an empty database, which must exist before the nyuki
+    connects to it.
+    """
+    client = MongoClient(host)
+    client.drop_database(database)
+    client[database]['benchmark'].insert_one({
+        'started': datetime.now(timezone.utc),
+    })
+    client.close()
+
+
+def write_report(report, output=None):
+    """
+    Write a JSON report to the file `output`, or to stdout.
+    """
+    report = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as file:
+            file.write(report + '\n')
+    else:
+        print(report)
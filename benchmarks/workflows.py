@@ -0,0 +1,318 @@
+"""
+Workflow throughput benchmark.
+
+A `WorkflowNyuki` is started against a stub bus and a local mongod, the
+synthetic templates are loaded, then N events are fired on the topic of
+each template. Reports, per template:
+- the completed workflows per second,
+- the trigger-to-end latency percentiles,
+- the event loop lag percentiles,
+- the peak RSS of the process.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import tempfile
+from tukio import get_broker, EXEC_TOPIC
+from tukio.workflow import WorkflowExecState, WorkflowTemplate
+
+from nyuki.debugging import percentiles
+from nyuki.logs import DEFAULT_LOGGING
+from nyuki.workflow import WorkflowNyuki
+from nyuki.workflow.publisher import ExecPublisher
+from nyuki.workflow.tasks.utils import runtime
+from nyuki.workflow.validation import validate
+
+from .bus import StubBus
+from .templates import SCENARIOS
+from .utils import peak_rss, prepare_database, run_info, write_report
+
+
+log = logging.getLogger(__name__)
+
+# Field of the events holding their send time
+SENT_KEY = '_benchmark_sent'
+POINTS = (50, 90, 99)
+
+
+class BenchmarkNyuki(WorkflowNyuki):
+
+    """
+    Workflow nyuki receiving its events from a `StubBus`.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        bus = StubBus(self)
+        self._services.add('bus', bus)
+        runtime.bus = bus
+        self.publisher = ExecPublisher(bus)
+
+    async def start_services(self):
+        """
+        `Nyuki.start()` without running the loop forever.
+        """
+        self._validate_config()
+        for name, service in self._services.all.items():
+            service.configure(**self.config.get(name, {}))
+        await self._services.start()
+        await self.setup()
+
+    async def stop_services(self):
+        await self.teardown()
+        await self._services.stop()
+
+
+class LagProbe:
+
+    """
+    Sample the delay of a periodic loop callback.
+    """
+
+    def __init__(self, interval=0.05):
+        self._interval = interval
+        self._loop = asyncio.get_event_loop()
+        self._handle = None
+        self._expected = None
+        self.lags = []
+
+    def start(self):
+        self._expected = self._loop.time() + self._interval
+        self._handle = self._loop.call_at(self._expected, self._probe)
+
+    def _probe(self):
+        now = self._loop.time()
+        self.lags.append(max(0.0, now - self._expected))
+        self._expected = now + self._interval
+        self._handle = self._loop.call_at(self._expected, self._probe)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class Benchmark:
+
+    """
+    Fire the events of a scenario and follow its workflows until they end.
+    """
+
+    # Events fired between two loop iterations, without any rate
+    BATCH = 100
+
+    def __init__(self, nyuki, events, rate=0, timeout=300):
+        self._nyuki = nyuki
+        self._events = events
+        self._rate = rate
+        self._timeout = timeout
+        self._loop = asyncio.get_event_loop()
+        # {<workflow exec id>: <event send time>}
+        self._started = {}
+        self._latencies = []
+        self._ended = 0
+        self._errors = 0
+        self._done = None
+
+    def _exec_event(self, event):
+        etype = event.data['type']
+        uid = event.source.as_dict()['workflow_exec_id']
+        if etype == WorkflowExecState.BEGIN.value:
+            sent = (event.data['content'] or {}).get(SENT_KEY)
+            if sent is not None:
+                self._started[uid] = sent
+            return
+        if etype not in (
+            WorkflowExecState.END.value,
+            WorkflowExecState.ERROR.value,
+        ):
+            return
+        sent = self._started.pop(uid, None)
+        if sent is None:
+            return
+        self._latencies.append(self._loop.time() - sent)
+        if etype == WorkflowExecState.ERROR.value:
+            self._errors += 1
+        else:
+            self._ended += 1
+        done = self._ended + self._errors >= self._events
+        if done and not self._done.done():
+            self._done.set_result(None)
+
+    async def _fire(self, topic):
+        start = self._loop.time()
+        for index in range(self._events):
+            if self._rate:
+                delay = start + index / self._rate - self._loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif index % self.BATCH == 0:
+                await asyncio.sleep(0)
+            self._nyuki.bus.receive(topic, {
+                'index': index,
+                'branch': index % 5,
+                SENT_KEY: self._loop.time(),
+            })
+
+    async def run(self, template):
+        await self._nyuki.storage.upsert_draft({
+            **WorkflowTemplate.from_dict(template).as_dict(),
+            'title': template['title'],
+            'tags': template['tags'],
+        })
+        await self._nyuki.storage.publish_draft(template['id'])
+        await self._nyuki.engine.selector.reload()
+
+        self._done = asyncio.Future()
+        broker = get_broker()
+        broker.register(self._exec_event, topic=EXEC_TOPIC)
+        probe = LagProbe()
+        probe.start()
+        start = self._loop.time()
+        fired = None
+        try:
+            await self._fire(template['topics'][0])
+            fired = self._loop.time() - start
+            await asyncio.wait_for(self._done, self._timeout)
+        except asyncio.TimeoutError:
+            log.error(
+                'Timeout, %s workflows still running',
+                self._events - self._ended - self._errors,
+            )
+        finally:
+            elapsed = self._loop.time() - start
+            probe.stop()
+            broker.unregister(self._exec_event, topic=EXEC_TOPIC)
+        # Let the history writer catch up before the next scenario
+        while self._nyuki.history.stats()['pending']:
+            await asyncio.sleep(0.1)
+
+        completed = self._ended + self._errors
+        return {
+            'events': self._events,
+            'ended': self._ended,
+            'errors': self._errors,
+            'incomplete': self._events - completed,
+            'fire_time': fired,
+            'elapsed': elapsed,
+            'workflows_per_second': completed / elapsed if elapsed else None,
+            'latency': {
+                'mean': (
+                    sum(self._latencies) / len(self._latencies)
+                    if self._latencies else None
+                ),
+                'max': max(self._latencies) if self._latencies else None,
+                **percentiles(self._latencies, POINTS),
+            },
+            'loop_lag': {
+                'samples': len(probe.lags),
+                'max': max(probe.lags) if probe.lags else None,
+                **percentiles(probe.lags, POINTS),
+            },
+            'peak_rss': peak_rss(),
+        }
+
+
+def nyuki_config(args, topics):
+    config = {}
+    if args.config:
+        with open(args.config) as file:
+            config = json.load(file)
+    config.update({
+        'bus': {'dsn': 'mqtt://benchmark@localhost'},
+        'mongo': {
+            **config.get('mongo', {}),
+            'host': args.mongo,
+            'database': args.database,
+        },
+        'api': {**config.get('api', {}), 'port': args.port},
+        'topics': topics,
+        'event_loop': args.loop,
+        # Keep stdout for the report
+        'log': {
+            **DEFAULT_LOGGING,
+            'handlers': {
+                **DEFAULT_LOGGING['handlers'],
+                'console': {
+                    **DEFAULT_LOGGING['handlers']['console'],
+                    'stream': 'ext://sys.stderr',
+                },
+            },
+            'root': {'handlers': ['console'], 'level': args.log_level},
+        },
+    })
+    return config
+
+
+async def run(nyuki, args, scenarios):
+    await nyuki.start_services()
+    results = {}
+    try:
+        for name in scenarios:
+            log.info('Running scenario %s', name)
+            benchmark = Benchmark(nyuki, args.events, args.rate, args.timeout)
+            results[name] = await benchmark.run(SCENARIOS[name]())
+            log.info(
+                'Scenario %s: %.1f workflows/s',
+                name, results[name]['workflows_per_second'] or 0,
+            )
+    finally:
+        await nyuki.stop_services()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-e', '--events', type=int, default=1000,
+                        help='events fired per scenario')
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help='events per second (default: no limit)')
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=sorted(SCENARIOS),
+                        help='scenarios to run (default: all)')
+    parser.add_argument('--mongo', default='mongodb://localhost')
+    parser.add_argument('--database', default='nyuki_benchmark',
+                        help='dropped before each run')
+    parser.add_argument('--port', type=int, default=5599,
+                        help='port of the nyuki api')
+    parser.add_argument('--loop', choices=['asyncio', 'uvloop'],
+                        default='asyncio')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='maximum time per scenario, in seconds')
+    parser.add_argument('-l', '--log-level', default='WARNING')
+    parser.add_argument('-c', '--config',
+                        help='nyuki config file to benchmark with')
+    parser.add_argument('-o', '--output', help='JSON report (default: stdout)')
+    args = parser.parse_args(argv)
+
+    scenarios = args.scenario or list(SCENARIOS)
+    topics = []
+    for name in scenarios:
+        template = SCENARIOS[name]()
+        # Fail early on a broken template
+        validate(WorkflowTemplate.from_dict(template))
+        topics.extend(template['topics'])
+
+    prepare_database(args.mongo, args.database)
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as file:
+        json.dump(nyuki_config(args, topics), file)
+        file.flush()
+        nyuki = BenchmarkNyuki(config=file.name)
+        report = {
+            'meta': run_info(
+                event_loop=type(nyuki.loop).__module__,
+                events=args.events,
+                rate=args.rate or None,
+            ),
+            'scenarios': nyuki.loop.run_until_complete(
+                run(nyuki, args, scenarios)
+            ),
+        }
+        nyuki.loop.close()
+
+    write_report(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -198,6 +198,12 @@ class Api(Service):
     def capabilities(self):
         return self._nyuki.HTTP_RESOURCES
 
+    def add_middleware(self, middleware):
+        """
+        Add an aiohttp middleware factory, run before the capabilities.
+        """
+        self._middlewares.insert(0, middleware)
+
     def configure(self, host='0.0.0.0', port=5558):
         self._host = host
         self._port = port
@@ -213,7 +219,16 @@ class Api(Service):
         log.info('Starting the http server on %s:%s', self._host, self._port)
         self._runner = web.AppRunner(self._app, access_log=access_log)
         await self._runner.setup()
-        site = web.TCPSite(self._runner, self._host, self._port)
+        workers = self._nyuki.workers
+        if workers.enabled:
+            # All the workers share the same port, and can reach each other
+            # through their own unix socket
+            site = web.TCPSite(
+                self._runner, self._host, self._port, reuse_port=True
+            )
+            await web.UnixSite(self._runner, workers.socket_path()).start()
+        else:
+            site = web.TCPSite(self._runner, self._host, self._port)
         await site.start()
 
     async def stop(self):
@@ -0,0 +1,11 @@
+from .api import Response, resource
+
+
+@resource('/http/client', versions=['v1'])
+class ApiHttpClient:
+
+    async def get(self, request):
+        """
+        Return the usage stats of the shared HTTP client pool
+        """
+        return Response(self.nyuki.http_client.stats())
@@ -62,6 +62,12 @@ class MqttBus(Service):
     def name(self):
         return self._dsn.user
 
+    @property
+    def connected(self):
+        if self.client is None:
+            return False
+        return self.client._connected_state.is_set()
+
     def configure(self, dsn, cafile=None, certfile=None, keyfile=None,
                   keep_alive=60, ping_delay=5):
         self._dsn = URL(dsn)
@@ -173,7 +179,9 @@ class MqttBus(Service):
             self._regex_subscriptions[topic].callbacks.remove(callback)
         if callback is None or not self._regex_subscriptions[topic].callbacks:
             del self._regex_subscriptions[topic]
-            await self.client.unsubscribe([topic])
+            # Nothing to tell a disconnected broker (e.g. when stopping)
+            if self.connected:
+                await self.client.unsubscribe([topic])
             log.info('Unsubscribed from %s', topic)
 
     async def _unsub(self, topic, callback):
@@ -190,7 +198,9 @@ class MqttBus(Service):
             self._subscriptions[topic].remove(callback)
         if callback is None or not self._subscriptions[topic]:
             del self._subscriptions[topic]
-            await self.client.unsubscribe([topic])
+            # Nothing to tell a disconnected broker (e.g. when stopping)
+            if self.connected:
+                await self.client.unsubscribe([topic])
             log.info('Unsubscribed from %s', topic)
 
     async def unsubscribe(self, topic, callback=None):
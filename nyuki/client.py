@@ -0,0 +1,135 @@
+import logging
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+
+from nyuki.services import Service
+
+
+log = logging.getLogger(__name__)
+
+
+class _Session:
+
+    """
+    Pooled session, or a short-lived one while the pool is stopped.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._session = None
+
+    async def __aenter__(self):
+        if self._client.session is not None:
+            return self._client.session
+        self._session = ClientSession(timeout=self._client._timeout)
+        return self._session
+
+    async def __aexit__(self, *exc_info):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class HttpClient(Service):
+
+    """
+    Nyuki-wide HTTP client session, sharing a pool of keep-alive connections
+    (and a DNS cache) between all the requests made by the nyuki.
+    """
+
+    CONF_SCHEMA = {
+        'type': 'object',
+        'properties': {
+            'http_client': {
+                'type': 'object',
+                'properties': {
+                    'limit': {'type': 'integer', 'minimum': 0},
+                    'limit_per_host': {'type': 'integer', 'minimum': 0},
+                    'keepalive_timeout': {'type': 'number', 'minimum': 0},
+                    'dns_cache_ttl': {'type': 'integer', 'minimum': 0},
+                    'timeout': {'type': 'number', 'minimum': 0},
+                    'connect_timeout': {'type': 'number', 'minimum': 0},
+                },
+                'additionalProperties': False
+            }
+        }
+    }
+
+    def __init__(self, nyuki):
+        self._nyuki = nyuki
+        self._nyuki.register_schema(self.CONF_SCHEMA)
+        self._connector_kwargs = {}
+        self._timeout = None
+        self._counters = {}
+        self.session = None
+
+    def configure(self, limit=100, limit_per_host=20, keepalive_timeout=30,
+                  dns_cache_ttl=300, timeout=300, connect_timeout=None):
+        self._connector_kwargs = {
+            'limit': limit,
+            'limit_per_host': limit_per_host,
+            'keepalive_timeout': keepalive_timeout,
+            'ttl_dns_cache': dns_cache_ttl,
+        }
+        self._timeout = ClientTimeout(total=timeout, connect=connect_timeout)
+
+    def _trace_config(self):
+        """
+        Count requests, connections and DNS cache usage.
+        """
+        trace_config = TraceConfig()
+
+        def counter(name):
+            async def count(session, context, params):
+                self._counters[name] += 1
+            self._counters[name] = 0
+            return count
+
+        trace_config.on_request_start.append(counter('requests'))
+        trace_config.on_request_exception.append(counter('errors'))
+        trace_config.on_connection_create_end.append(counter('connections_created'))
+        trace_config.on_connection_reuseconn.append(counter('connections_reused'))
+        trace_config.on_connection_queued_start.append(counter('queued'))
+        trace_config.on_dns_cache_hit.append(counter('dns_cache_hits'))
+        trace_config.on_dns_cache_miss.append(counter('dns_cache_misses'))
+        return trace_config
+
+    async def start(self):
+        self.session = ClientSession(
+            connector=TCPConnector(**self._connector_kwargs),
+            timeout=self._timeout,
+            trace_configs=[self._trace_config()],
+        )
+        log.info(
+            'HTTP client pool started (limit: %s, per host: %s)',
+            self._connector_kwargs['limit'],
+            self._connector_kwargs['limit_per_host'],
+        )
+
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        log.info('HTTP client pool stopped')
+
+    def borrow(self):
+        """
+        Context manager returning the pooled session, or a short-lived one
+        when the pool is stopped (nyuki teardown, configuration reload).
+        """
+        return _Session(self)
+
+    def stats(self):
+        """
+        Return the pool usage and the request counters.
+        """
+        stats = {
+            **self._connector_kwargs,
+            **self._counters,
+            'acquired': 0,
+            'idle': 0,
+        }
+        if self.session is not None:
+            connector = self.session.connector
+            stats['acquired'] = len(connector._acquired)
+            stats['idle'] = sum(len(conns) for conns in connector._conns.values())
+        return stats
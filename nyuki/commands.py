@@ -23,6 +23,10 @@ def _build_args():
                         help='bus host server: <host>[:<port>]', required=False)
     parser.add_argument('-a', '--api',
                         help='api binding: <host>[:<port>]', required=False)
+    parser.add_argument('-w', '--workers', type=int,
+                        help='number of worker processes', required=False)
+    parser.add_argument('--loop', choices=['asyncio', 'uvloop'],
+                        help='event loop implementation', required=False)
     return parser.parse_args()
 
 
@@ -64,6 +68,12 @@ def get_command_kwargs():
             }
         }
 
+    if args.loop:
+        command_args['event_loop'] = args.loop
+
+    if args.workers:
+        command_args['workers'] = {'count': args.workers}
+
     if args.config:
         command_args['config'] = args.config
 
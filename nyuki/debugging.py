@@ -1,7 +1,15 @@
+import sys
+import time
 import signal
+import asyncio
 import logging
+import threading
+import traceback
 import collections
+from asyncio.events import Handle
+
 from nyuki.api import resource, Response
+from nyuki.services import Service
 
 
 log = logging.getLogger(__name__)
@@ -16,6 +24,18 @@ class ApiSampleEmitter:
         return Response(self.nyuki._sampler.output_stats())
 
 
+@resource('/monitor')
+class ApiLoopMonitor:
+
+    async def get(self, request):
+        monitor = self.nyuki.monitor
+        if not monitor.enabled:
+            return Response(status=404)
+        return Response(await self.nyuki.workers.aggregate(
+            request, monitor.stats(), monitor.merge
+        ))
+
+
 class StackSampler:
 
     """
@@ -64,3 +84,215 @@ class StackSampler:
             for frame, count in ordered_stacks
         ])
         return '\n'.join(lines) + '\n'
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Return the given percentiles (nearest rank) of a list of values.
+    """
+    values = sorted(values)
+    if not values:
+        return {'p{}'.format(point): None for point in points}
+    return {
+        'p{}'.format(point): values[
+            min(len(values) - 1, int(len(values) * point / 100))
+        ]
+        for point in points
+    }
+
+
+def _callback_name(handle):
+    """
+    Name of a loop callback, or of the coroutine of a task step.
+    """
+    callback = handle._callback
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner._coro
+        return 'task {}'.format(getattr(coro, '__qualname__', repr(coro)))
+    return getattr(callback, '__qualname__', repr(callback))
+
+
+class LoopMonitor(Service):
+
+    """
+    Measure the event loop lag with a periodic probe, and record the
+    callbacks (or task steps) that block the loop for longer than
+    `threshold` seconds. A watchdog thread captures the stack of the loop
+    while a callback is blocking it.
+    Only the handles of the default asyncio loop are timed.
+    """
+
+    CONF_SCHEMA = {
+        'type': 'object',
+        'properties': {
+            'monitor': {
+                'type': 'object',
+                'properties': {
+                    'enabled': {'type': 'boolean'},
+                    'interval': {'type': 'number', 'minimum': 0.01},
+                    'threshold': {'type': 'number', 'minimum': 0.001},
+                    'window': {'type': 'integer', 'minimum': 1},
+                    'max_slow': {'type': 'integer', 'minimum': 1},
+                },
+                'additionalProperties': False
+            }
+        }
+    }
+
+    # Original `Handle._run`, while the monitor is installed
+    _handle_run = None
+
+    def __init__(self, nyuki):
+        self._nyuki = nyuki
+        self._nyuki.register_schema(self.CONF_SCHEMA)
+        self.enabled = False
+        self._interval = 0.5
+        self._threshold = 0.1
+        self._lags = collections.deque(maxlen=600)
+        self._slow = collections.deque(maxlen=100)
+        self._slow_count = 0
+        self._probe = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        # (<handle>, <start time>) of the running callback
+        self._current = None
+        self._stack = None
+        self._loop_thread = None
+
+    def configure(self, enabled=False, interval=0.5, threshold=0.1,
+                  window=600, max_slow=100):
+        self.enabled = enabled
+        self._interval = interval
+        self._threshold = threshold
+        self._lags = collections.deque(self._lags, maxlen=window)
+        self._slow = collections.deque(self._slow, maxlen=max_slow)
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self._install()
+        self._stopped.clear()
+        self._loop_thread = threading.get_ident()
+        self._watchdog = threading.Thread(
+            target=self._watch, name='loop-monitor', daemon=True
+        )
+        self._watchdog.start()
+        self._probe = asyncio.ensure_future(self._run_probe())
+        log.info(
+            'Loop monitor started (probe every %ss, slow above %ss)',
+            self._interval, self._threshold,
+        )
+
+    async def stop(self):
+        if self._probe is not None:
+            self._probe.cancel()
+            self._probe = None
+        if self._watchdog is not None:
+            self._stopped.set()
+            self._watchdog.join()
+            self._watchdog = None
+        self._uninstall()
+
+    def _install(self):
+        if LoopMonitor._handle_run is not None:
+            return
+        LoopMonitor._handle_run = original = Handle._run
+        monitor = self
+
+        def _run(handle):
+            start = time.monotonic()
+            monitor._current = (handle, start)
+            try:
+                original(handle)
+            finally:
+                monitor._current = None
+                duration = time.monotonic() - start
+                if duration >= monitor._threshold:
+                    monitor._record(handle, duration)
+
+        Handle._run = _run
+
+    def _uninstall(self):
+        if LoopMonitor._handle_run is not None:
+            Handle._run = LoopMonitor._handle_run
+            LoopMonitor._handle_run = None
+
+    def _record(self, handle, duration):
+        self._slow_count += 1
+        stack, self._stack = self._stack, None
+        entry = {
+            'callback': _callback_name(handle),
+            'duration': duration,
+            'time': time.time(),
+            'stack': stack,
+        }
+        self._slow.append(entry)
+        log.warning(
+            'Event loop blocked for %.3fs by %s', duration, entry['callback']
+        )
+
+    def _watch(self):
+        """
+        Capture the stack of the loop thread while a callback blocks it.
+        """
+        captured = None
+        while not self._stopped.wait(self._threshold / 2):
+            current = self._current
+            if current is None or current is captured:
+                continue
+            if time.monotonic() - current[1] < self._threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._stack = traceback.format_stack(frame)
+                captured = current
+
+    async def _run_probe(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self._interval)
+            self._lags.append(max(0, loop.time() - start - self._interval))
+
+    def stats(self):
+        lags = list(self._lags)
+        return {
+            'interval': self._interval,
+            'threshold': self._threshold,
+            'lag': {
+                'samples': len(lags),
+                'last': lags[-1] if lags else None,
+                'max': max(lags) if lags else None,
+                **percentiles(lags),
+            },
+            'slow_callbacks': self._slow_count,
+            'slow': list(self._slow),
+        }
+
+    @staticmethod
+    def merge(results):
+        """
+        Merge the `stats()` of several worker processes: the lag is the one
+        of the most delayed loop.
+        """
+        merged = dict(results[0])
+        merged['lag'] = {
+            key: max(
+                (result['lag'][key] for result in results
+                 if result['lag'][key] is not None),
+                default=None,
+            )
+            for key in results[0]['lag']
+        }
+        merged['lag']['samples'] = sum(
+            result['lag']['samples'] for result in results
+        )
+        merged['slow_callbacks'] = sum(
+            result['slow_callbacks'] for result in results
+        )
+        merged['slow'] = sorted(
+            (entry for result in results for entry in result['slow']),
+            key=lambda entry: entry['time'],
+        )
+        return merged
@@ -9,13 +9,18 @@ from signal import SIGHUP, SIGINT, SIGTERM
 
 from .api import Api
 from .api.bus import ApiBusTopics, ApiBusPublish
+from .api.client import ApiHttpClient
 from .api.config import ApiConfiguration
 from .bus import MqttBus
+from .client import HttpClient
 from .commands import get_command_kwargs
 from .config import get_full_config, write_conf_json, merge_configs
-from .debugging import StackSampler, ApiSampleEmitter
+from .debugging import (
+    StackSampler, ApiSampleEmitter, ApiLoopMonitor, LoopMonitor
+)
 from .logs import DEFAULT_LOGGING
 from .services import ServiceManager
+from .workers import Workers
 
 
 log = logging.getLogger(__name__)
@@ -41,6 +46,7 @@ class Nyuki:
         'required': ['log'],
         'properties': {
             'trace': {'type': 'boolean'},
+            'event_loop': {'type': 'string', 'enum': ['asyncio', 'uvloop']},
         }
     }
 
@@ -49,7 +55,9 @@ class Nyuki:
         ApiBusPublish,
         ApiBusTopics,
         ApiConfiguration,
+        ApiHttpClient,
         ApiSampleEmitter,
+        ApiLoopMonitor,
     ]
 
     def __init__(self, **kwargs):
@@ -77,11 +85,15 @@ class Nyuki:
         self._sampler = None
         self._set_stack_sampling()
         # Set loop
+        self._set_event_loop_policy()
         self.loop = asyncio.get_event_loop() or asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
 
         self._services = ServiceManager(self)
         self._services.add('api', Api(self))
+        self._services.add('http_client', HttpClient(self))
+        self._services.add('workers', Workers(self))
+        self._services.add('monitor', LoopMonitor(self))
 
         # Add bus service if in conf file
         bus_config = self._config.get('bus')
@@ -118,6 +130,13 @@ class Nyuki:
         The nyuki process is terminated when this method is finished
         """
         self._validate_config()
+        workers = self._services.get('workers')
+        workers.configure(**self._config.get('workers', {}))
+        if workers.supervisor:
+            # This process only runs the workers
+            workers.supervise()
+            return
+
         self.loop.add_signal_handler(SIGTERM, self.abort, SIGTERM)
         self.loop.add_signal_handler(SIGINT, self.abort, SIGINT)
         self.loop.add_signal_handler(SIGHUP, self.hang_up, SIGHUP)
@@ -283,6 +302,21 @@ class Nyuki:
                 service.configure(**self._config.get(name, {}))
                 asyncio.ensure_future(service.start())
 
+    def _set_event_loop_policy(self):
+        """
+        Use uvloop if configured and installed, must be called before the
+        loop is created.
+        """
+        if self._config.get('event_loop') != 'uvloop':
+            return
+        try:
+            import uvloop
+        except ImportError:
+            log.warning('uvloop is not installed, using the asyncio loop')
+            return
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        log.info('Using the uvloop event loop')
+
     def _set_stack_sampling(self):
         enable = self.config.get('trace') is True
         # Enable sampler trace
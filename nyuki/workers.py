@@ -0,0 +1,283 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from aiohttp import ClientSession, UnixConnector
+
+from nyuki.services import Service
+
+
+log = logging.getLogger(__name__)
+
+
+class Workers(Service):
+
+    """
+    Prefork mode: a supervisor process runs `count` copies of the nyuki.
+    The workers share the API port (SO_REUSEPORT) and each of them also
+    listens on a unix socket, through which the other workers can reach
+    the objects (e.g. workflow instances) it owns.
+    """
+
+    ENV_INDEX = 'NYUKI_WORKER'
+    ENV_COUNT = 'NYUKI_WORKERS'
+    ENV_DIRECTORY = 'NYUKI_WORKERS_DIR'
+    # Set on the requests forwarded between workers
+    FORWARDED_HEADER = 'X-Nyuki-Worker'
+    RESTART_DELAY = 1.0
+
+    CONF_SCHEMA = {
+        'type': 'object',
+        'properties': {
+            'workers': {
+                'type': 'object',
+                'properties': {
+                    'count': {'type': 'integer', 'minimum': 1},
+                },
+                'additionalProperties': False
+            }
+        }
+    }
+
+    def __init__(self, nyuki):
+        self._nyuki = nyuki
+        self._nyuki.register_schema(self.CONF_SCHEMA)
+        self.count = 1
+        self.index = None
+        self._directory = None
+        self._sessions = {}
+
+    def configure(self, count=1):
+        """
+        The process environment is set by the supervisor for its workers.
+        """
+        if self.ENV_INDEX in os.environ:
+            self.index = int(os.environ[self.ENV_INDEX])
+            self.count = int(os.environ[self.ENV_COUNT])
+            self._directory = os.environ[self.ENV_DIRECTORY]
+        else:
+            self.count = count
+
+    @property
+    def supervisor(self):
+        return self.count > 1 and self.index is None
+
+    @property
+    def enabled(self):
+        """
+        True in a worker process of the prefork mode.
+        """
+        return self.count > 1 and self.index is not None
+
+    @property
+    def siblings(self):
+        return [index for index in range(self.count) if index != self.index]
+
+    def socket_path(self, index=None):
+        return os.path.join(self._directory, '{}.sock'.format(
+            self.index if index is None else index
+        ))
+
+    def owner(self, key):
+        """
+        Return the index of the worker owning a string key, stable across
+        processes and restarts.
+        """
+        return zlib.crc32(key.encode()) % self.count
+
+    def owns(self, key):
+        return not self.enabled or self.owner(key) == self.index
+
+    def owns_event(self, topic, data):
+        """
+        Partition the bus events between the workers.
+        """
+        if not self.enabled:
+            return True
+        key = '{}:{}'.format(topic, json.dumps(
+            data, sort_keys=True, default=str
+        ))
+        return self.owner(key) == self.index
+
+    def forwarded(self, request):
+        return self.FORWARDED_HEADER in request.headers
+
+    async def start(self):
+        if self.enabled:
+            log.info('Started worker %s/%s', self.index + 1, self.count)
+
+    async def stop(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    def _session(self, index):
+        try:
+            return self._sessions[index]
+        except KeyError:
+            session = ClientSession(
+                connector=UnixConnector(path=self.socket_path(index))
+            )
+            self._sessions[index] = session
+            return session
+
+    async def _request(self, index, request, body, path=None):
+        """
+        Send a copy of `request` (to `path` if given) to the worker `index`,
+        return its status, content type and body.
+        """
+        headers = {
+            key: value
+            for key, value in request.headers.items()
+            if key.lower() not in ('host', 'content-length', 'transfer-encoding')
+        }
+        headers[self.FORWARDED_HEADER] = str(self.index)
+        url = 'http://worker-{}{}'.format(index, path or request.rel_url)
+        async with self._session(index).request(
+            request.method, url, headers=headers, data=body
+        ) as response:
+            return (
+                response.status,
+                response.headers.get('Content-Type'),
+                await response.read(),
+            )
+
+    async def broadcast(self, request, path=None, body=None):
+        """
+        Forward a request (or a copy sent to `path`, with `body`) to the
+        other workers, return their responses by worker index as
+        (<status>, <content type>, <body>).
+        """
+        if body is None:
+            body = await request.read()
+        results = await asyncio.gather(*[
+            self._request(index, request, body, path)
+            for index in self.siblings
+        ], return_exceptions=True)
+        responses = {}
+        for index, result in zip(self.siblings, results):
+            if isinstance(result, Exception):
+                log.error('Worker %s unreachable: %s', index, result)
+            else:
+                responses[index] = result
+        return responses
+
+    async def find(self, request):
+        """
+        Forward a request on an object this worker does not own to the
+        other workers, return the first response that is not a 404 as
+        (<status>, <content type>, <body>), or None.
+        """
+        for status, content_type, body in (
+            await self.broadcast(request)
+        ).values():
+            if status != 404:
+                return status, content_type, body
+        return None
+
+    async def collect(self, request):
+        """
+        Forward a request returning a JSON list to the other workers,
+        return the concatenation of their lists.
+        """
+        items = []
+        for status, _, body in (await self.broadcast(request)).values():
+            if status == 200:
+                items.extend(json.loads(body.decode()))
+        return items
+
+    async def gather(self, request):
+        """
+        Forward a request returning a JSON object to the other workers,
+        return their objects by worker index.
+        """
+        return {
+            index: json.loads(body.decode())
+            for index, (status, _, body) in (
+                await self.broadcast(request)
+            ).items()
+            if status == 200
+        }
+
+    async def aggregate(self, request, local, merge):
+        """
+        Return the JSON object `local` of this worker merged with the ones
+        of the other workers by `merge(<list of objects>)`, when `request`
+        was not forwarded by another worker.
+        """
+        if not self.enabled or self.forwarded(request):
+            return local
+        others = await self.gather(request)
+        return merge([local] + list(others.values()))
+
+    def supervise(self):
+        """
+        Run and watch the worker processes until they are all stopped.
+        Crashed workers are restarted, signals are forwarded.
+        """
+        directory = tempfile.mkdtemp(prefix='nyuki-')
+        processes = {}
+        stopping = False
+
+        main = sys.modules['__main__']
+        if getattr(main, '__spec__', None) is not None:
+            # Started with `python -m <module>`
+            command = [sys.executable, '-m', main.__spec__.name] + sys.argv[1:]
+        else:
+            command = [sys.executable] + sys.argv
+
+        def spawn(index):
+            env = {
+                **os.environ,
+                self.ENV_INDEX: str(index),
+                self.ENV_COUNT: str(self.count),
+                self.ENV_DIRECTORY: directory,
+            }
+            # Terminal signals only reach the supervisor, which forwards them
+            processes[index] = subprocess.Popen(
+                command, env=env, start_new_session=True
+            )
+
+        def forward(signum, frame):
+            nonlocal stopping
+            if signum != signal.SIGHUP:
+                stopping = True
+            for process in processes.values():
+                process.send_signal(signum)
+
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, forward)
+
+        log.info('Starting %s workers', self.count)
+        for index in range(self.count):
+            spawn(index)
+
+        try:
+            while processes:
+                pid, status = os.wait()
+                for index, process in list(processes.items()):
+                    if process.pid == pid:
+                        break
+                else:
+                    continue
+                del processes[index]
+                if stopping:
+                    continue
+                if os.WIFSIGNALED(status):
+                    reason = 'signal {}'.format(os.WTERMSIG(status))
+                else:
+                    reason = 'status {}'.format(os.WEXITSTATUS(status))
+                log.error('Worker %s exited (%s), restarting it', index, reason)
+                time.sleep(self.RESTART_DELAY)
+                if not stopping:
+                    spawn(index)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        log.info('All workers stopped')
@@ -0,0 +1,212 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import Counter
+
+
+log = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+
+    """
+    The pending queue is full.
+    """
+
+
+class AdmissionTimeout(Exception):
+
+    """
+    No slot was available before the end of the pending timeout.
+    """
+
+
+class AdmissionControl:
+
+    """
+    Bound the number of running workflows, globally and per template.
+    Workflows that cannot run yet wait in a pending queue, ordered by the
+    priority of their template (higher first) and then by arrival.
+    A limit of 0 means unlimited.
+    """
+
+    MAX_PENDING = 1000
+    PENDING_TIMEOUT = 60.0
+
+    def __init__(self):
+        self._max_running = 0
+        self._max_per_template = 0
+        self._max_pending = self.MAX_PENDING
+        self._timeout = self.PENDING_TIMEOUT
+        self._priorities = {}
+        self._running = Counter()
+        self._total = 0
+        # Heap of (-<priority>, <arrival order>, <template id>, <future>,
+        #          <arrival time>)
+        self._pending = []
+        self._order = itertools.count()
+        self._stats = Counter()
+
+    def configure(self, max_running=0, max_per_template=0,
+                  max_pending=MAX_PENDING, pending_timeout=PENDING_TIMEOUT,
+                  priorities=None):
+        self._max_running = max_running
+        self._max_per_template = max_per_template
+        self._max_pending = max_pending
+        self._timeout = pending_timeout
+        self._priorities = priorities or {}
+        # New limits may free slots
+        self._wake_up()
+
+    def _can_run(self, tid):
+        if self._max_running and self._total >= self._max_running:
+            return False
+        if self._max_per_template and self._running[tid] >= self._max_per_template:
+            return False
+        return True
+
+    def take(self, tid):
+        """
+        Count a running workflow without checking the limits.
+        """
+        self._running[tid] += 1
+        self._total += 1
+        self._stats['admitted'] += 1
+
+    def try_acquire(self, tid):
+        """
+        Take a slot for a new workflow of the template `tid` if one is
+        available right now and nothing is pending, return False otherwise.
+        """
+        if self._pending or not self._can_run(tid):
+            return False
+        self.take(tid)
+        return True
+
+    async def acquire(self, tid):
+        """
+        Wait for a slot to run a new workflow of the template `tid`.
+        Raise `AdmissionRejected` if the pending queue is full, or
+        `AdmissionTimeout` if no slot is available in time.
+        """
+        if self.try_acquire(tid):
+            return
+        if len(self._pending) >= self._max_pending:
+            self._stats['rejected'] += 1
+            raise AdmissionRejected(
+                'Too many pending workflows ({})'.format(len(self._pending))
+            )
+
+        future = asyncio.Future()
+        entry = (
+            -self._priorities.get(tid, 0), next(self._order), tid, future,
+            time.time(),
+        )
+        heapq.heappush(self._pending, entry)
+        self._wake_up()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self._timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # The slot was given right before the timeout
+                return
+            self._remove(entry)
+            self._stats['timeouts'] += 1
+            raise AdmissionTimeout(
+                'No slot available after {}s'.format(self._timeout)
+            )
+        except asyncio.CancelledError:
+            self._remove(entry)
+            # The slot may have been given in the mean time
+            if future.done() and not future.cancelled():
+                self.release(tid)
+            raise
+
+    def _remove(self, entry):
+        try:
+            self._pending.remove(entry)
+        except ValueError:
+            return
+        heapq.heapify(self._pending)
+        entry[3].cancel()
+
+    def release(self, tid):
+        """
+        Free the slot of an ended workflow.
+        """
+        self._running[tid] -= 1
+        if self._running[tid] <= 0:
+            del self._running[tid]
+        self._total -= 1
+        self._wake_up()
+
+    def release_on_done(self, tid, wflow):
+        """
+        Free the slot of a workflow when it ends.
+        """
+        wflow.add_done_callback(lambda _: self.release(tid))
+
+    def _wake_up(self):
+        """
+        Give the free slots to the pending workflows, by priority. A template
+        at its own limit does not block the others.
+        """
+        if not self._pending:
+            return
+        waiting = []
+        while self._pending:
+            if self._max_running and self._total >= self._max_running:
+                break
+            entry = heapq.heappop(self._pending)
+            tid, future = entry[2], entry[3]
+            if future.done():
+                continue
+            if self._can_run(tid):
+                self.take(tid)
+                future.set_result(None)
+            else:
+                waiting.append(entry)
+        for entry in waiting:
+            heapq.heappush(self._pending, entry)
+
+    def stats(self):
+        now = time.time()
+        return {
+            'max_running': self._max_running,
+            'max_per_template': self._max_per_template,
+            'max_pending': self._max_pending,
+            'running': self._total,
+            'running_per_template': dict(self._running),
+            'pending': [
+                {
+                    'template_id': tid,
+                    'priority': -priority,
+                    'waiting': now - since,
+                }
+                for priority, _, tid, _, since in sorted(self._pending)
+            ],
+            'admitted': self._stats['admitted'],
+            'rejected': self._stats['rejected'],
+            'timeouts': self._stats['timeouts'],
+        }
+
+    @staticmethod
+    def merge(results):
+        """
+        Merge the `stats()` of several worker processes, the limits apply
+        to each of them.
+        """
+        merged = dict(results[0])
+        running = Counter()
+        for result in results:
+            running.update(result['running_per_template'])
+        merged['running_per_template'] = dict(running)
+        merged['pending'] = sorted(
+            (entry for result in results for entry in result['pending']),
+            key=lambda entry: (-entry['priority'], -entry['waiting']),
+        )
+        for key in ('running', 'admitted', 'rejected', 'timeouts'):
+            merged[key] = sum(result[key] for result in results)
+        return merged
@@ -0,0 +1,14 @@
+from nyuki.api import Response, resource
+
+
+@resource('/workflow/admission', versions=['v1'])
+class ApiWorkflowAdmission:
+
+    async def get(self, request):
+        """
+        Return the concurrency limits, running and pending workflows
+        """
+        admission = self.nyuki.admission
+        return Response(await self.nyuki.workers.aggregate(
+            request, admission.stats(), admission.merge
+        ))
@@ -76,6 +76,7 @@ class ApiFactoryRegexes:
         except AutoReconnect:
             return Response(status=503)
         await self.nyuki.storage.regexes.delete()
+        await self.nyuki.invalidation.invalidate('regexes')
         return Response(rules)
 
 
@@ -118,6 +119,7 @@ class ApiFactoryRegex:
                 'error_code': 'invalid_regex'
             })
         await self.nyuki.storage.regexes.insert(regex)
+        await self.nyuki.invalidation.invalidate('regexes', regex_id)
         return Response(regex)
 
     async def delete(self, request, regex_id):
@@ -132,6 +134,7 @@ class ApiFactoryRegex:
             return Response(status=404)
 
         await self.nyuki.storage.regexes.delete(regex_id)
+        await self.nyuki.invalidation.invalidate('regexes', regex_id)
         return Response(regex)
 
 
@@ -260,6 +263,7 @@ class ApiFactoryLookups:
         except AutoReconnect:
             return Response(status=503)
         await self.nyuki.storage.lookups.delete()
+        await self.nyuki.invalidation.invalidate('lookups')
         return Response(lookups)
 
 
@@ -296,6 +300,7 @@ class ApiFactoryLookup:
             lookup_id=lookup_id
         )
         await self.nyuki.storage.lookups.insert(lookup)
+        await self.nyuki.invalidation.invalidate('lookups', lookup_id)
         return Response(lookup)
 
     async def delete(self, request, lookup_id):
@@ -310,6 +315,7 @@ class ApiFactoryLookup:
             return Response(status=404)
 
         await self.nyuki.storage.lookups.delete(lookup_id)
+        await self.nyuki.invalidation.invalidate('lookups', lookup_id)
         return Response(lookup)
 
 
@@ -10,8 +10,10 @@ from pymongo.errors import AutoReconnect
 
 from nyuki.api import Response, resource, content_type, HTTPBreak
 from nyuki.utils import from_isoformat
+from nyuki.workflow.admission import AdmissionRejected, AdmissionTimeout
 from nyuki.workflow.tasks.utils.uri import URI, InvalidWorkflowUri
-from nyuki.workflow.db.workflow_instances import Ordering
+from nyuki.workflow.db.utils.errors import PayloadTooLarge
+from nyuki.workflow.db.workflow_instances import InvalidPageToken, Ordering
 
 
 log = logging.getLogger(__name__)
@@ -44,6 +46,32 @@ class _WorkflowResource:
         broker.register(exec_handler, topic=topic)
 
 
+def instance_router(nyuki):
+    """
+    Middleware factory forwarding the requests on the running workflow
+    instances owned by another worker process (prefork mode).
+    """
+    async def factory(app, handler):
+        async def middleware(request):
+            iid = request.match_info.get('iid')
+            if (
+                iid is None or
+                iid in nyuki.running_workflows or
+                not nyuki.workers.enabled or
+                nyuki.workers.forwarded(request)
+            ):
+                return await handler(request)
+
+            found = await nyuki.workers.find(request)
+            if found is None:
+                return await handler(request)
+            status, ctype, body = found
+            headers = {'Content-Type': ctype} if ctype else {}
+            return Response(body=body, status=status, headers=headers)
+        return middleware
+    return factory
+
+
 @resource('/workflow/instances', ['v1'], 'application/json')
 class ApiWorkflows(_WorkflowResource):
 
@@ -62,6 +90,11 @@ class ApiWorkflows(_WorkflowResource):
                     continue
             workflows.append(wflow.report(tasks=tasks))
 
+        # Instances running in the other worker processes
+        workers = self.nyuki.workers
+        if workers.enabled and not workers.forwarded(request):
+            workflows.extend(await workers.collect(request))
+
         return Response(workflows)
 
     async def put(self, request):
@@ -94,14 +127,17 @@ class ApiWorkflows(_WorkflowResource):
                 return Response(status=400, body={
                     'error': 'This workflow is already being rescued'
                 })
-        else:
-            # Fetch the template from the storage
+        elif draft:
+            # Fetch the draft from the storage
             try:
                 template = await self.nyuki.storage.get_template(
-                    request['id'], draft=draft
+                    request['id'], draft=True
                 )
             except AutoReconnect:
                 return Response(status=503)
+        else:
+            # Active templates are kept in memory by the selector
+            template = self.nyuki.engine.selector.get_dict(request['id'])
 
         if not template:
             return Response(status=404, body={
@@ -116,6 +152,18 @@ class ApiWorkflows(_WorkflowResource):
                 'error': 'More than one root task'
             })
 
+        admission = self.nyuki.admission
+        if exec:
+            # Rescued workflows were already running, never reject them
+            admission.take(wf_tmpl.uid)
+        else:
+            try:
+                await admission.acquire(wf_tmpl.uid)
+            except AdmissionRejected as exc:
+                return Response(status=429, body={'error': str(exc)})
+            except AdmissionTimeout as exc:
+                return Response(status=503, body={'error': str(exc)})
+
         if exec:
             wflow = await self.nyuki.engine.rescue(wf_tmpl, request)
         elif draft:
@@ -124,9 +172,11 @@ class ApiWorkflows(_WorkflowResource):
             wflow = await self.nyuki.engine.trigger(wf_tmpl.uid, data)
 
         if wflow is None:
+            admission.release(wf_tmpl.uid)
             return Response(status=400, body={
                 'error': 'Could not start any workflow from this template'
             })
+        admission.release_on_done(wf_tmpl.uid, wflow)
 
         # Prevent workflow loop
         exec_track = exec_track.split(',') if exec_track else []
@@ -281,13 +331,17 @@ class ApiWorkflowsHistory:
         Filters:
             * `root` return only the root workflows
             * `full` return the full graph and details of all workflows
-                * :warning: can be a huge amount of data
+                * :warning: can be a huge amount of data, 413 if the tasks
+                  exceed the `mongo.history_max_size` config
             * `since` return the workflows since this date
             * `state` return the workflows on this FutureState
             * `offset` return the worflows from this offset
             * `limit` return this amount of workflows
+            * `next` return the workflows following a page, using its
+              `next` token (same filters and ordering, prefer to `offset`)
             * `order` order results following the Ordering enum values
-            * `search` search templates with specific title
+            * `search` return the workflows whose template title contains
+              this text (case-insensitive)
         """
         # Filter on start date
         since = request.query.get('since')
@@ -335,17 +389,24 @@ class ApiWorkflowsHistory:
                 })
 
         try:
-            count, history = await self.nyuki.storage.get_history(
+            count, history, next_page = await self.nyuki.storage.get_history(
                 root=(request.query.get('root') == '1'),
                 full=(request.query.get('full') == '1'),
                 search=request.query.get('search'),
                 order=order,
                 offset=offset, limit=limit, since=since, state=state,
+                after=request.query.get('next'),
             )
         except AutoReconnect:
             return Response(status=503)
+        except InvalidPageToken as exc:
+            return Response(status=400, body={'error': str(exc)})
+        except PayloadTooLarge as exc:
+            return Response(status=413, body={
+                'error': '{}, use a lower limit'.format(exc)
+            })
 
-        data = {'count': count, 'data': history}
+        data = {'count': count, 'data': history, 'next': next_page}
         return Response(data)
 
 
@@ -370,7 +431,7 @@ class ApiWorkflowHistoryTask:
     async def get(self, request, uid, task_id):
         try:
             task = await self.nyuki.storage.get_instance_task(
-                task_id, (request.query.get('full') == '1')
+                task_id, (request.query.get('full') == '1'), uid,
             )
         except AutoReconnect:
             return Response(status=503)
@@ -384,7 +445,9 @@ class ApiWorkflowHistoryTaskData:
 
     async def get(self, request, uid, task_id):
         try:
-            task = await self.nyuki.storage.get_instance_task_data(task_id)
+            task = await self.nyuki.storage.get_instance_task_data(
+                task_id, uid,
+            )
         except AutoReconnect:
             return Response(status=503)
         if not task:
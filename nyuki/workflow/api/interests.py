@@ -0,0 +1,142 @@
+import json
+
+from nyuki.api import Response, resource
+
+from nyuki.workflow.interests import LeaseNotFound
+
+
+def lease_params(request):
+    """
+    Check the body of a lease request, return the `watch` arguments.
+    """
+    params = {}
+    for key in ('instances', 'templates'):
+        value = request.get(key, [])
+        if not isinstance(value, list) or not all(
+            isinstance(item, str) for item in value
+        ):
+            raise ValueError("'{}' must be a list of ids".format(key))
+        params[key] = value
+    ttl = request.get('ttl')
+    if ttl is not None and (
+        not isinstance(ttl, (int, float)) or isinstance(ttl, bool) or ttl <= 0
+    ):
+        raise ValueError("'ttl' must be a positive number of seconds")
+    params['ttl'] = ttl
+    return params
+
+
+async def replicate(nyuki, request, path=None, body=None):
+    """
+    Apply a lease request to the other worker processes (prefork mode), the
+    exec events of an instance are only published by the worker owning it.
+    Return their responses by worker index.
+    """
+    workers = nyuki.workers
+    if not workers.enabled or workers.forwarded(request):
+        return {}
+    return await workers.broadcast(request, path, body)
+
+
+def replicated(responses):
+    """
+    Return the first response of the other workers that is not a 404.
+    """
+    for status, content_type, body in responses.values():
+        if status != 404:
+            headers = {'Content-Type': content_type} if content_type else {}
+            return Response(body=body, status=status, headers=headers)
+    return Response(status=404)
+
+
+@resource('/workflow/watch', versions=['v1'])
+class ApiWorkflowWatches:
+
+    async def get(self, request):
+        """
+        Return the active leases on workflow exec updates
+        """
+        return Response(self.nyuki.interests.stats())
+
+    async def put(self, request):
+        """
+        Watch the exec updates of workflow instances and/or templates.
+        {
+            "instances": ["<instance id>"],
+            "templates": ["<template id>"],
+            "ttl": <seconds>
+        }
+        """
+        request_body = await request.json()
+        try:
+            params = lease_params(request_body)
+        except ValueError as exc:
+            return Response(status=400, body={'error': str(exc)})
+        lease = self.nyuki.interests.watch(**params)
+        # Same lease id in every worker
+        await replicate(
+            self.nyuki, request,
+            path='{}/{}'.format(request.rel_url.path, lease['id']),
+            body=json.dumps(request_body),
+        )
+        return Response(lease)
+
+
+@resource('/workflow/watch/{lease_id}', versions=['v1'])
+class ApiWorkflowWatch:
+
+    async def get(self, request, lease_id):
+        """
+        Return the lease `lease_id`
+        """
+        try:
+            return Response(self.nyuki.interests.get(lease_id))
+        except LeaseNotFound:
+            return replicated(await replicate(self.nyuki, request))
+
+    async def put(self, request, lease_id):
+        """
+        Create or replace the lease `lease_id`
+        """
+        request_body = await request.json()
+        try:
+            params = lease_params(request_body)
+        except ValueError as exc:
+            return Response(status=400, body={'error': str(exc)})
+        lease = self.nyuki.interests.watch(
+            lease_id=lease_id, create=True, **params
+        )
+        await replicate(self.nyuki, request)
+        return Response(lease)
+
+    async def post(self, request, lease_id):
+        """
+        Renew the lease `lease_id`, replacing its interests if any is given
+        """
+        request_body = await request.json() if request.can_read_body else {}
+        try:
+            params = lease_params(request_body)
+        except ValueError as exc:
+            return Response(status=400, body={'error': str(exc)})
+
+        responses = await replicate(self.nyuki, request)
+        interests = self.nyuki.interests
+        try:
+            if 'instances' in request_body or 'templates' in request_body:
+                lease = interests.watch(lease_id=lease_id, **params)
+            else:
+                lease = interests.renew(lease_id, params['ttl'])
+        except LeaseNotFound:
+            return replicated(responses)
+        return Response(lease)
+
+    async def delete(self, request, lease_id):
+        """
+        Stop watching the interests of the lease `lease_id`
+        """
+        responses = await replicate(self.nyuki, request)
+        try:
+            self.nyuki.interests.cancel(lease_id)
+        except LeaseNotFound:
+            return replicated(responses)
+        return Response()
@@ -0,0 +1,40 @@
+from nyuki.api import Response, resource
+
+
+@resource('/workflow/stats', versions=['v1'])
+class ApiWorkflowStats:
+
+    async def get(self, request):
+        """
+        Return the internal metrics of the workflow engine
+        """
+        return Response({
+            'history': self.nyuki.history.stats(),
+            'websocket': self.nyuki.publisher.stats(),
+            'templates': self.nyuki.templates.stats(
+                wflow.template
+                for wflow in self.nyuki.running_workflows.values()
+            ),
+        })
+
+
+@resource('/workflow/stats/tasks', versions=['v1'])
+class ApiWorkflowTaskStats:
+
+    async def get(self, request):
+        """
+        Return the timing histograms and outcomes per task name and template
+        """
+        timings = self.nyuki.timings
+        return Response(await self.nyuki.workers.aggregate(
+            request, timings.stats(), timings.merge
+        ))
+
+    async def delete(self, request):
+        """
+        Reset the task timings
+        """
+        self.nyuki.timings.reset()
+        workers = self.nyuki.workers
+        if workers.enabled and not workers.forwarded(request):
+            await workers.broadcast(request)
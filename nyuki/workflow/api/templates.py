@@ -183,6 +183,8 @@ class ApiTemplate(_TemplateResource):
             'title': request.get('title'),
             'tags': request.get('tags', []),
         })
+        self.nyuki.engine.selector.update_metadata(tid, metadata)
+        await self.nyuki.invalidation.invalidate('templates', tid)
 
         return Response(metadata)
 
@@ -200,6 +202,8 @@ class ApiTemplate(_TemplateResource):
             return Response(status=404)
 
         await self.nyuki.storage.delete_template(tid)
+        self.nyuki.engine.selector.unload(tid)
+        await self.nyuki.invalidation.invalidate('templates', tid)
         return Response(templates)
 
 
@@ -262,6 +266,9 @@ class ApiTemplateDraft(_TemplateResource):
         # Update draft into a new template
         await self.nyuki.storage.publish_draft(tid)
         tmpl_dict['state'] = TemplateState.ACTIVE.value
+        # Replace the previous active version in the selector's index
+        self.nyuki.engine.selector.load(tmpl_dict)
+        await self.nyuki.invalidation.invalidate('templates', tid)
         return Response(tmpl_dict)
 
     async def patch(self, request, tid):
@@ -35,15 +35,21 @@ class DataInspector(object):
             raise HTTPBreak(503)
         if not template:
             raise HTTPBreak(404, {'error': 'template not found'})
+        return self.template_keys(template)
 
+    @classmethod
+    def template_keys(cls, template):
+        """
+        Return the data keys used by the tasks of a template dict.
+        """
         keys = set()
         for task in template.get('tasks', []):
             for key, data in task.get('config', {}).items():
                 # Get all evaluable inner-data
-                for value in self.iter(data):
+                for value in cls.iter(data):
                     if not isinstance(value, str):
                         continue
-                    for regex in self.REGEX:
+                    for regex in cls.REGEX:
                         for data_key in regex.findall(value):
                             keys.add(data_key)
         return list(keys)
@@ -0,0 +1,355 @@
+import asyncio
+import fcntl
+import gzip
+import logging
+import os
+import re
+import threading
+import zlib
+from bson import json_util
+from pymongo.errors import AutoReconnect
+
+from .task_instances import TaskInstancesCollection
+from .utils.buckets import date_range, months_before
+
+
+log = logging.getLogger(__name__)
+
+
+def project(document, fields):
+    """
+    Apply an inclusion projection of mongo (dotted `fields`) to a document.
+    """
+    result = {}
+    for field, included in fields.items():
+        if not included:
+            continue
+        source, target = document, result
+        keys = field.split('.')
+        for key in keys[:-1]:
+            source = source.get(key) if isinstance(source, dict) else None
+            if not isinstance(source, dict):
+                break
+            target = target.setdefault(key, {})
+        else:
+            if keys[-1] in source:
+                target[keys[-1]] = source[keys[-1]]
+    return result
+
+
+class SegmentStore:
+
+    """
+    Append-only segments of archived workflow instances (with their tasks),
+    one JSON document per line. Each batch is appended as a gzip member, the
+    index file of a segment gives the offset of the member and the line of
+    each instance: `<id> <offset> <line>`.
+    Several processes may share a store, appends are locked. The in-memory
+    index is guarded as well, it is used from the executor threads.
+    """
+
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    SEGMENT_REGEX = re.compile(r'^history-(\d{6})\.idx$')
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self._segment_size = segment_size
+        # {<instance id>: (<segment>, <offset>, <line>)}
+        self._index = {}
+        # Read size of each index file
+        self._positions = {}
+        self._current = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._index)
+
+    def _file(self, segment, extension):
+        return os.path.join(
+            self.path, 'history-{:06d}.{}'.format(segment, extension)
+        )
+
+    def load(self):
+        """
+        Read the new entries of the index files.
+        """
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        os.makedirs(self.path, exist_ok=True)
+        for filename in sorted(os.listdir(self.path)):
+            match = self.SEGMENT_REGEX.match(filename)
+            if match is None:
+                continue
+            segment = int(match.group(1))
+            self._current = max(self._current, segment)
+            path = self._file(segment, 'idx')
+            position = self._positions.get(path, 0)
+            with open(path, 'rb') as file:
+                file.seek(position)
+                data = file.read()
+            # Ignore a partly written entry
+            data = data[:data.rfind(b'\n') + 1]
+            for entry in data.decode().splitlines():
+                try:
+                    wid, offset, line = entry.split()
+                    self._index[wid] = (segment, int(offset), int(line))
+                except ValueError:
+                    log.warning("Invalid archive index entry '%s'", entry)
+            self._positions[path] = position + len(data)
+
+    def append(self, instances):
+        """
+        Append the instances not archived yet, return their count.
+        """
+        with open(os.path.join(self.path, 'lock'), 'w') as lock, self._lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            instances = [i for i in instances if i['id'] not in self._index]
+            if not instances:
+                return 0
+
+            segment = self._current or 1
+            path = self._file(segment, 'ndjson.gz')
+            if os.path.exists(path) and \
+                    os.path.getsize(path) >= self._segment_size:
+                segment += 1
+                path = self._file(segment, 'ndjson.gz')
+            data = gzip.compress(''.join(
+                json_util.dumps(instance) + '\n' for instance in instances
+            ).encode())
+            with open(path, 'ab') as file:
+                offset = file.tell()
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+
+            # Instances are only indexed once stored
+            path = self._file(segment, 'idx')
+            with open(path, 'a') as file:
+                # After a partly written entry
+                if file.tell() > self._positions.get(path, 0):
+                    file.write('\n')
+                file.write(''.join(
+                    '{} {} {}\n'.format(instance['id'], offset, line)
+                    for line, instance in enumerate(instances)
+                ))
+                file.flush()
+                os.fsync(file.fileno())
+            self._load()
+            return len(instances)
+
+    def get(self, instance_id):
+        """
+        Return an archived instance, decompressing its gzip member only.
+        """
+        with self._lock:
+            if instance_id not in self._index:
+                # Archived by another process
+                self._load()
+            try:
+                segment, offset, line = self._index[instance_id]
+            except KeyError:
+                return None
+
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        data = b''
+        with open(self._file(segment, 'ndjson.gz'), 'rb') as file:
+            file.seek(offset)
+            while not decompressor.eof:
+                chunk = file.read(64 * 1024)
+                if not chunk:
+                    break
+                data += decompressor.decompress(chunk)
+        return json_util.loads(data.split(b'\n')[line].decode())
+
+
+class HistoryArchive:
+
+    """
+    Move the workflow instances started before the last `after` months, and
+    their tasks, from mongo to the segments of `path`, every `interval`
+    seconds. Archived instances are deleted from mongo by id, monthly
+    buckets are dropped once empty. Archived instances are read by id.
+    """
+
+    INTERVAL = 3600.0
+    BATCH_SIZE = 500
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._segments = None
+        self._after = None
+        self._interval = self.INTERVAL
+        self._future = None
+
+    def configure(self, path=None, after=None, interval=INTERVAL,
+                  segment_size=SegmentStore.SEGMENT_SIZE):
+        if after is not None and after <= 0:
+            raise ValueError("'after' must be a positive number of months")
+        if path is None:
+            self._segments = None
+        elif self._segments is None or self._segments.path != path:
+            self._segments = SegmentStore(path, segment_size)
+        self._after = after
+        self._interval = interval
+
+    async def _call(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(
+            None, func, *args
+        )
+
+    async def start(self):
+        if self._segments is None:
+            return
+        await self._call(self._segments.load)
+        log.info('%s archived workflow instances', len(self._segments))
+        if self._after and self._future is None:
+            self._future = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.archive()
+            except AutoReconnect as exc:
+                log.error('Could not archive the history: %s', exc)
+            except Exception as exc:
+                log.error('Failed to archive the history')
+                log.exception(exc)
+            await asyncio.sleep(self._interval)
+
+    @staticmethod
+    def _complete(workflow, tasks):
+        """
+        Return True if all the tasks of the graph of an instance were read,
+        with their content.
+        """
+        expected = set()
+        for parent, children in workflow['template'].get('graph', {}).items():
+            expected.add(parent)
+            expected.update(children)
+        found = {
+            task['template']['id'] for task in tasks
+            if task.get('id') and 'id' in task.get('template', {})
+        }
+        return expected <= found
+
+    async def _archive(self, collection, task_collection, batch):
+        """
+        Store a batch of instances with their tasks, then delete them.
+        Instances whose tasks could not all be read are left in mongo.
+        """
+        tasks = self._storage._task_instances
+        since, until = date_range(batch)
+        found = await tasks.get_many(
+            [workflow['id'] for workflow in batch],
+            full=True, since=since, until=until,
+        )
+        complete = []
+        for workflow in batch:
+            if not self._complete(workflow, found[workflow['id']]):
+                log.warning(
+                    "Missing tasks of workflow instance '%s', not archived",
+                    workflow['id'],
+                )
+                continue
+            workflow['template']['tasks'] = found[workflow['id']]
+            complete.append(workflow)
+        if not complete:
+            return 0
+
+        wids = [workflow['id'] for workflow in complete]
+        archived = await self._call(self._segments.append, complete)
+        await collection.delete_many({'id': {'$in': wids}})
+        await task_collection.delete_many({
+            'workflow_instance_id': {'$in': wids},
+        })
+        return archived
+
+    async def _archive_bucket(self, name, query, task_name):
+        workflows = self._storage._workflow_instances
+        tasks = self._storage._task_instances
+        collection = workflows.buckets.collection(name)
+        task_collection = tasks.buckets.collection(task_name)
+        archived = 0
+        batch = []
+        async for workflow in collection.find(query, workflows.FILTERS):
+            batch.append(workflow)
+            if len(batch) >= self.BATCH_SIZE:
+                archived += await self._archive(
+                    collection, task_collection, batch
+                )
+                batch = []
+        if batch:
+            archived += await self._archive(collection, task_collection, batch)
+        return archived
+
+    async def _drop_if_empty(self, buckets, name):
+        """
+        Drop an archived bucket, unless reports were written to it since it
+        was read (archived on the next run).
+        """
+        if await buckets.collection(name).count_documents({}) > 0:
+            log.info('History bucket %s not empty, kept', name)
+            return
+        await buckets.drop(name)
+
+    async def archive(self):
+        """
+        Archive the instances started before the last `after` months.
+        """
+        workflows = self._storage._workflow_instances
+        tasks = self._storage._task_instances
+        before = months_before(None, self._after)
+        names = await workflows.buckets.names(until=months_before(before, 1))
+        archived = 0
+        for name in names:
+            date = workflows.buckets.month(name)
+            if date is None:
+                query = {'start': {'$lt': before}}
+                task_name = tasks.buckets.unpartitioned
+            else:
+                query = {}
+                task_name = tasks.buckets.name(date)
+            archived += await self._archive_bucket(name, query, task_name)
+            if date is not None:
+                await self._drop_if_empty(workflows.buckets, name)
+                await self._drop_if_empty(tasks.buckets, task_name)
+        if archived:
+            log.info('Archived %s workflow instances', archived)
+        return archived
+
+    async def get_instance(self, instance_id, full=False):
+        """
+        Return an archived instance, with its tasks.
+        """
+        if self._segments is None:
+            return None
+        workflow = await self._call(self._segments.get, instance_id)
+        if workflow is not None and full is False:
+            workflow['template']['tasks'] = [
+                project(task, TaskInstancesCollection.TASK_HISTORY_FILTERS)
+                for task in workflow['template']['tasks']
+            ]
+        return workflow
+
+    async def get_task(self, instance_id, task_id, full=False):
+        """
+        Return one task of an archived instance.
+        """
+        workflow = await self.get_instance(instance_id, full=True)
+        if workflow is None:
+            return None
+        for task in workflow['template']['tasks']:
+            if task['id'] == task_id:
+                if full is False:
+                    task.pop('inputs', None)
+                    task.pop('outputs', None)
+                return task
@@ -0,0 +1,48 @@
+import logging
+
+from pymongo import IndexModel, ReturnDocument
+
+from .utils.indexes import ensure_indexes
+
+
+log = logging.getLogger(__name__)
+
+
+class CacheVersionsCollection:
+
+    """
+    Cluster-wide version of each kind of in-memory cache, incremented on
+    every invalidation.
+    {
+        "kind": <str>,
+        "version": <int>
+    }
+    """
+
+    def __init__(self, db):
+        self._versions = db['cache_versions']
+
+    async def index(self):
+        await ensure_indexes(self._versions, [
+            IndexModel('kind', unique=True, name='unique_kind'),
+        ])
+
+    async def get(self):
+        """
+        Return the current version of all cache kinds.
+        """
+        cursor = self._versions.find(None, {'_id': 0})
+        return {doc['kind']: doc['version'] async for doc in cursor}
+
+    async def bump(self, kind):
+        """
+        Increment and return the version of a cache kind.
+        """
+        doc = await self._versions.find_one_and_update(
+            {'kind': kind},
+            {'$inc': {'version': 1}},
+            projection={'_id': 0},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return doc['version']
@@ -1,6 +1,8 @@
 import logging
+from copy import deepcopy
+from pymongo import IndexModel
 
-from .utils.indexes import check_index_names
+from .utils.indexes import ensure_indexes
 
 
 log = logging.getLogger(__name__)
@@ -10,10 +12,13 @@ class DataProcessingCollection:
 
     def __init__(self, db, collection_name):
         self._rules = db[collection_name]
+        # In-memory cache of the rules fetched by id
+        self._cache = {}
 
     async def index(self):
-        await check_index_names(self._rules, ['unique_id'])
-        await self._rules.create_index('id', unique=True, name='unique_id')
+        await ensure_indexes(self._rules, [
+            IndexModel('id', unique=True, name='unique_id'),
+        ])
 
     async def get(self):
         """
@@ -26,7 +31,25 @@ class DataProcessingCollection:
         """
         Return the rule for given id or None
         """
-        return await self._rules.find_one({'id': rule_id}, {'_id': 0})
+        # Copies, the nested values must not be shared with the cache
+        try:
+            return deepcopy(self._cache[rule_id])
+        except KeyError:
+            pass
+        rule = await self._rules.find_one({'id': rule_id}, {'_id': 0})
+        if rule is not None:
+            self._cache[rule_id] = rule
+            return deepcopy(rule)
+        return rule
+
+    def evict(self, rule_id=None):
+        """
+        Remove a rule from the in-memory cache, or all rules.
+        """
+        if rule_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(rule_id, None)
 
     async def insert(self, data):
         """
@@ -46,6 +69,7 @@ class DataProcessingCollection:
         )
         log.debug('upserting data: %s', data)
         await self._rules.replace_one(query, data, upsert=True)
+        self.evict(data['id'])
 
     async def delete(self, rule_id=None):
         """
@@ -55,3 +79,4 @@ class DataProcessingCollection:
         log.info("Removing rule(s) from collection '%s'", self._rules.name)
         log.debug('delete query: %s', query)
         await self._rules.delete_one(query)
+        self.evict(rule_id)
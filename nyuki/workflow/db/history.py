@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import time
+from pymongo.errors import AutoReconnect
+
+from .utils.buckets import months_before
+
+
+log = logging.getLogger(__name__)
+
+
+class HistoryWriter:
+
+    """
+    Write-behind buffer of the finished workflow instances.
+    Instances are queued (up to `max_pending`, producers wait beyond) and
+    written in bulk every `batch_size` instances or `flush_interval` seconds,
+    whichever comes first.
+    With a `retention` (in months, besides the current one), the buckets of
+    the older months are dropped every `EXPIRE_INTERVAL` seconds.
+    """
+
+    BATCH_SIZE = 500
+    FLUSH_INTERVAL = 1.0
+    MAX_PENDING = 10000
+    RETRY_DELAY = 1.0
+    # Write attempts of the remaining instances when stopping
+    STOP_RETRIES = 3
+    EXPIRE_INTERVAL = 3600.0
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._batch_size = self.BATCH_SIZE
+        self._interval = self.FLUSH_INTERVAL
+        self._queue = asyncio.Queue(maxsize=self.MAX_PENDING)
+        self._flush_future = None
+        self._write_future = None
+        self._expire_future = None
+        self._retention = None
+        # Instances taken from the queue, waiting for a full batch
+        self._batch = []
+        self._stopping = False
+        self._stats = {
+            'flushed': 0,
+            'batches': 0,
+            'retries': 0,
+            'errors': 0,
+            'last_flush_time': None,
+            'max_flush_time': 0.0,
+            'total_flush_time': 0.0,
+        }
+
+    def configure(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                  max_pending=MAX_PENDING, retention=None):
+        self._batch_size = batch_size
+        self._retention = retention
+        self._interval = flush_interval
+        if max_pending != self._queue.maxsize:
+            if self._queue.empty():
+                self._queue = asyncio.Queue(maxsize=max_pending)
+            else:
+                log.warning('History queue not empty, size unchanged')
+
+    def start(self):
+        self._stopping = False
+        if self._flush_future is None:
+            self._flush_future = asyncio.ensure_future(self._run())
+        if self._expire_future is None:
+            self._expire_future = asyncio.ensure_future(self._expire())
+
+    async def stop(self):
+        """
+        Stop the periodic flush and write all the pending instances.
+        """
+        self._stopping = True
+        if self._expire_future is not None:
+            self._expire_future.cancel()
+            self._expire_future = None
+        if self._flush_future is not None:
+            self._flush_future.cancel()
+            self._flush_future = None
+        if self._write_future is not None:
+            await self._write_future
+        batch, self._batch = self._batch, []
+        await self._write(batch)
+        while not self._queue.empty():
+            await self._write(self._next_batch())
+
+    async def put(self, instance):
+        """
+        Queue a workflow report to be inserted in the history.
+        """
+        await self._queue.put(instance)
+
+    def stats(self):
+        batches = self._stats['batches']
+        return {
+            'pending': self._queue.qsize() + len(self._batch),
+            'max_pending': self._queue.maxsize,
+            'flushed': self._stats['flushed'],
+            'batches': batches,
+            'retries': self._stats['retries'],
+            'errors': self._stats['errors'],
+            'last_flush_time': self._stats['last_flush_time'],
+            'max_flush_time': self._stats['max_flush_time'],
+            'avg_flush_time': (
+                self._stats['total_flush_time'] / batches if batches else None
+            ),
+        }
+
+    def _next_batch(self):
+        batch = []
+        while len(batch) < self._batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            # Wait for a first instance, then for a full batch or the interval
+            self._batch.append(await self._queue.get())
+            deadline = time.monotonic() + self._interval
+            while len(self._batch) < self._batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    self._batch.append(
+                        await asyncio.wait_for(self._queue.get(), timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+            batch, self._batch = self._batch, []
+            # Never interrupt a write, `stop` waits for it
+            self._write_future = asyncio.ensure_future(self._write(batch))
+            await asyncio.shield(self._write_future)
+            self._write_future = None
+
+    async def _expire(self):
+        while True:
+            if self._retention:
+                before = months_before(None, self._retention)
+                try:
+                    await self._storage.expire_history(before)
+                except AutoReconnect as exc:
+                    log.error('Could not expire the history: %s', exc)
+                except Exception as exc:
+                    log.error('Failed to expire the history')
+                    log.exception(exc)
+            await asyncio.sleep(self.EXPIRE_INTERVAL)
+
+    async def _write(self, batch):
+        if not batch:
+            return
+        start = time.monotonic()
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                await self._storage.insert_instances(batch)
+            except AutoReconnect as exc:
+                # Do not block the nyuki's shutdown forever
+                if self._stopping and attempts > self.STOP_RETRIES:
+                    self._stats['errors'] += 1
+                    log.error('Lost %s workflow instances: %s', len(batch), exc)
+                    break
+                self._stats['retries'] += 1
+                log.error(
+                    'Could not write %s workflow instances, retrying in %ss: %s',
+                    len(batch), self.RETRY_DELAY, exc,
+                )
+                await asyncio.sleep(self.RETRY_DELAY)
+            except Exception as exc:
+                self._stats['errors'] += 1
+                log.error('Failed to write %s workflow instances', len(batch))
+                log.exception(exc)
+                break
+            else:
+                self._stats['flushed'] += len(batch)
+                break
+
+        elapsed = time.monotonic() - start
+        self._stats['batches'] += 1
+        self._stats['last_flush_time'] = elapsed
+        self._stats['total_flush_time'] += elapsed
+        self._stats['max_flush_time'] = max(
+            self._stats['max_flush_time'], elapsed
+        )
+        log.debug('Wrote %s workflow instances in %.3fs', len(batch), elapsed)
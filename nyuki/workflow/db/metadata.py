@@ -1,8 +1,8 @@
 import logging
 
-from pymongo import ReturnDocument
+from pymongo import IndexModel, ReturnDocument
 
-from .utils.indexes import check_index_names
+from .utils.indexes import ensure_indexes
 
 
 log = logging.getLogger(__name__)
@@ -22,12 +22,11 @@ class MetadataCollection:
         self._metadata = db['workflow_metadata']
 
     async def index(self):
-        await check_index_names(self._metadata, ['unique_workflow_template_id'])
-        await self._metadata.create_index(
+        await ensure_indexes(self._metadata, [IndexModel(
             'workflow_template_id',
             unique=True,
             name='unique_workflow_template_id',
-        )
+        )])
 
     async def get_one(self, tid):
         """
@@ -38,6 +37,19 @@ class MetadataCollection:
             {'_id': 0, 'workflow_template_id': 0},
         )
 
+    async def get_many(self, tids):
+        """
+        Return the metadata of several templates, by template id.
+        """
+        cursor = self._metadata.find(
+            {'workflow_template_id': {'$in': list(tids)}},
+            {'_id': 0},
+        )
+        return {
+            metadata.pop('workflow_template_id'): metadata
+            async for metadata in cursor
+        }
+
     async def insert(self, metadata):
         """
         Insert new metadata for a template.
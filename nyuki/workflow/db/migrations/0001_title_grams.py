@@ -0,0 +1,49 @@
+import logging
+from pymongo import ASCENDING, UpdateOne
+
+from nyuki.workflow.db.utils.search import ngrams
+
+
+log = logging.getLogger(__name__)
+
+
+class Migration:
+
+    """
+    Add the n-grams of the template titles to the workflow instances
+    stored before the title search used them.
+    """
+
+    BACKGROUND = True
+    BATCH_SIZE = 1000
+
+    def __init__(self, db):
+        self._instances = db['workflow_instances']
+
+    async def run_batch(self, position):
+        """
+        Index the titles of the next instances without n-grams, by `_id`.
+        """
+        query = {'title_grams': None}
+        if position is not None:
+            query['_id'] = {'$gt': position}
+        cursor = self._instances.find(
+            query, {'_id': 1, 'template.title': 1},
+        ).sort('_id', ASCENDING).limit(self.BATCH_SIZE)
+        instances = await cursor.to_list(None)
+        if not instances:
+            return None
+
+        await self._instances.bulk_write([
+            UpdateOne(
+                {'_id': instance['_id']},
+                {'$set': {
+                    'title_grams': ngrams(
+                        instance.get('template', {}).get('title')
+                    ),
+                }},
+            )
+            for instance in instances
+        ], ordered=False)
+        log.info('Indexed the title of %s workflow instances', len(instances))
+        return instances[-1]['_id']
@@ -1,23 +1,224 @@
+"""
+Versioned migrations of the workflow database.
+
+Each module `<number>_<name>.py` of this folder defines a `Migration(db)`
+class, applied once in the order of the module names. Applied migrations
+are recorded in the `migrations` collection, with the checksum of their
+module, so that only the pending ones run on startup.
+
+A migration either defines `async def run()`, awaited before the nyuki
+starts, or sets `BACKGROUND = True` and defines `async def run_batch(
+position)`, returning the position of its next batch (None once done).
+Background migrations run after the startup, and resume from their last
+recorded position when interrupted.
+"""
+import asyncio
+import hashlib
+import logging
 import os
+from datetime import datetime, timedelta, timezone
+from enum import Enum
 from importlib import util
+from pymongo import IndexModel, ReturnDocument
+from pymongo.errors import AutoReconnect, DuplicateKeyError
+
+from ..utils.indexes import ensure_indexes
+
+
+log = logging.getLogger(__name__)
+
+
+class MigrationState(Enum):
+
+    RUNNING = 'running'
+    APPLIED = 'applied'
+
+
+def checksum(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def load_migration(name, path, db):
+    spec = util.spec_from_file_location(name, path)
+    module = util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Migration(db)
+
+
+class MigrationRunner:
+
+    """
+    Run the pending migrations, one replica at a time: a migration is
+    leased for `LEASE` seconds, renewed while it runs. The other replicas
+    poll its record every `POLL` seconds until it is applied, or take it
+    over once its lease expired.
+    """
 
+    LEASE = 60.0
+    POLL = 5.0
+    FOLDER = os.path.dirname(__file__)
 
-async def run_migrations(*args, **kwargs):
-    folder = os.path.dirname(__file__)
-    migrations = set()
-    with os.scandir(folder) as sd:
-        for entry in sd:
-            if entry.name.startswith('__') or entry.name.endswith('__.py'):
+    def __init__(self, db):
+        self._db = db
+        self._migrations = db['migrations']
+        self._future = None
+
+    def _modules(self):
+        """
+        Return the (name, path) of the migration modules, sorted by name.
+        """
+        modules = []
+        with os.scandir(self.FOLDER) as sd:
+            for entry in sd:
+                name, extension = os.path.splitext(entry.name)
+                if extension != '.py' or name.startswith('__'):
+                    continue
+                modules.append((name, entry.path))
+        return sorted(modules)
+
+    async def run(self):
+        """
+        Apply the pending migrations, those running in background are
+        started last.
+        """
+        await ensure_indexes(self._migrations, [
+            IndexModel('name', unique=True, name='unique_name'),
+        ])
+        records = {
+            record['name']: record
+            async for record in self._migrations.find({}, {'_id': 0})
+        }
+
+        background = []
+        for name, path in self._modules():
+            record = records.get(name, {})
+            digest = checksum(path)
+            if record.get('state') == MigrationState.APPLIED.value:
+                if record.get('checksum') != digest:
+                    log.warning('Migration %s changed since applied', name)
                 continue
-            migrations.add(entry.name)
-
-    for filename in migrations:
-        name, _ = os.path.splitext(filename)
-        path = os.path.join(folder, filename)
-        # Load module spec.
-        spec = util.spec_from_file_location(name, path)
-        # Load module.
-        module = spec.loader.load_module(spec.name)
-        # Instantiate module migration and run.
-        migration = module.Migration(*args, **kwargs)
-        await migration.run()
+            migration = load_migration(name, path, self._db)
+            if getattr(migration, 'BACKGROUND', False) is True:
+                background.append((name, digest, migration))
+            else:
+                await self._apply(name, digest, migration)
+
+        if background and self._future is None:
+            self._future = asyncio.ensure_future(
+                self._run_background(background)
+            )
+
+    async def stop(self):
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
+
+    def _lease(self):
+        return datetime.now(timezone.utc) + timedelta(seconds=self.LEASE)
+
+    async def _acquire(self, name, digest):
+        """
+        Lease a pending migration, return its record or None if applied or
+        leased by another replica.
+        """
+        now = datetime.now(timezone.utc)
+        try:
+            return await self._migrations.find_one_and_update(
+                {
+                    'name': name,
+                    'state': {'$ne': MigrationState.APPLIED.value},
+                    '$or': [
+                        {'locked_until': None},
+                        {'locked_until': {'$lt': now}},
+                    ],
+                },
+                {
+                    '$set': {
+                        'checksum': digest,
+                        'state': MigrationState.RUNNING.value,
+                        'locked_until': self._lease(),
+                    },
+                    '$setOnInsert': {'started': now, 'position': None},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            return None
+
+    async def _update(self, name, **fields):
+        await self._migrations.update_one({'name': name}, {'$set': fields})
+
+    async def _renew(self, name):
+        while True:
+            await asyncio.sleep(self.LEASE / 3)
+            try:
+                await self._update(name, locked_until=self._lease())
+            except AutoReconnect as exc:
+                log.error('Could not renew migration %s: %s', name, exc)
+
+    async def _wait(self, name, digest):
+        """
+        Return the leased record of a pending migration, or None once
+        applied by another replica.
+        """
+        waiting = False
+        while True:
+            record = await self._acquire(name, digest)
+            if record is not None:
+                return record
+            record = await self._migrations.find_one(
+                {'name': name}, {'_id': 0}
+            )
+            if record and record.get('state') == MigrationState.APPLIED.value:
+                log.info('Migration %s applied by another replica', name)
+                return None
+            if not waiting:
+                log.info('Waiting for migration %s on another replica', name)
+                waiting = True
+            await asyncio.sleep(self.POLL)
+
+    async def _apply(self, name, digest, migration):
+        record = await self._wait(name, digest)
+        if record is None:
+            return
+
+        log.info('Applying migration %s', name)
+        renew = asyncio.ensure_future(self._renew(name))
+        try:
+            if getattr(migration, 'BACKGROUND', False) is True:
+                position = record.get('position')
+                while True:
+                    position = await migration.run_batch(position)
+                    if position is None:
+                        break
+                    await self._update(name, position=position)
+            else:
+                await migration.run()
+        except BaseException:
+            # Leave it pending, for the next startup
+            await asyncio.shield(self._update(name, locked_until=None))
+            raise
+        finally:
+            renew.cancel()
+
+        await self._update(
+            name,
+            state=MigrationState.APPLIED.value,
+            applied=datetime.now(timezone.utc),
+            locked_until=None,
+        )
+        log.info('Migration %s applied', name)
+
+    async def _run_background(self, migrations):
+        for name, digest, migration in migrations:
+            try:
+                await self._apply(name, digest, migration)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                log.error('Migration %s failed', name)
+                log.exception(exc)
+                # The next ones may depend on it
+                break
@@ -1,17 +1,27 @@
+import asyncio
 import logging
 import os
 from copy import deepcopy
 
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.errors import ServerSelectionTimeoutError
-
+from pymongo.common import MAX_BSON_SIZE
+from pymongo.errors import (
+    AutoReconnect, CollectionInvalid, DocumentTooLarge,
+    ServerSelectionTimeoutError,
+)
+
+from .archive import HistoryArchive
+from .cache_versions import CacheVersionsCollection
 from .triggers import TriggerCollection
 from .data_processing import DataProcessingCollection
 from .metadata import MetadataCollection
+from .migrations import MigrationRunner
 from .workflow_templates import WorkflowTemplatesCollection, TemplateState
 from .task_templates import TaskTemplatesCollection
 from .workflow_instances import WorkflowInstancesCollection
 from .task_instances import TaskInstancesCollection
+from .utils.buckets import date_range, history_date, month
+from .utils.sanitize import sanitize_workflow_exec
 
 
 log = logging.getLogger(__name__)
@@ -19,10 +29,16 @@ log = logging.getLogger(__name__)
 
 class MongoStorage:
 
+    # Maximum size of the tasks of a full history page, in bytes
+    HISTORY_MAX_SIZE = 32 * 1024 * 1024
+
     def __init__(self):
         self._client = None
         self._db = None
         self._validate_on_start = False
+        self._validate_future = None
+        self._migrations = None
+        self._history_max_size = self.HISTORY_MAX_SIZE
 
         # Collections
         self._workflow_templates = None
@@ -33,16 +49,21 @@ class MongoStorage:
         self.regexes = None
         self.lookups = None
         self.triggers = None
+        self.cache_versions = None
+        # Instances moved out of mongo
+        self.archive = HistoryArchive(self)
 
-    def configure(self, host, database, validate_on_start=True, **kwargs):
+    def configure(self, host, database, validate_on_start=True,
+                  history_max_size=HISTORY_MAX_SIZE, **kwargs):
         log.info("Setting up mongo storage with host '%s'", host)
         self._client = AsyncIOMotorClient(host, **kwargs)
         self._validate_on_start = validate_on_start
+        self._history_max_size = history_max_size
         self._db_name = database
 
     async def index(self):
         """
-        Try to connect to mongo and index all the collections.
+        Try to connect to mongo and index all the collections concurrently.
         """
         if self._db_name not in await self._client.list_database_names():
             # If the old mongo DB does not exist, use the new tenant format
@@ -59,18 +80,22 @@ class MongoStorage:
         self.regexes = DataProcessingCollection(self._db, 'regexes')
         self.lookups = DataProcessingCollection(self._db, 'lookups')
         self.triggers = TriggerCollection(self._db)
+        self.cache_versions = CacheVersionsCollection(self._db)
 
         log.info('Trying to connect to Mongo...')
         while True:
             try:
-                await self._workflow_templates.index()
-                await self._task_templates.index()
-                await self._workflow_metadata.index()
-                await self._workflow_instances.index()
-                await self._task_instances.index()
-                await self.regexes.index()
-                await self.lookups.index()
-                await self.triggers.index()
+                await asyncio.gather(
+                    self._workflow_templates.index(),
+                    self._task_templates.index(),
+                    self._workflow_metadata.index(),
+                    self._workflow_instances.index(),
+                    self._task_instances.index(),
+                    self.regexes.index(),
+                    self.lookups.index(),
+                    self.triggers.index(),
+                    self.cache_versions.index(),
+                )
             except ServerSelectionTimeoutError as exc:
                 log.error('Could not connect to Mongo - %s', exc)
             else:
@@ -78,11 +103,39 @@ class MongoStorage:
                 break
 
         if self._validate_on_start is True:
+            # Full scans of the collections, not holding up the startup
+            self._validate_future = asyncio.ensure_future(self.validate())
+
+    async def validate(self):
+        """
+        Validate all the collections, one after another.
+        """
+        try:
             collections = await self._db.list_collection_names()
             log.info('Validating %s collections', len(collections))
             for collection in collections:
-                await self._db.validate_collection(collection)
-                log.info('Validated collection %s', collection)
+                try:
+                    await self._db.validate_collection(collection)
+                except CollectionInvalid as exc:
+                    log.error('Invalid collection %s: %s', collection, exc)
+                else:
+                    log.info('Validated collection %s', collection)
+        except AutoReconnect as exc:
+            log.error('Could not validate the collections: %s', exc)
+
+    async def migrate(self):
+        """
+        Apply the pending migrations to the selected database.
+        """
+        self._migrations = MigrationRunner(self._db)
+        await self._migrations.run()
+
+    async def stop(self):
+        if self._validate_future is not None:
+            self._validate_future.cancel()
+            self._validate_future = None
+        if self._migrations is not None:
+            await self._migrations.stop()
 
     # Templates
 
@@ -134,31 +187,41 @@ class MongoStorage:
         This does not append the metadata.
         """
         templates = await self._workflow_templates.get_for_topic(topic)
-        if templates:
-            log.info(
-                'Fetched %s templates for event from "%s"',
-                len(templates), topic,
-            )
+        if not templates:
+            return templates
+        log.info(
+            'Fetched %s templates for event from "%s"', len(templates), topic,
+        )
+        tasks = await self._task_templates.get_many(templates)
         for template in templates:
-            template['tasks'] = await self._task_templates.get(
-                template['id'], template['version']
-            )
+            template['tasks'] = tasks[(template['id'], template['version'])]
         return templates
 
     async def get_templates(self, template_id=None, full=False):
         """
         Return all active/draft templates
         Limited to a small set of fields if 'full' is False.
+        Metadata and tasks are fetched in one query each, for all templates.
         TODO: Pagination.
         """
         templates = await self._workflow_templates.get(template_id, full)
+        if not templates:
+            return templates
+
+        tids = {template['id'] for template in templates}
+        if full is True:
+            metadata, tasks = await asyncio.gather(
+                self._workflow_metadata.get_many(tids),
+                self._task_templates.get_many(templates),
+            )
+        else:
+            metadata = await self._workflow_metadata.get_many(tids)
+
         for template in templates:
-            metadata = await self._workflow_metadata.get_one(template['id'])
-            template.update(metadata)
+            template.update(metadata.get(template['id'], {}))
             if full is True:
-                template['tasks'] = await self._task_templates.get(
-                    template['id'], template['version']
-                )
+                key = (template['id'], template['version'])
+                template['tasks'] = tasks[key]
         return templates
 
     async def get_template(self, tid, draft=False, version=None):
@@ -196,38 +259,93 @@ class MongoStorage:
         """
         Insert a static workflow instance and all its tasks.
         """
-        task_instances = []
-        for task in instance['template'].pop('tasks'):
-            task['workflow_instance_id'] = instance['id']
-            task_instances.append(task)
-        await self._task_instances.insert_many(task_instances)
-        await self._workflow_instances.insert(instance)
+        await self.insert_instances([instance])
+
+    async def insert_instances(self, instances):
+        """
+        Insert a batch of static workflow instances and all their tasks.
+        The given instances are left untouched so that it can be retried.
+        """
+        # Tasks are stored in the bucket of their workflow
+        task_instances = {}
+        workflow_instances = []
+        for instance in instances:
+            tasks = task_instances.setdefault(
+                month(history_date(instance)), []
+            )
+            template = dict(instance['template'])
+            for task in template.pop('tasks'):
+                task = {**task, 'workflow_instance_id': instance['id']}
+                try:
+                    task = sanitize_workflow_exec(task, MAX_BSON_SIZE)
+                except DocumentTooLarge as exc:
+                    log.error("Task '%s' data not stored: %s", task['id'], exc)
+                    task = sanitize_workflow_exec({
+                        **task, 'inputs': None, 'outputs': None,
+                        'reporting': None,
+                    })
+                tasks.append(task)
+            workflow_instances.append(sanitize_workflow_exec(
+                {**instance, 'template': template}, MAX_BSON_SIZE
+            ))
+        await asyncio.gather(*[
+            self._task_instances.insert_many(tasks, date)
+            for date, tasks in task_instances.items()
+            if tasks
+        ])
+        await self._workflow_instances.insert_many(workflow_instances)
 
     # History
 
     async def get_history(self, **kwargs):
         """
-        Return paginated workflow history.
+        Return paginated workflow history, with the token of the next page.
+        The tasks of a full page are fetched in one query per bucket, up to
+        `history_max_size` bytes.
         """
-        count, workflows = await self._workflow_instances.get(**kwargs)
-        if kwargs.get('full') is True:
+        count, workflows, next_page = await self._workflow_instances.get(
+            **kwargs
+        )
+        if kwargs.get('full') is True and workflows:
+            since, until = date_range(workflows)
+            tasks = await self._task_instances.get_many(
+                [workflow['id'] for workflow in workflows],
+                full=True,
+                max_size=self._history_max_size,
+                since=since,
+                until=until,
+            )
             for workflow in workflows:
-                workflow['template']['tasks'] = await self._task_instances.get(
-                    workflow['id'], True
-                )
-        return count, workflows
+                workflow['template']['tasks'] = tasks[workflow['id']]
+        return count, workflows, next_page
+
+    async def expire_history(self, before):
+        """
+        Drop the history buckets of the months before the month of
+        `before`. The history stored before the partitioning is kept.
+        """
+        await self._workflow_instances.buckets.drop_before(before)
+        await self._task_instances.buckets.drop_before(before)
 
     async def get_instance(self, instance_id, full=False):
         workflow = await self._workflow_instances.get_one(instance_id, full)
         if not workflow:
-            return
+            return await self.archive.get_instance(instance_id, full)
         workflow['template']['tasks'] = await self._task_instances.get(
-            workflow['id'], full
+            workflow['id'], full, history_date(workflow)
         )
         return workflow
 
-    async def get_instance_task(self, task_id, full=False):
-        return await self._task_instances.get_one(task_id, full)
-
-    async def get_instance_task_data(self, task_id):
-        return await self._task_instances.get_data(task_id)
+    async def get_instance_task(self, task_id, full=False, instance_id=None):
+        task = await self._task_instances.get_one(task_id, full)
+        if not task and instance_id is not None:
+            return await self.archive.get_task(instance_id, task_id, full)
+        return task
+
+    async def get_instance_task_data(self, task_id, instance_id=None):
+        data = await self._task_instances.get_data(task_id)
+        if not data and instance_id is not None:
+            task = await self.archive.get_task(instance_id, task_id, True)
+            if task:
+                return {key: task.get(key) for key in ('inputs', 'outputs')}
+        return data
@@ -1,9 +1,16 @@
+import asyncio
 import logging
 from datetime import timezone
 
+from bson import BSON
 from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import IndexModel
+from pymongo.errors import BulkWriteError
 
-from .utils.indexes import check_index_names
+from .utils.buckets import Buckets
+from .utils.errors import PayloadTooLarge, only_duplicates
+from .utils.indexes import ensure_indexes
 
 
 log = logging.getLogger(__name__)
@@ -30,33 +37,86 @@ class TaskInstancesCollection:
         **{'outputs.{}'.format(key): 1 for key in WS_FILTERS}
     }
 
+    CODEC_OPTIONS = CodecOptions(tz_aware=True, tzinfo=timezone.utc)
+
     def __init__(self, db):
         # Handle timezones in mongo collections.
         # See http://api.mongodb.com/python/current/examples/datetimes.html#reading-time
-        self._instances = db['task_instances'].with_options(
-            codec_options=CodecOptions(tz_aware=True, tzinfo=timezone.utc)
+        self.buckets = Buckets(
+            db, 'task_instances', self._index,
+            codec_options=self.CODEC_OPTIONS,
         )
 
+    @staticmethod
+    async def _index(collection):
+        await ensure_indexes(collection, [
+            IndexModel('id', unique=True, name='unique_id'),
+            IndexModel('workflow_instance_id', name='workflow_instance_id'),
+        ])
+
     async def index(self):
-        await check_index_names(
-            self._instances, ['unique_id', 'workflow_instance_id'],
-        )
-        await self._instances.create_index('id', unique=True, name='unique_id')
-        await self._instances.create_index(
-            'workflow_instance_id',
-            name='workflow_instance_id',
-        )
+        await self.buckets.index()
+
+    async def _find_one(self, query, filters):
+        names = await self.buckets.names()
+        tasks = await asyncio.gather(*[
+            self.buckets.collection(name).find_one(query, filters)
+            for name in names
+        ])
+        for task in tasks:
+            if task is not None:
+                return task
 
-    async def get(self, wid, full=False):
+    async def get(self, wid, full=False, date=None):
         """
-        Return all task instances of one workflow.
+        Return all task instances of one workflow, stored in the bucket
+        of `date` if given.
         """
         if full is False:
             filters = self.TASK_HISTORY_FILTERS
         else:
             filters = {'_id': 0, 'workflow_instance_id': 0}
-        cursor = self._instances.find({'workflow_instance_id': wid}, filters)
-        return await cursor.to_list(None)
+        names = await self.buckets.names(since=date, until=date)
+        tasks = await asyncio.gather(*[
+            self.buckets.collection(name).find(
+                {'workflow_instance_id': wid}, filters
+            ).to_list(None)
+            for name in names
+        ])
+        return [task for bucket in tasks for task in bucket]
+
+    async def get_many(self, wids, full=False, max_size=None, since=None,
+                       until=None):
+        """
+        Return the task instances of several workflows, by workflow id,
+        using one query per bucket between `since` and `until`.
+        Raise `PayloadTooLarge` if the tasks amount to more than `max_size`
+        bytes.
+        """
+        if full is False:
+            filters = {**self.TASK_HISTORY_FILTERS, 'workflow_instance_id': 1}
+        else:
+            # Exclusion projection, `workflow_instance_id` is returned
+            filters = {'_id': 0}
+        query = {'workflow_instance_id': {'$in': list(wids)}}
+        # Undecoded documents, to measure them before decoding
+        raw_options = self.CODEC_OPTIONS.with_options(
+            document_class=RawBSONDocument
+        )
+
+        tasks = {wid: [] for wid in wids}
+        size = 0
+        for name in await self.buckets.names(since=since, until=until):
+            collection = self.buckets.collection(name, raw_options)
+            cursor = collection.find(query, filters)
+            async for raw in cursor:
+                size += len(raw.raw)
+                if max_size is not None and size > max_size:
+                    await cursor.close()
+                    raise PayloadTooLarge(max_size)
+                task = BSON(raw.raw).decode(self.CODEC_OPTIONS)
+                tasks[task.pop('workflow_instance_id')].append(task)
+        return tasks
 
     async def get_one(self, tid, full=False):
         """
@@ -65,36 +125,46 @@ class TaskInstancesCollection:
         filters = {'_id': 0, 'workflow_instance_id': 0}
         if full is False:
             filters.update({'inputs': 0, 'outputs': 0})
-        return await self._instances.find_one({'id': tid}, filters)
+        return await self._find_one({'id': tid}, filters)
 
-    def get_for_csv(self, workflow_id):
+    async def get_for_csv(self, workflow_id, date=None):
         """
         Return the data needed for a CSV import of one workflow execution.
         To be used with `async for task in get_for_csv():`
         """
-        return self._instances.find({
-            'workflow_instance_id': workflow_id,
-            'template.name': {'$in': ['send_sms', 'call', 'send_email', 'wait_sms', 'wait_call', 'wait_email']},
-            'reporting': {'$ne': None},
-        }, {
-            'start': 1,
-            'template.id': 1,
-            'template.title': 1,
-            'template.name': 1,
-            'reporting.contacts': 1,
-        })
+        for name in await self.buckets.names(since=date, until=date):
+            cursor = self.buckets.collection(name).find({
+                'workflow_instance_id': workflow_id,
+                'template.name': {'$in': ['send_sms', 'call', 'send_email', 'wait_sms', 'wait_call', 'wait_email']},
+                'reporting': {'$ne': None},
+            }, {
+                'start': 1,
+                'template.id': 1,
+                'template.title': 1,
+                'template.name': 1,
+                'reporting.contacts': 1,
+            })
+            async for task in cursor:
+                yield task
 
     async def get_data(self, tid):
         """
         Return the data (inputs/outputs) of one executed task.
         """
-        return await self._instances.find_one(
+        return await self._find_one(
             {'id': tid},
             {'_id': 0, 'inputs': 1, 'outputs': 1},
         )
 
-    async def insert_many(self, tasks):
+    async def insert_many(self, tasks, date=None):
         """
-        Insert all the tasks of a finished workflow.
+        Insert all the tasks of finished workflows, in the bucket of the
+        workflows' `date`.
+        Tasks already inserted by a previous attempt are ignored.
         """
-        await self._instances.insert_many(tasks)
+        collection = await self.buckets.get(date)
+        try:
+            await collection.insert_many(tasks, ordered=False)
+        except BulkWriteError as exc:
+            if not only_duplicates(exc):
+                raise
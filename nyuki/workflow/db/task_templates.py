@@ -1,9 +1,9 @@
 import logging
 
-from pymongo import ASCENDING, DESCENDING, ReplaceOne
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne
 from pymongo.errors import BulkWriteError
 
-from .utils.indexes import check_index_names
+from .utils.indexes import ensure_indexes
 
 
 log = logging.getLogger(__name__)
@@ -29,19 +29,26 @@ class TaskTemplatesCollection:
         self._templates = db['task_templates']
 
     async def index(self):
-        await check_index_names(
-            self._templates, ['unique_uid_workflow_template_id_version'],
-        )
-        # Pair of indexes on the workflow template id/version
-        await self._templates.create_index(
-            [
-                ('id', ASCENDING),
-                ('workflow_template.id', ASCENDING),
-                ('workflow_template.version', DESCENDING),
-            ],
-            unique=True,
-            name='unique_uid_workflow_template_id_version'
-        )
+        await ensure_indexes(self._templates, [
+            # Pair of indexes on the workflow template id/version
+            IndexModel(
+                [
+                    ('id', ASCENDING),
+                    ('workflow_template.id', ASCENDING),
+                    ('workflow_template.version', DESCENDING),
+                ],
+                unique=True,
+                name='unique_uid_workflow_template_id_version'
+            ),
+            # Tasks of one or several workflow templates
+            IndexModel(
+                [
+                    ('workflow_template.id', ASCENDING),
+                    ('workflow_template.version', DESCENDING),
+                ],
+                name='workflow_template_id_version'
+            ),
+        ])
 
     async def get(self, workflow_id, version):
         """
@@ -59,6 +66,28 @@ class TaskTemplatesCollection:
         )
         return await cursor.to_list(None)
 
+    async def get_many(self, templates):
+        """
+        Return the task templates of several workflow templates, by
+        (<workflow id>, <version>).
+        """
+        keys = {(tmpl['id'], tmpl['version']) for tmpl in templates}
+        if not keys:
+            # An empty `$or` is rejected by Mongo
+            return {}
+        cursor = self._templates.find(
+            {'$or': [
+                {'workflow_template.id': tid, 'workflow_template.version': v}
+                for tid, v in sorted(keys)
+            ]},
+            {'_id': 0},
+        )
+        tasks = {key: [] for key in keys}
+        async for task in cursor:
+            workflow = task.pop('workflow_template')
+            tasks[(workflow['id'], workflow['version'])].append(task)
+        return tasks
+
     async def insert_many(self, tasks, template):
         """
         Update multiple tasks at once, remove the now unused tasks.
@@ -1,7 +1,8 @@
 import asyncio
 import logging
+from pymongo import IndexModel
 
-from .utils.indexes import check_index_names
+from .utils.indexes import ensure_indexes
 
 
 log = logging.getLogger(__name__)
@@ -13,8 +14,9 @@ class TriggerCollection:
         self._triggers = db['triggers']
 
     async def index(self):
-        await check_index_names(self._triggers, ['unique_tid'])
-        await self._triggers.create_index('tid', unique=True, name='unique_tid')
+        await ensure_indexes(self._triggers, [
+            IndexModel('tid', unique=True, name='unique_tid'),
+        ])
 
     async def get(self):
         """
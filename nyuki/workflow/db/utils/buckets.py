@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import re
+import time
+from datetime import datetime, timezone
+
+
+log = logging.getLogger(__name__)
+
+
+def month(date=None):
+    """
+    First instant of the month of `date` (UTC), the current one by default.
+    """
+    if date is None:
+        date = datetime.now(timezone.utc)
+    elif date.tzinfo is not None:
+        date = date.astimezone(timezone.utc)
+    return datetime(date.year, date.month, 1, tzinfo=timezone.utc)
+
+
+def months_before(date, count):
+    """
+    First instant of the month `count` months before the month of `date`.
+    """
+    date = month(date)
+    index = date.year * 12 + date.month - 1 - count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def history_date(workflow):
+    """
+    Date routing a workflow instance, and its tasks, to a history bucket.
+    """
+    return workflow.get('start') or workflow.get('end')
+
+
+def date_range(workflows):
+    """
+    Range of the history dates of several workflow instances, unbounded if
+    any of them has no date.
+    """
+    dates = [history_date(workflow) for workflow in workflows]
+    if not dates or None in dates:
+        return None, None
+    return min(dates), max(dates)
+
+
+class Buckets:
+
+    """
+    Monthly collections `<name>_<YYYYMM>` of a time-partitioned collection.
+    The collection `<name>` holds the documents stored before the
+    partitioning, it is read along with every range of buckets.
+    """
+
+    # Refresh period of the list of existing buckets, the bucket of the
+    # current month is always read
+    LIST_TTL = 60.0
+
+    def __init__(self, db, name, indexer, codec_options=None):
+        self._db = db
+        self._name = name
+        self.unpartitioned = name
+        # Coroutine function creating the indexes of a bucket
+        self._indexer = indexer
+        self._codec_options = codec_options
+        self._pattern = re.compile(r'^{}_(\d{{4}})(\d{{2}})$'.format(
+            re.escape(name)
+        ))
+        self._existing = set()
+        self._listed = None
+        # Buckets indexed by this process
+        self._indexed = set()
+
+    def name(self, date=None):
+        return '{}_{:%Y%m}'.format(self._name, month(date))
+
+    def month(self, name):
+        """
+        Month of a bucket, None for the unpartitioned collection.
+        """
+        match = self._pattern.match(name)
+        if match is None:
+            return None
+        year, number = match.groups()
+        return datetime(int(year), int(number), 1, tzinfo=timezone.utc)
+
+    def collection(self, name, codec_options=None):
+        return self._db[name].with_options(
+            codec_options=codec_options or self._codec_options
+        )
+
+    async def _list(self, force=False):
+        now = time.monotonic()
+        if not force and self._listed and now - self._listed < self.LIST_TTL:
+            return
+        pattern = r'^{}(_\d{{6}})?$'.format(re.escape(self._name))
+        names = await self._db.list_collection_names(
+            filter={'name': {'$regex': pattern}}
+        )
+        self._existing = set(names)
+        self._listed = now
+
+    async def names(self, since=None, until=None):
+        """
+        Return the names of the buckets overlapping the months of `since`
+        and `until`, newest first, then the unpartitioned collection.
+        """
+        await self._list()
+        names = self._existing | {self.name()}
+        since = month(since) if since is not None else None
+        until = month(until) if until is not None else None
+        buckets = []
+        for name in names:
+            date = self.month(name)
+            if date is None:
+                continue
+            if since is not None and date < since:
+                continue
+            if until is not None and date > until:
+                continue
+            buckets.append(name)
+        buckets.sort(reverse=True)
+        if self._name in names:
+            buckets.append(self._name)
+        return buckets
+
+    async def get(self, date=None):
+        """
+        Return the bucket of `date`, indexed before its first use.
+        """
+        name = self.name(date)
+        collection = self.collection(name)
+        if name not in self._indexed:
+            await self._indexer(collection)
+            self._indexed.add(name)
+            self._existing.add(name)
+        return collection
+
+    async def index(self):
+        """
+        Index all the existing buckets.
+        """
+        await self._list(force=True)
+        await asyncio.gather(*[
+            self._indexer(self.collection(name)) for name in self._existing
+        ])
+        self._indexed.update(self._existing)
+
+    async def drop(self, name):
+        await self._db.drop_collection(name)
+        self._existing.discard(name)
+        self._indexed.discard(name)
+
+    async def drop_before(self, date):
+        """
+        Drop the buckets of the months before the month of `date`.
+        """
+        await self._list(force=True)
+        dropped = []
+        for name in sorted(self._existing):
+            bucket = self.month(name)
+            if bucket is None or bucket >= month(date):
+                continue
+            await self.drop(name)
+            dropped.append(name)
+        if dropped:
+            log.info("Dropped history buckets: %s", ', '.join(dropped))
+        return dropped
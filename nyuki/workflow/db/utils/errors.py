@@ -0,0 +1,27 @@
+DUPLICATE_KEY_ERROR = 11000
+
+
+class PayloadTooLarge(Exception):
+
+    """
+    A query returned more data than allowed.
+    """
+
+    def __init__(self, max_size):
+        super().__init__('Payload larger than {} bytes'.format(max_size))
+        self.max_size = max_size
+
+
+def only_duplicates(bulk_error):
+    """
+    Return True if a `BulkWriteError` only failed on already inserted
+    documents (e.g. when retrying an unordered bulk insert).
+    """
+    details = bulk_error.details
+    return (
+        not details.get('writeConcernErrors') and
+        all(
+            error['code'] == DUPLICATE_KEY_ERROR
+            for error in details.get('writeErrors', [])
+        )
+    )
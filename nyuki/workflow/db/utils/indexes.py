@@ -4,11 +4,52 @@ import logging
 log = logging.getLogger(__name__)
 
 
-async def check_index_names(collection, names):
-    # Add the default index on '_id'
-    names.append('_id_')
+def _same_collation(collation, expected):
+    """
+    The server fills in the default values of the options not given.
+    """
+    if not expected:
+        return not collation or collation.get('locale') == 'simple'
+    return collation is not None and all(
+        collation.get(key) == value for key, value in expected.items()
+    )
+
+
+def _same_index(index, expected):
+    return (
+        list(index['key'].items()) == list(expected['key'].items()) and
+        bool(index.get('unique')) == bool(expected.get('unique')) and
+        bool(index.get('sparse')) == bool(expected.get('sparse')) and
+        index.get('partialFilterExpression') ==
+        expected.get('partialFilterExpression') and
+        index.get('expireAfterSeconds') ==
+        expected.get('expireAfterSeconds') and
+        _same_collation(index.get('collation'), expected.get('collation'))
+    )
+
+
+async def ensure_indexes(collection, indexes):
+    """
+    Create the missing `indexes` (`IndexModel` list) of a collection in one
+    command, existing ones with the same spec are kept. All the indexes are
+    rebuilt if an unknown or different one is found.
+    """
+    expected = {index.document['name']: index.document for index in indexes}
+    existing = set()
     async for index in collection.list_indexes():
-        if index['name'] not in names:
+        # Default index on '_id'
+        if index['name'] == '_id_':
+            continue
+        if index['name'] not in expected or \
+                not _same_index(index, expected[index['name']]):
             log.warning(f"Bad index found in '{collection.name}', rebuilding")
             await collection.drop_indexes()
+            existing = set()
             break
+        existing.add(index['name'])
+
+    missing = [
+        index for index in indexes if index.document['name'] not in existing
+    ]
+    if missing:
+        await collection.create_indexes(missing)
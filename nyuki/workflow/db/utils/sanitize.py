@@ -0,0 +1,144 @@
+from datetime import datetime
+from pymongo.errors import DocumentTooLarge
+
+
+# Sizes of the BSON encoded fixed-size values
+_FIXED_SIZES = {float: 8, bool: 1, type(None): 0, datetime: 8}
+_SCALARS = {str, int, *_FIXED_SIZES}
+_CONTAINERS = (dict, list, tuple)
+# Marks the end of a container in the traversal stack
+_EXIT = object()
+
+
+def internal_data(obj):
+    return 'Internal server data: {}'.format(type(obj))
+
+
+def _replacement(item, ancestors):
+    """
+    Return the string replacing a non-scalar item, or None for containers
+    that must be traversed.
+    """
+    if type(item) not in _CONTAINERS:
+        return internal_data(item)
+    if id(item) in ancestors:
+        return 'Circular reference: {}'.format(type(item))
+    return None
+
+
+def _index_keys_size(length):
+    """
+    BSON size of the keys ('0', '1'...) of an array of `length` items.
+    """
+    size = 0
+    digits, lower = 1, 0
+    while lower < length:
+        upper = min(length, 10 ** digits)
+        size += (upper - lower) * digits
+        digits, lower = digits + 1, upper
+    return size
+
+
+def _items_size(values):
+    """
+    BSON size of the values of a container, with their type bytes.
+    Nested containers only count for their own length and null byte.
+    """
+    size = len(values)
+    strings = []
+    for item in values:
+        kind = type(item)
+        if kind is str:
+            strings.append(item)
+        elif kind is int:
+            size += 4 if -2 ** 31 <= item < 2 ** 31 else 8
+        elif kind in _FIXED_SIZES:
+            size += _FIXED_SIZES[kind]
+        else:
+            size += 5
+    # Length and null byte of each string
+    size += 5 * len(strings) + len(''.join(strings).encode('utf-8'))
+    return size
+
+
+def _check_size(size, max_size):
+    if size > max_size:
+        raise DocumentTooLarge(
+            'BSON document too large ({} bytes), the maximum is {}'.format(
+                size, max_size
+            )
+        )
+
+
+def sanitize_workflow_exec(obj, max_size=None):
+    """
+    Return a copy of `obj` that can be stored in Mongo, the input is never
+    modified. Unknown objects are replaced by an 'internal data' string,
+    dict keys are converted to strings, tuples to lists, and circular
+    references are cut.
+    If `max_size` is set, raise `DocumentTooLarge` when the BSON encoded
+    document would be bigger (in bytes).
+    """
+    if type(obj) in _SCALARS:
+        return obj
+    if type(obj) not in _CONTAINERS:
+        return internal_data(obj)
+    if max_size is not None and type(obj) is not dict:
+        raise TypeError('only documents (dicts) can be size-checked')
+
+    root = [None]
+    # Length and trailing null byte of the document
+    size = 5
+    ancestors = set()
+    # (<source container>, <target container>, <key in the target container>)
+    stack = [(obj, root, 0)]
+
+    scalars = _SCALARS
+    push = stack.append
+    while stack:
+        value, target, key = stack.pop()
+        if value is _EXIT:
+            ancestors.discard(key)
+            continue
+
+        ancestors.add(id(value))
+        push((_EXIT, None, id(value)))
+        # Containers are copied and their unsafe values replaced, nested
+        # containers are filled in later (which keeps the order of the keys)
+        if type(value) is dict:
+            if all(type(item_key) is str for item_key in value):
+                copy = dict(value)
+            else:
+                copy = {
+                    (item_key if type(item_key) is str else str(item_key)): item
+                    for item_key, item in value.items()
+                }
+            for item_key, item in copy.items():
+                if type(item) not in scalars:
+                    replacement = _replacement(item, ancestors)
+                    if replacement is None:
+                        push((item, copy, item_key))
+                    else:
+                        copy[item_key] = replacement
+        else:
+            copy = list(value)
+            for index, item in enumerate(copy):
+                if type(item) not in scalars:
+                    replacement = _replacement(item, ancestors)
+                    if replacement is None:
+                        push((item, copy, index))
+                    else:
+                        copy[index] = replacement
+        target[key] = copy
+
+        if max_size is not None:
+            # Keys with their null byte, then values
+            if type(copy) is dict:
+                size += len(copy) + len(''.join(copy).encode('utf-8'))
+                size += _items_size(list(copy.values()))
+            else:
+                size += len(copy) + _index_keys_size(len(copy))
+                size += _items_size(copy)
+            _check_size(size, max_size)
+
+    return root[0]
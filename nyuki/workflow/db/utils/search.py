@@ -0,0 +1,51 @@
+import re
+
+
+# Longest indexed n-grams
+GRAM_SIZE = 3
+# Indexed characters of a text
+MAX_LENGTH = 256
+
+
+def normalize(text):
+    """
+    Case-insensitive form of a text, with single spaces.
+    """
+    return ' '.join(text.casefold().split())
+
+
+def ngrams(text, size=GRAM_SIZE):
+    """
+    Return the distinct substrings of `text` of length 1 to `size`.
+    """
+    text = normalize(text or '')[:MAX_LENGTH]
+    grams = set()
+    for length in range(1, size + 1):
+        for start in range(len(text) - length + 1):
+            grams.add(text[start:start + length])
+    return sorted(grams)
+
+
+def search_query(field, grams_field, text):
+    """
+    Return the query of the documents whose `field` contains `text`,
+    case-insensitive. Texts of up to `GRAM_SIZE` characters are found
+    with the index of `grams_field` alone, longer ones are found with the
+    index then checked with an escaped regex.
+    """
+    text = normalize(text)
+    if not text:
+        return {}
+    if len(text) <= GRAM_SIZE:
+        return {grams_field: text}
+
+    grams = []
+    for start in range(len(text) - GRAM_SIZE + 1):
+        gram = text[start:start + GRAM_SIZE]
+        if gram not in grams:
+            grams.append(gram)
+    pattern = r'\s+'.join(re.escape(word) for word in text.split(' '))
+    return {
+        grams_field: {'$all': grams},
+        field: {'$regex': pattern, '$options': 'i'},
+    }
@@ -1,13 +1,21 @@
 import re
+import time
+import heapq
 import asyncio
 import logging
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from enum import Enum
 from datetime import datetime, timezone
 
+from bson import json_util
 from bson.codec_options import CodecOptions
-from pymongo import DESCENDING, ASCENDING
+from pymongo import DESCENDING, ASCENDING, IndexModel
+from pymongo.errors import BulkWriteError
 
-from .utils.indexes import check_index_names
+from .utils.buckets import Buckets, history_date, month
+from .utils.errors import only_duplicates
+from .utils.indexes import ensure_indexes
+from .utils.search import ngrams, search_query
 
 
 log = logging.getLogger(__name__)
@@ -27,81 +35,293 @@ class Ordering(Enum):
         return [key for key in cls.__members__.keys()]
 
 
+class InvalidPageToken(ValueError):
+    pass
+
+
+class PageToken:
+
+    """
+    Opaque position in the history, after the last instance of a page:
+    its value of the sort field and its id.
+    """
+
+    @staticmethod
+    def _value(workflow, field):
+        value = workflow
+        for key in field.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        return value
+
+    @classmethod
+    def dump(cls, workflow, field, direction):
+        token = json_util.dumps({
+            'field': field,
+            'direction': direction,
+            'value': cls._value(workflow, field),
+            'id': workflow['id'],
+        })
+        return urlsafe_b64encode(token.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def load(token):
+        try:
+            token = urlsafe_b64decode(token + '=' * (-len(token) % 4))
+            token = json_util.loads(token.decode())
+            return (
+                token['field'], token['direction'], token['value'], token['id']
+            )
+        except (ValueError, TypeError, KeyError) as exc:
+            raise InvalidPageToken('Invalid page token') from exc
+
+    @classmethod
+    def query(cls, token, field, direction):
+        """
+        Return the query of the instances following `token`, sorted on
+        `field` then on the instance id.
+        """
+        tfield, tdirection, value, wid = cls.load(token)
+        if (tfield, tdirection) != (field, direction):
+            raise InvalidPageToken('Page token of another ordering')
+        operator = '$gt' if direction == ASCENDING else '$lt'
+        if value is None:
+            # Mongo sorts null values first, and `$gt: null` matches nothing
+            if direction == ASCENDING:
+                return {'$or': [
+                    {field: {'$ne': None}},
+                    {field: None, 'id': {'$gt': wid}},
+                ]}
+            return {field: None, 'id': {'$lt': wid}}
+        return {'$or': [
+            {field: {operator: value}},
+            {field: value, 'id': {operator: wid}},
+        ]}
+
+
 class WorkflowInstancesCollection:
 
+    """
+    Finished workflow instances, with the n-grams of their template title
+    (`title_grams`) for the search.
+    Instances are stored in monthly buckets, by start date. A page is read
+    from the buckets overlapping its range of dates only, then merged.
+    """
+
     REQUESTER_REGEX = re.compile(r'^nyuki://.*')
+    FILTERS = {'_id': 0, 'title_grams': 0}
+    # Cache of the filtered counts
+    COUNT_TTL = 10.0
+    MAX_COUNTS = 1000
 
     def __init__(self, db):
         # Handle timezones in mongo collections.
         # See http://api.mongodb.com/python/current/examples/datetimes.html#reading-time
-        self._instances = db['workflow_instances'].with_options(
-            codec_options=CodecOptions(tz_aware=True, tzinfo=timezone.utc)
+        self.buckets = Buckets(
+            db, 'workflow_instances', self._index,
+            codec_options=CodecOptions(tz_aware=True, tzinfo=timezone.utc),
         )
+        # {<query>: (<count>, <expiration time>)}
+        self._counts = {}
 
-    async def index(self):
-        await check_index_names(self._instances, [
-            'unique_id', 'state', 'requester', 'template_title',
-            'sort_start', 'sort_end',
+    @staticmethod
+    async def _index(collection):
+        await ensure_indexes(collection, [
+            # Workflow
+            IndexModel('id', unique=True, name='unique_id'),
+            IndexModel('state', name='state'),
+            IndexModel('requester', name='requester'),
+            # Search and sorting indexes, the instance id breaks the ties of
+            # the pagination
+            IndexModel(
+                [('template.title', ASCENDING), ('id', ASCENDING)],
+                name='sort_title_id',
+            ),
+            IndexModel(
+                [('start', DESCENDING), ('id', DESCENDING)],
+                name='sort_start_id',
+            ),
+            IndexModel(
+                [('end', DESCENDING), ('id', DESCENDING)], name='sort_end_id'
+            ),
+            IndexModel('title_grams', name='title_grams'),
         ])
-        # Workflow
-        await self._instances.create_index('id', unique=True, name='unique_id')
-        await self._instances.create_index('state', name='state')
-        await self._instances.create_index('requester', name='requester')
-        # Search and sorting indexes
-        await self._instances.create_index(
-            'template.title', name='template_title'
-        )
-        await self._instances.create_index(
-            [('start', DESCENDING)], name='sort_start'
-        )
-        await self._instances.create_index(
-            [('end', DESCENDING)], name='sort_end'
-        )
+
+    async def index(self):
+        await self.buckets.index()
 
     async def get_one(self, instance_id, full=False):
         """
         Return the instance with `instance_id` from workflow history.
         """
-        return await self._instances.find_one({'id': instance_id}, {'_id': 0})
+        names = await self.buckets.names()
+        workflows = await asyncio.gather(*[
+            self.buckets.collection(name).find_one(
+                {'id': instance_id}, self.FILTERS
+            )
+            for name in names
+        ])
+        for workflow in workflows:
+            if workflow is not None:
+                return workflow
+
+    async def _count(self, query, names):
+        if not query:
+            counts = [
+                self.buckets.collection(name).estimated_document_count()
+                for name in names
+            ]
+        else:
+            counts = [
+                self.buckets.collection(name).count_documents(query)
+                for name in names
+            ]
+        return sum(await asyncio.gather(*counts))
+
+    async def count(self, query, since=None):
+        """
+        Count the instances matching `query` in the buckets from the month
+        of `since`, cached for `COUNT_TTL` seconds. Whole buckets are
+        counted from their metadata.
+        """
+        names = await self.buckets.names(since=since)
+        if not query:
+            return await self._count(query, names)
+
+        key = json_util.dumps(query, sort_keys=True)
+        now = time.monotonic()
+        try:
+            count, expires = self._counts[key]
+        except KeyError:
+            pass
+        else:
+            if expires > now:
+                return count
+
+        count = await self._count(query, names)
+        if len(self._counts) >= self.MAX_COUNTS:
+            self._counts = {
+                key: value
+                for key, value in self._counts.items()
+                if value[1] > now
+            }
+        self._counts[key] = (count, now + self.COUNT_TTL)
+        return count
+
+    @staticmethod
+    def _until(field, direction, after):
+        """
+        Latest start date of the instances following the token `after`,
+        instances end after they start.
+        """
+        if after is None or direction != DESCENDING:
+            return None
+        if field not in ('start', 'end'):
+            return None
+        _, _, value, _ = PageToken.load(after)
+        return value if isinstance(value, datetime) else None
+
+    async def _find(self, name, query, field, direction, limit):
+        cursor = self.buckets.collection(name).find(query, self.FILTERS)
+        cursor.sort([(field, direction), ('id', direction)])
+        if limit is not None:
+            cursor.limit(limit)
+        return await cursor.to_list(None)
 
     async def get(self, root=False, full=False, offset=None, limit=None,
-                  since=None, state=None, search=None, order=None):
+                  since=None, state=None, search=None, order=None,
+                  after=None):
         """
-        Return all instances from history from `since` with state `state`.
+        Return all instances from history from `since` with state `state`,
+        their count and the token of the next page.
+        Pages are read from the token `after` of the previous one, or
+        skipping `offset` instances.
         """
         query = {}
         # Prepare query
         if isinstance(since, datetime):
             query['start'] = {'$gte': since}
+        else:
+            since = None
         if isinstance(state, Enum):
             query['state'] = state.value
         if root is True:
             query['requester'] = {'$not': self.REQUESTER_REGEX}
         if search:
-            query['template.title'] = {'$regex': '.*{}.*'.format(search)}
+            query.update(search_query('template.title', 'title_grams', search))
 
-        cursor = self._instances.find(query, {'_id': 0})
-        # Count total results regardless of limit/offset
-        count = await self._instances.count_documents({})
+        # End descending by default
+        field, direction = order or Ordering.end_desc.value
+        page = query
+        if after is not None:
+            page = {'$and': [query, PageToken.query(after, field, direction)]}
+        names = await self.buckets.names(
+            since=since, until=self._until(field, direction, after),
+        )
 
-        # Sort depending on Order enum values
-        if order is not None:
-            cursor.sort(*order)
-        else:
-            # End descending by default
-            cursor.sort(*Ordering.end_desc.value)
+        # Set offset and limit, each bucket returns a whole page
+        if after is not None or not isinstance(offset, int) or offset < 0:
+            offset = 0
+        if not isinstance(limit, int) or limit <= 0:
+            limit = None
+        size = offset + limit if limit is not None else None
 
-        # Set offset and limit
-        if isinstance(offset, int) and offset >= 0:
-            cursor.skip(offset)
-        if isinstance(limit, int) and limit > 0:
-            cursor.limit(limit)
+        # Execute query, count total results regardless of limit/offset
+        count, *pages = await asyncio.gather(
+            self.count(query, since),
+            *[
+                self._find(name, page, field, direction, size)
+                for name in names
+            ]
+        )
+
+        # Sort depending on Order enum values, mongo sorts null values first
+        def key(workflow):
+            value = PageToken._value(workflow, field)
+            return (value is not None, value, workflow['id'])
+
+        workflows = list(heapq.merge(
+            *pages, key=key, reverse=direction == DESCENDING,
+        ))
+        stop = offset + limit if limit is not None else None
+        workflows = workflows[offset:stop]
+        next_page = None
+        if workflows and limit is not None and len(workflows) == limit:
+            next_page = PageToken.dump(workflows[-1], field, direction)
+        return count, workflows, next_page
 
-        # Execute query
-        return count, await cursor.to_list(None)
+    @staticmethod
+    def _document(workflow):
+        return {
+            **workflow,
+            'title_grams': ngrams(workflow['template'].get('title')),
+        }
 
     async def insert(self, workflow):
         """
         Insert a finished workflow report into the workflow history.
         """
-        await self._instances.insert_one(workflow)
+        collection = await self.buckets.get(history_date(workflow))
+        await collection.insert_one(self._document(workflow))
+
+    async def _insert_many(self, date, workflows):
+        collection = await self.buckets.get(date)
+        try:
+            await collection.insert_many(workflows, ordered=False)
+        except BulkWriteError as exc:
+            if not only_duplicates(exc):
+                raise
+
+    async def insert_many(self, workflows):
+        """
+        Insert finished workflow reports into the workflow history, in the
+        bucket of their month.
+        Reports already inserted by a previous attempt are ignored.
+        """
+        buckets = {}
+        for workflow in workflows:
+            date = month(history_date(workflow))
+            buckets.setdefault(date, []).append(self._document(workflow))
+        await asyncio.gather(*[
+            self._insert_many(date, documents)
+            for date, documents in buckets.items()
+        ])
@@ -2,9 +2,9 @@ import asyncio
 import logging
 from enum import Enum
 
-from pymongo import DESCENDING
+from pymongo import DESCENDING, IndexModel
 
-from .utils.indexes import check_index_names
+from .utils.indexes import ensure_indexes
 
 
 log = logging.getLogger(__name__)
@@ -48,19 +48,18 @@ class WorkflowTemplatesCollection:
         self._templates = db['workflow_templates']
 
     async def index(self):
-        await check_index_names(self._templates, [
-            'topics', 'unique_id_version', 'id_state',
+        await ensure_indexes(self._templates, [
+            IndexModel('topics', name='topics'),
+            IndexModel(
+                [('id', DESCENDING), ('version', DESCENDING)],
+                unique=True,
+                name='unique_id_version',
+            ),
+            IndexModel(
+                [('id', DESCENDING), ('state', DESCENDING)],
+                name='id_state',
+            ),
         ])
-        await self._templates.create_index('topics', name='topics')
-        await self._templates.create_index(
-            [('id', DESCENDING), ('version', DESCENDING)],
-            unique=True,
-            name='unique_id_version',
-        )
-        await self._templates.create_index(
-            [('id', DESCENDING), ('state', DESCENDING)],
-            name='id_state',
-        )
 
     async def get(self, template_id=None, full=False):
         """
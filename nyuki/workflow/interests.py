@@ -0,0 +1,140 @@
+import heapq
+import logging
+import time
+from collections import Counter
+from uuid import uuid4
+
+
+log = logging.getLogger(__name__)
+
+
+class LeaseNotFound(Exception):
+    pass
+
+
+class InterestRegistry:
+
+    """
+    Keep track of the workflow instances and templates watched by the
+    clients. Interests are declared through leases that expire unless they
+    are renewed. Disabled by default: every instance is then watched, as
+    expected by the clients not using leases.
+    """
+
+    LEASE_TTL = 60.0
+    MAX_LEASE_TTL = 3600.0
+
+    def __init__(self):
+        self._enabled = False
+        self._default_ttl = self.LEASE_TTL
+        # {<lease id>: {'instances': set, 'templates': set, 'expires': float}}
+        self._leases = {}
+        # Heap of (<expiration time>, <lease id>), renewals push new entries
+        self._expirations = []
+        self._instances = Counter()
+        self._templates = Counter()
+
+    def configure(self, enabled=False, lease_ttl=LEASE_TTL):
+        self._enabled = enabled
+        self._default_ttl = lease_ttl
+
+    def watch(self, instances=None, templates=None, ttl=None, lease_id=None,
+              create=False):
+        """
+        Create a lease on the given instance and template ids, or renew and
+        replace the lease `lease_id` (created if `create` is set).
+        """
+        if lease_id is not None:
+            if lease_id in self._leases:
+                self._drop(lease_id)
+            elif not create:
+                raise LeaseNotFound(lease_id)
+        else:
+            lease_id = str(uuid4())
+
+        ttl = min(ttl or self._default_ttl, self.MAX_LEASE_TTL)
+        lease = {
+            'instances': set(instances or []),
+            'templates': set(templates or []),
+            'expires': time.time() + ttl,
+        }
+        self._leases[lease_id] = lease
+        self._instances.update(lease['instances'])
+        self._templates.update(lease['templates'])
+        heapq.heappush(self._expirations, (lease['expires'], lease_id))
+        return self._lease_dict(lease_id, lease)
+
+    def renew(self, lease_id, ttl=None):
+        """
+        Extend the lease `lease_id`, keeping its interests.
+        """
+        try:
+            lease = self._leases[lease_id]
+        except KeyError:
+            raise LeaseNotFound(lease_id)
+        return self.watch(
+            lease['instances'], lease['templates'], ttl, lease_id
+        )
+
+    def cancel(self, lease_id):
+        if lease_id not in self._leases:
+            raise LeaseNotFound(lease_id)
+        self._drop(lease_id)
+
+    def get(self, lease_id):
+        self._purge()
+        try:
+            return self._lease_dict(lease_id, self._leases[lease_id])
+        except KeyError:
+            raise LeaseNotFound(lease_id)
+
+    def _drop(self, lease_id):
+        lease = self._leases.pop(lease_id)
+        for counter, keys in (
+            (self._instances, lease['instances']),
+            (self._templates, lease['templates']),
+        ):
+            for key in keys:
+                counter[key] -= 1
+                if counter[key] <= 0:
+                    del counter[key]
+
+    def _purge(self):
+        now = time.time()
+        while self._expirations and self._expirations[0][0] <= now:
+            expires, lease_id = heapq.heappop(self._expirations)
+            lease = self._leases.get(lease_id)
+            # Skip the outdated entries of renewed leases
+            if lease is not None and lease['expires'] == expires:
+                log.debug('Lease %s expired', lease_id)
+                self._drop(lease_id)
+
+    def watched(self, instance_id, template_id):
+        """
+        Return True if a client watches this instance or its template.
+        """
+        if not self._enabled:
+            return True
+        self._purge()
+        return instance_id in self._instances or template_id in self._templates
+
+    @staticmethod
+    def _lease_dict(lease_id, lease):
+        return {
+            'id': lease_id,
+            'instances': sorted(lease['instances']),
+            'templates': sorted(lease['templates']),
+            'expires': lease['expires'],
+        }
+
+    def stats(self):
+        self._purge()
+        return {
+            'enabled': self._enabled,
+            'leases': [
+                self._lease_dict(lease_id, lease)
+                for lease_id, lease in self._leases.items()
+            ],
+            'instances': len(self._instances),
+            'templates': len(self._templates),
+        }
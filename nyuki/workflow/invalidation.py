@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from pymongo.errors import AutoReconnect, ServerSelectionTimeoutError
+
+
+log = logging.getLogger(__name__)
+
+
+class CacheInvalidation:
+
+    """
+    Keep the in-memory caches of several nyuki replicas consistent.
+    Each modification publishes a versioned invalidation event on a reserved
+    bus topic shared by all the replicas of this service, which evict the
+    matching cache entries. The last version of each cache kind is also
+    stored in Mongo and checked periodically, so that a lost message never
+    leaves a cache stale for longer than one check interval.
+    """
+
+    CHECK_INTERVAL = 30.0
+
+    def __init__(self, nyuki):
+        self._nyuki = nyuki
+        self._handlers = {}
+        self._versions = {}
+        self._interval = self.CHECK_INTERVAL
+        self._check_future = None
+
+    @property
+    def topic(self):
+        return '{}/cache'.format(self._nyuki.bus.name)
+
+    def configure(self, check_interval=CHECK_INTERVAL):
+        self._interval = check_interval
+
+    def register(self, kind, handler):
+        """
+        Register a callback or coroutine `handler(key)` evicting an entry
+        from a cache kind (`key` is None to flush the whole cache).
+        """
+        self._handlers.setdefault(kind, []).append(handler)
+
+    async def start(self):
+        try:
+            self._versions = await self._nyuki.storage.cache_versions.get()
+        except (AutoReconnect, ServerSelectionTimeoutError) as exc:
+            log.error('Could not fetch cache versions: %s', exc)
+        await self._nyuki.bus.subscribe(self.topic, self._received)
+        self._check_future = asyncio.ensure_future(self._check_versions())
+
+    async def stop(self):
+        if self._check_future:
+            self._check_future.cancel()
+            self._check_future = None
+        # Only drops the local callback once the bus is stopped
+        await self._nyuki.bus.unsubscribe(self.topic, self._received)
+
+    async def invalidate(self, kind, key=None):
+        """
+        Notify the other replicas that an entry (or all entries if `key` is
+        None) of a cache kind is outdated. Local caches are expected to have
+        been updated by the caller.
+        """
+        try:
+            version = await self._nyuki.storage.cache_versions.bump(kind)
+        except AutoReconnect as exc:
+            # The periodic check will not notice this one, still notify
+            log.error("Could not bump version of cache '%s': %s", kind, exc)
+            version = None
+        else:
+            self._versions[kind] = max(self._versions.get(kind, 0), version)
+
+        await self._nyuki.bus.publish({
+            'origin': self._nyuki.id,
+            'kind': kind,
+            'key': key,
+            'version': version,
+        }, self.topic)
+
+    async def _evict(self, kind, key):
+        for handler in self._handlers.get(kind, []):
+            try:
+                result = handler(key)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as exc:
+                log.error("Failed to evict '%s' from cache '%s'", key, kind)
+                log.exception(exc)
+
+    async def _received(self, topic, data):
+        if data.get('origin') == self._nyuki.id:
+            return
+
+        kind = data['kind']
+        key = data.get('key')
+        version = data.get('version')
+        if version is not None:
+            seen = self._versions.get(kind, 0)
+            self._versions[kind] = max(seen, version)
+            if version > seen + 1:
+                # At least one invalidation was missed
+                log.warning("Missed invalidations of cache '%s'", kind)
+                key = None
+
+        log.debug("Evicting '%s' from cache '%s'", key, kind)
+        await self._evict(kind, key)
+
+    async def _check_versions(self):
+        """
+        Flush the caches whose cluster-wide version is ahead of ours.
+        """
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                versions = await self._nyuki.storage.cache_versions.get()
+            except AutoReconnect as exc:
+                log.error('Could not check cache versions: %s', exc)
+                continue
+
+            for kind, version in versions.items():
+                if version > self._versions.get(kind, 0):
+                    log.warning("Cache '%s' is outdated, flushing", kind)
+                    self._versions[kind] = version
+                    await self._evict(kind, None)
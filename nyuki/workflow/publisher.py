@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+class ExecPublisher:
+
+    """
+    Publish the workflow exec updates to the websocket topics.
+    Progress updates are held for `flush_interval` seconds and the
+    consecutive updates of a same topic are merged into one message.
+    Any other update of an instance is published immediately, right after
+    the progress updates it holds, so that they keep their order: the
+    sends of an instance are serialized.
+    """
+
+    FLUSH_INTERVAL = 0.5
+
+    def __init__(self, bus):
+        self._bus = bus
+        self._interval = self.FLUSH_INTERVAL
+        # {<instance id>: OrderedDict({<topic>: <payload>})}
+        self._pending = {}
+        # {<instance id>: (<asyncio.Lock>, <users>)}
+        self._locks = {}
+        self._handle = None
+        self._stats = {'published': 0, 'coalesced': 0}
+
+    def configure(self, flush_interval=FLUSH_INTERVAL):
+        self._interval = flush_interval
+
+    async def publish(self, instance_id, topic, payload):
+        """
+        Publish an update, after the progress updates held for its instance.
+        """
+        await self._flush(instance_id, (topic, payload))
+
+    async def progress(self, instance_id, topic, payload):
+        """
+        Hold a progress update, merging it with the pending one of its topic.
+        """
+        if not self._interval:
+            await self._send(topic, payload)
+            return
+
+        topics = self._pending.setdefault(instance_id, OrderedDict())
+        previous = topics.get(topic)
+        if previous is None:
+            topics[topic] = payload
+        else:
+            self._stats['coalesced'] += 1
+            topics[topic] = self._merge(previous, payload)
+
+        if self._handle is None:
+            self._handle = asyncio.get_event_loop().call_later(
+                self._interval, self._flush_later
+            )
+
+    @staticmethod
+    def _merge(previous, payload):
+        """
+        Keep the latest payload, with the data keys of the previous one it
+        does not update.
+        """
+        data = payload.get('data')
+        if isinstance(data, dict) and isinstance(previous.get('data'), dict):
+            payload = {**payload, 'data': {**previous['data'], **data}}
+        return payload
+
+    def _flush_later(self):
+        self._handle = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """
+        Publish all the held progress updates.
+        """
+        for instance_id in list(self._pending):
+            await self._flush(instance_id)
+
+    async def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        await self.flush()
+
+    async def _flush(self, instance_id, update=None):
+        """
+        Publish the progress updates held for an instance, then `update`
+        (<topic>, <payload>) if given.
+        """
+        lock, users = self._locks.get(instance_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[instance_id] = (lock, users + 1)
+        try:
+            async with lock:
+                topics = self._pending.pop(instance_id, None) or {}
+                for topic, payload in topics.items():
+                    await self._send(topic, payload)
+                if update is not None:
+                    await self._send(*update)
+        finally:
+            lock, users = self._locks.pop(instance_id)
+            if users > 1:
+                self._locks[instance_id] = (lock, users - 1)
+
+    async def _send(self, topic, payload):
+        self._stats['published'] += 1
+        await self._bus.publish(payload, 'websocket/{}'.format(topic))
+
+    def stats(self):
+        return {
+            'flush_interval': self._interval,
+            'pending': sum(len(topics) for topics in self._pending.values()),
+            'published': self._stats['published'],
+            'coalesced': self._stats['coalesced'],
+        }
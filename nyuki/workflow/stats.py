@@ -0,0 +1,233 @@
+import bisect
+from collections import Counter
+from tukio.task.factory import TaskExecState
+
+
+class Histogram:
+
+    """
+    Fixed-bucket histogram of durations, in seconds.
+    """
+
+    BUCKETS = (
+        0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 3600,
+    )
+
+    __slots__ = ('_counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        # One more bucket for the values above the last bound
+        self._counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self._counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram._counts = [bucket['count'] for bucket in data['buckets']]
+        histogram.count = data['count']
+        histogram.total = data['sum']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
+
+    def update(self, other):
+        """
+        Add the values of another histogram.
+        """
+        self._counts = [a + b for a, b in zip(self._counts, other._counts)]
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, point):
+        """
+        Upper bound of the bucket holding the given percentile.
+        """
+        if not self.count:
+            return None
+        rank = self.count * point / 100
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank and count:
+                if index == len(self.BUCKETS):
+                    return self.max
+                return min(self.BUCKETS[index], self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': [
+                {'le': bound, 'count': count}
+                for bound, count in zip(
+                    self.BUCKETS + ('+inf',), self._counts
+                )
+            ],
+        }
+
+
+class TaskTimings:
+
+    """
+    Execution timings of the workflow tasks, per task name and per workflow
+    template, built from the tukio exec events:
+    - queue: from the end of the upstream task (or the workflow start) to
+      the task start,
+    - duration: from the task start to its end,
+    - outcomes: count of each final task state.
+    """
+
+    OUTCOMES = {
+        TaskExecState.END.value: 'end',
+        TaskExecState.ERROR.value: 'error',
+        TaskExecState.TIMEOUT.value: 'timeout',
+        TaskExecState.SKIP.value: 'skip',
+    }
+
+    def __init__(self):
+        # {('task'|'template', <key>): {'queue': Histogram, ...}}
+        self._stats = {}
+        # {(<template id>, <version>): (<graph>, {<child>: [<parents>]})}
+        self._parents = {}
+
+    def _entries(self, task, template):
+        for key in (('task', task.template.name), ('template', template['id'])):
+            try:
+                yield self._stats[key]
+            except KeyError:
+                entry = self._stats[key] = {
+                    'queue': Histogram(),
+                    'duration': Histogram(),
+                    'outcomes': Counter(),
+                }
+                yield entry
+
+    def _parents_of(self, template):
+        """
+        Return the upstream tasks of each task of a template version, built
+        once per version.
+        """
+        key = (template['id'], template.get('version'))
+        graph = template['graph']
+        cached = self._parents.get(key)
+        # The interned templates of a version share their graph, a draft
+        # can change without a new version
+        if cached is not None and cached[0] is graph:
+            return cached[1]
+
+        parents = {}
+        for parent_id, children in graph.items():
+            for child_id in children:
+                parents.setdefault(child_id, []).append(parent_id)
+        self._parents[key] = (graph, parents)
+        return parents
+
+    def _ready_time(self, task, instance, template):
+        """
+        Time at which a task could start: the latest end of its upstream
+        tasks, or the start of the workflow.
+        """
+        ready = None
+        parents = self._parents_of(template).get(task.template.uid, [])
+        for parent_id in parents:
+            parent = instance._tasks_by_id.get(parent_id)
+            end = getattr(parent, '_end', None)
+            if end is not None and (ready is None or end > ready):
+                ready = end
+        return ready or instance._start
+
+    def record(self, event_type, task_id, wflow):
+        """
+        Record the timings of a task exec event.
+        """
+        if event_type != TaskExecState.BEGIN.value and (
+            event_type not in self.OUTCOMES
+        ):
+            return
+        instance = wflow.instance
+        task = instance._tasks_by_id.get(task_id)
+        if task is None or task._start is None:
+            return
+
+        template = wflow.template
+        if event_type == TaskExecState.BEGIN.value:
+            ready = self._ready_time(task, instance, template)
+            if ready is None:
+                return
+            queue = max(0.0, (task._start - ready).total_seconds())
+            for entry in self._entries(task, template):
+                entry['queue'].add(queue)
+            return
+
+        outcome = self.OUTCOMES[event_type]
+        duration = None
+        if task._end is not None:
+            duration = (task._end - task._start).total_seconds()
+        for entry in self._entries(task, template):
+            entry['outcomes'][outcome] += 1
+            if duration is not None:
+                entry['duration'].add(duration)
+
+    def stats(self):
+        result = {'tasks': {}, 'templates': {}}
+        for (kind, key), entry in self._stats.items():
+            result['{}s'.format(kind)][key] = {
+                'queue': entry['queue'].as_dict(),
+                'duration': entry['duration'].as_dict(),
+                'outcomes': dict(entry['outcomes']),
+            }
+        return result
+
+    @staticmethod
+    def merge(results):
+        """
+        Merge the `stats()` of several worker processes.
+        """
+        merged = {'tasks': {}, 'templates': {}}
+        for result in results:
+            for kind, entries in result.items():
+                for key, entry in entries.items():
+                    target = merged[kind].setdefault(key, {
+                        'queue': Histogram(),
+                        'duration': Histogram(),
+                        'outcomes': Counter(),
+                    })
+                    for name in ('queue', 'duration'):
+                        target[name].update(Histogram.from_dict(entry[name]))
+                    target['outcomes'].update(entry['outcomes'])
+        for entries in merged.values():
+            for entry in entries.values():
+                entry['queue'] = entry['queue'].as_dict()
+                entry['duration'] = entry['duration'].as_dict()
+                entry['outcomes'] = dict(entry['outcomes'])
+        return merged
+
+    def reset(self):
+        self._stats.clear()
+        self._parents.clear()
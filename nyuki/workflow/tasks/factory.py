@@ -1,6 +1,5 @@
 import asyncio
 import logging
-from aiohttp import ClientSession
 from copy import deepcopy
 from tukio.task import register
 from tukio.task.holder import TaskHolder
@@ -182,8 +181,13 @@ class FactoryTask(TaskHolder):
     async def execute(self, event):
         data = event.data
         runtime_config = deepcopy(self.config)
-        async with ClientSession() as self.session:
-            await self.get_factory_rules(runtime_config)
+        # The pool may be stopped (configuration reload)
+        async with runtime.http_client.borrow() as session:
+            self.session = session
+            try:
+                await self.get_factory_rules(runtime_config)
+            finally:
+                self.session = None
         log.debug('Full factory config: %s', runtime_config)
 
         converter = Converter.from_dict(runtime_config)
@@ -1,14 +1,16 @@
 import json
 import asyncio
 import logging
+from collections import OrderedDict
 from enum import Enum
-from aiohttp import ClientSession
+from tukio import get_broker, EXEC_TOPIC
 from tukio.task import register
 from tukio.task.holder import TaskHolder
-from tukio.workflow import WorkflowExecState, Workflow
+from tukio.workflow import WorkflowExecState, Workflow, WorkflowTemplate
 
+from nyuki.workflow.api.vars import DataInspector
 from .utils import runtime
-from .utils.uri import URI
+from .utils.uri import URI, InvalidWorkflowUri
 
 
 log = logging.getLogger(__name__)
@@ -22,12 +24,96 @@ class WorkflowStatus(Enum):
     DONE = 'done'
 
 
+class CompletionListener:
+
+    """
+    Route the async completions of the workflows triggered on other nyukis
+    to the waiting tasks, using a single subscription to the completions of
+    this replica: `<bus name>/async/<nyuki id>[/<worker index>]/+`.
+    """
+
+    # Keep completions received before their task waits for them
+    EARLY_TTL = 60.0
+
+    def __init__(self):
+        self._futures = {}
+        # {<task uid>: (<data>, <expiration time>)}, by expiration time
+        self._early = OrderedDict()
+
+    @property
+    def prefix(self):
+        # Each replica, and each of its worker processes (prefork mode),
+        # only receives its own completions
+        parts = [runtime.bus.name, 'async']
+        nyuki = getattr(runtime, 'nyuki', None)
+        if nyuki is not None:
+            parts.append(nyuki.id)
+            if nyuki.workers.enabled:
+                parts.append(str(nyuki.workers.index))
+        return '/'.join(parts)
+
+    @property
+    def topic(self):
+        return '{}/+'.format(self.prefix)
+
+    def task_topic(self, uid):
+        return '{}/{}'.format(self.prefix, uid)
+
+    async def start(self):
+        await runtime.bus.subscribe(self.topic, self._received)
+
+    async def stop(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._early.clear()
+        await runtime.bus.unsubscribe(self.topic, self._received)
+
+    def wait(self, uid):
+        """
+        Return a future resolved with the completion of the task `uid`.
+        """
+        future = asyncio.Future()
+        try:
+            data, _ = self._early.pop(uid)
+        except KeyError:
+            self._futures[uid] = future
+        else:
+            future.set_result(data)
+        return future
+
+    def discard(self, uid):
+        self._futures.pop(uid, None)
+
+    def _purge(self):
+        now = asyncio.get_event_loop().time()
+        while self._early:
+            uid, (_, expiration) = next(iter(self._early.items()))
+            if expiration > now:
+                break
+            del self._early[uid]
+
+    async def _received(self, topic, data):
+        uid = topic.rsplit('/', 1)[-1]
+        log.debug(
+            "Received data for async trigger_workflow in '%s': %s",
+            topic, data,
+        )
+        future = self._futures.pop(uid, None)
+        if future is None:
+            self._purge()
+            expiration = asyncio.get_event_loop().time() + self.EARLY_TTL
+            self._early[uid] = (data, expiration)
+        elif not future.done():
+            future.set_result(data)
+
+
 @register('trigger_workflow', 'execute')
 class TriggerWorkflowTask(TaskHolder):
 
     __slots__ = (
         'template', 'blocking', 'task', '_engine', 'data',
-        'status', 'triggered_id', 'async_future',
+        'status', 'triggered_id', 'async_future', 'local', '_exec_topic',
     )
 
     SCHEMA = {
@@ -54,6 +140,11 @@ class TriggerWorkflowTask(TaskHolder):
         self.template = self.config['template']
         self.blocking = self.config.get('blocking', True)
         self.task = None
+        # Workflows of the running nyuki are triggered without any request
+        self.local = (
+            runtime.bus is not None and
+            self.template['service'] == runtime.bus.name
+        )
         self._engine = 'http://{}/{}/api/v1/workflow'.format(
             runtime.config.get('http_host', 'localhost'),
             self.template['service'],
@@ -64,6 +155,8 @@ class TriggerWorkflowTask(TaskHolder):
         self.data = None
         self.triggered_id = None
         self.async_future = None
+        # Broker topic `local_exec` is registered to
+        self._exec_topic = None
 
     def report(self):
         return {
@@ -71,14 +164,83 @@ class TriggerWorkflowTask(TaskHolder):
             'status': self.status,
         }
 
-    async def async_exec(self, topic, data):
-        log.debug(
-            "Received data for async trigger_workflow in '%s': %s",
-            topic, data,
-        )
+    def local_exec(self, event):
+        """
+        Resolve the completion of a local workflow from the tukio broker.
+        """
+        if event.data['type'] not in (
+            WorkflowExecState.END.value,
+            WorkflowExecState.ERROR.value,
+        ):
+            return
+        self._unregister()
         if not self.async_future.done():
-            self.async_future.set_result(data)
-        await runtime.bus.unsubscribe(topic)
+            self.async_future.set_result(event.data)
+
+    def _unregister(self):
+        if self._exec_topic is None:
+            return
+        try:
+            get_broker().unregister(self.local_exec, topic=self._exec_topic)
+        except KeyError:
+            log.debug('Handler of %s already unregistered', self._exec_topic)
+        self._exec_topic = None
+
+    async def _trigger_local(self, workflow, track):
+        """
+        Start a workflow of the running nyuki, without going through its API.
+        """
+        nyuki = runtime.nyuki
+        tid = self.template['id']
+        if self.template.get('draft', False):
+            template = await nyuki.storage.get_template(tid, draft=True)
+        else:
+            template = nyuki.engine.selector.get_dict(tid)
+        if not template:
+            raise RuntimeError("Can't load template info")
+
+        # Prevent workflow loop
+        for ancestor in track:
+            try:
+                info = URI.parse(ancestor)
+            except InvalidWorkflowUri:
+                continue
+            if info.template_id == tid and info.holder == runtime.bus.name:
+                raise RuntimeError(
+                    "Can't process workflow template {}, reason: "
+                    "Loop detected between workflows".format(self.template)
+                )
+
+        lightened_data = {
+            key: self.data[key]
+            for key in DataInspector.template_keys(template)
+            if key in self.data
+        }
+        if self.template.get('draft', False):
+            wflow = await nyuki.engine.run_once(
+                WorkflowTemplate.from_dict(template), lightened_data
+            )
+        else:
+            wflow = await nyuki.engine.trigger(tid, lightened_data)
+        if wflow is None:
+            raise RuntimeError(
+                "Can't process workflow template {}, reason: Could not start "
+                "any workflow from this template".format(self.template)
+            )
+        # Children never wait for an admission slot held by their parents
+        nyuki.admission.take(tid)
+        nyuki.admission.release_on_done(tid, wflow)
+
+        self.triggered_id = wflow.uid
+        nyuki.new_workflow(
+            template, wflow,
+            track=track,
+            requester=URI.instance(workflow.instance),
+        )
+        if self.blocking:
+            self.async_future = asyncio.Future()
+            self._exec_topic = '/'.join((EXEC_TOPIC, wflow.uid))
+            get_broker().register(self.local_exec, topic=self._exec_topic)
 
     async def execute(self, event):
         """
@@ -88,17 +250,41 @@ class TriggerWorkflowTask(TaskHolder):
         self.task = asyncio.Task.current_task()
         is_draft = self.template.get('draft', False)
 
-        # Send the HTTP request
         log.info('Triggering template %s%s on service %s', self.template['id'],
                  ' (draft)' if is_draft else '', self.template['service'])
 
-        # Setup headers (set requester and exec-track to avoid workflow loops)
+        # Set requester and exec-track to avoid workflow loops
         workflow = runtime.workflows[Workflow.current_workflow().uid]
         parent = workflow.exec.get('requester')
         track = list(workflow.exec.get('track', []))
         if parent:
             track.append(parent)
 
+        if self.local:
+            await self._trigger_local(workflow, track)
+        else:
+            await self._trigger_remote(workflow, track)
+
+        wf_id = '@'.join([self.triggered_id[:8], self.template['service']])
+        self.status = WorkflowStatus.RUNNING.value
+        log.info('Successfully started %s', wf_id)
+        self.task.dispatch_progress(self.report())
+
+        # Block until task completed
+        if self.blocking:
+            log.info('Waiting for workflow %s to complete', wf_id)
+            await self.async_future
+            self.status = WorkflowStatus.DONE.value
+            log.info('Workflow %s is done', wf_id)
+            self.task.dispatch_progress({'status': self.status})
+
+        return self.data
+
+    async def _trigger_remote(self, workflow, track):
+        """
+        Start a workflow through the API of its nyuki.
+        """
+        is_draft = self.template.get('draft', False)
         headers = {
             'Content-Type': 'application/json',
             'Referer': URI.instance(workflow.instance),
@@ -107,20 +293,18 @@ class TriggerWorkflowTask(TaskHolder):
 
         # Handle blocking trigger_workflow using mqtt
         if self.blocking:
-            topic = '{}/async/{}'.format(runtime.bus.name, self.uid[:8])
-            headers['X-Surycat-Async-Topic'] = topic
+            completions = runtime.completions
+            headers['X-Surycat-Async-Topic'] = completions.task_topic(self.uid)
             headers['X-Surycat-Async-Events'] = ','.join([
                 WorkflowExecState.END.value,
                 WorkflowExecState.ERROR.value,
             ])
-            self.async_future = asyncio.Future()
-            await runtime.bus.subscribe(topic, self.async_exec)
-
-            def _unsub(f):
-                asyncio.ensure_future(runtime.bus.unsubscribe(topic))
-            self.task.add_done_callback(_unsub)
+            self.async_future = completions.wait(self.uid)
+            self.task.add_done_callback(
+                lambda _: completions.discard(self.uid)
+            )
 
-        async with ClientSession() as session:
+        async with runtime.http_client.borrow() as session:
             # Compute data to send to sub-workflows
             url = '{}/vars/{}{}'.format(
                 self._engine,
@@ -149,7 +333,7 @@ class TriggerWorkflowTask(TaskHolder):
             async with session.put(**params) as response:
                 if response.status != 200:
                     msg = "Can't process workflow template {} on {}".format(
-                        self.template, self.nyuki_api
+                        self.template, self._engine
                     )
                     if response.status % 400 < 100:
                         reason = await response.json()
@@ -158,28 +342,14 @@ class TriggerWorkflowTask(TaskHolder):
                 resp_body = await response.json()
                 self.triggered_id = resp_body['id']
 
-        wf_id = '@'.join([self.triggered_id[:8], self.template['service']])
-        self.status = WorkflowStatus.RUNNING.value
-        log.info('Successfully started %s', wf_id)
-        self.task.dispatch_progress(self.report())
-
-        # Block until task completed
-        if self.blocking:
-            log.info('Waiting for workflow %s to complete', wf_id)
-            await self.async_future
-            self.status = WorkflowStatus.DONE.value
-            log.info('Workflow %s is done', wf_id)
-            self.task.dispatch_progress({'status': self.status})
-
-        return self.data
-
     async def _end_triggered_workflow(self):
         """
         Asynchronously cancel the triggered workflow.
         """
         wf_id = '@'.join([self.triggered_id[:8], self.template['service']])
-        async with ClientSession() as session:
-            url = '{}/instances/{}'.format(self._engine, self.triggered_id)
+        url = '{}/instances/{}'.format(self._engine, self.triggered_id)
+        # The pool may be stopped when the task is torn down
+        async with runtime.http_client.borrow() as session:
             async with session.delete(url) as response:
                 if response.status != 200:
                     log.warning('Failed to cancel workflow %s', wf_id)
@@ -200,5 +370,13 @@ class TriggerWorkflowTask(TaskHolder):
             log.debug('No workflow to cancel')
             return self.data
 
+        if self.local:
+            self._unregister()
+            try:
+                runtime.workflows[self.triggered_id].instance.cancel()
+            except KeyError:
+                log.debug('Workflow %s already ended', self.triggered_id)
+            return self.data
+
         asyncio.ensure_future(self._end_triggered_workflow())
         return self.data
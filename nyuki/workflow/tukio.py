@@ -1,21 +1,276 @@
-from tukio.task import TaskTemplate
-from tukio.workflow import WorkflowTemplate
+import logging
+import sys
+import weakref
+from tukio import Engine, UnknownTaskName
+from tukio.event import Event
+from tukio.utils import Listen
+from tukio.workflow import WorkflowRootTaskError, WorkflowTemplate
+
+from nyuki.workflow.db.workflow_templates import TemplateState
+
+
+log = logging.getLogger(__name__)
+
+
+class SharedTemplate(dict):
+
+    """
+    Full template dict shared by all the workflow instances of a template
+    version. It must never be modified, use a copy instead.
+    """
+
+    __slots__ = ('__weakref__', 'size')
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('shared templates are read-only')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        # Copies (and deep copies) are regular dicts
+        return (dict, (dict(self),))
+
+
+def _deep_sizeof(obj):
+    """
+    Approximate memory size of a JSON-like object, in bytes.
+    """
+    size = 0
+    stack = [obj]
+    seen = set()
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return size
+
+
+class TemplatePool:
+
+    """
+    Intern the full template dicts by id, version and state, so that the
+    running instances of a same template version share one read-only copy.
+    A template is released once no instance nor selector references it.
+    """
+
+    def __init__(self):
+        # {(<id>, <version>, <state>): <SharedTemplate>}
+        self._templates = weakref.WeakValueDictionary()
+
+    def intern(self, template):
+        """
+        Return the shared copy of a template dict.
+        """
+        if isinstance(template, SharedTemplate):
+            return template
+
+        key = (template['id'], template.get('version'), template.get('state'))
+        shared = self._templates.get(key)
+        # Drafts (and metadata) can change without a new version
+        if shared is not None and shared == template:
+            return shared
+
+        shared = SharedTemplate(template)
+        shared.size = _deep_sizeof(template)
+        self._templates[key] = shared
+        return shared
+
+    def stats(self, templates):
+        """
+        Return the memory used by the given templates (e.g. those of the
+        running instances) and the memory saved by sharing them.
+        """
+        refs = {}
+        sizes = {}
+        for template in templates:
+            refs[id(template)] = refs.get(id(template), 0) + 1
+            sizes[id(template)] = getattr(template, 'size', None)
+            if sizes[id(template)] is None:
+                sizes[id(template)] = _deep_sizeof(template)
+        return {
+            'interned': len(self._templates),
+            'references': sum(refs.values()),
+            'distinct': len(refs),
+            'size': sum(sizes.values()),
+            'saved': sum(
+                (count - 1) * sizes[key] for key, count in refs.items()
+            ),
+        }
 
 
 class WorkflowSelector:
 
-    def __init__(self, storage):
+    """
+    In-memory index of the active workflow templates, by topic.
+    Keeps both the full template dicts (with metadata and tasks) and their
+    `WorkflowTemplate` objects, so that selecting and triggering a workflow
+    does not require any database request.
+    """
+
+    def __init__(self, storage, pool=None):
         self.storage = storage
+        self.pool = pool or TemplatePool()
+        # {<template id>: (<template dict>, <WorkflowTemplate>)}
+        self._templates = {}
+        # {<topic>: {<template id>}}, `Listen.everything` for `topics: None`
+        self._topics = {Listen.everything: set()}
+
+    async def reload(self):
+        """
+        Replace the whole index with the active templates from the storage.
+        """
+        templates = await self.storage.get_templates(full=True)
+        self.clear()
+        for template in templates:
+            if template['state'] != TemplateState.ACTIVE.value:
+                continue
+            try:
+                self.load(template)
+            except (WorkflowRootTaskError, UnknownTaskName) as exc:
+                log.error("Invalid template '%s': %s", template['id'], exc)
+        log.info('Loaded %s active templates', len(self._templates))
+
+    async def refresh(self, tmpl_id=None):
+        """
+        Re-fetch one active template from the storage, or all of them.
+        """
+        if tmpl_id is None:
+            await self.reload()
+            return
+
+        template = await self.storage.get_template(tmpl_id, draft=False)
+        if template:
+            self.load(template)
+        else:
+            self.unload(tmpl_id)
+
+    def clear(self):
+        self._templates.clear()
+        self._topics = {Listen.everything: set()}
+
+    def load(self, template):
+        """
+        Index (or re-index) a full active template dict. A new template
+        version is validated, invalid ones are not indexed.
+        """
+        template = self.pool.intern(template)
+        indexed = self._templates.get(template['id'])
+        if indexed is not None and indexed[0] is template:
+            return indexed[1]
+
+        wf_tmpl = WorkflowTemplate.from_dict(template)
+        wf_tmpl.validate()
+        if wf_tmpl.uid in self._templates:
+            self.unload(wf_tmpl.uid)
+        self._templates[wf_tmpl.uid] = (template, wf_tmpl)
+
+        listen = wf_tmpl.listen
+        if listen is Listen.everything:
+            self._topics[Listen.everything].add(wf_tmpl.uid)
+        elif listen is Listen.topics:
+            for topic in wf_tmpl.topics:
+                self._topics.setdefault(topic, set()).add(wf_tmpl.uid)
+        return wf_tmpl
+
+    def unload(self, tmpl_id):
+        """
+        Remove a template from the index, if present.
+        """
+        try:
+            _, wf_tmpl = self._templates.pop(tmpl_id)
+        except KeyError:
+            return
+
+        listen = wf_tmpl.listen
+        if listen is Listen.everything:
+            self._topics[Listen.everything].discard(tmpl_id)
+        elif listen is Listen.topics:
+            for topic in wf_tmpl.topics:
+                tids = self._topics.get(topic)
+                if tids is None:
+                    continue
+                tids.discard(tmpl_id)
+                if not tids:
+                    del self._topics[topic]
+
+    def update_metadata(self, tmpl_id, metadata):
+        """
+        Update the title/tags of an indexed template.
+        """
+        try:
+            template, wf_tmpl = self._templates[tmpl_id]
+        except KeyError:
+            return
+        template = self.pool.intern({
+            **template,
+            **{
+                key: metadata[key]
+                for key in ('title', 'tags')
+                if key in metadata
+            },
+        })
+        self._templates[tmpl_id] = (template, wf_tmpl)
+
+    def get(self, tmpl_id):
+        """
+        Return the `WorkflowTemplate` of an active template, or None.
+        """
+        try:
+            return self._templates[tmpl_id][1]
+        except KeyError:
+            return None
+
+    def get_dict(self, tmpl_id):
+        """
+        Return the full dict of an active template, or None.
+        """
+        try:
+            return self._templates[tmpl_id][0]
+        except KeyError:
+            return None
+
+    def select(self, topic=None):
+        """
+        Return the `WorkflowTemplate` objects listening on `topic`,
+        including the ones listening on every topic.
+        """
+        tids = self._topics[Listen.everything]
+        if topic is not None and topic in self._topics:
+            tids = tids | self._topics[topic]
+        return [self._templates[tid][1] for tid in tids]
+
+
+class WorkflowEngine(Engine):
+
+    """
+    Allow dispatching an event and starting the selected workflows
+    separately, so that each start can wait for an admission slot.
+    """
+
+    def dispatch(self, data, topic=None):
+        """
+        Dispatch new data to the listening tasks and return its event.
+        """
+        log.debug("data received: %s (topic=%s)", data, topic)
+        event = Event(data, topic=topic)
+        self._broker.dispatch(event, topic)
+        return event
 
-    async def get(self, tmpl_id):
-        template = await self.storage.get_template(
-            tmpl_id, draft=False
-        )
-        return WorkflowTemplate.from_dict(template)
-
-    async def select(self, topic):
-        templates = await self.storage.get_for_topic(topic)
-        return [
-            WorkflowTemplate.from_dict(template)
-            for template in templates
-        ]
+    async def start(self, template, event):
+        """
+        Try to run a new instance of a selected template with an event
+        already dispatched.
+        """
+        if self._must_stop:
+            log.debug("The engine is stopping, cannot trigger new workflows")
+            return None
+        with await self._lock:
+            return self._try_run(template, event)
@@ -1,19 +1,19 @@
 import asyncio
 import logging
 from uuid import uuid4
-from copy import deepcopy
 from random import shuffle
-from datetime import datetime
-from tukio import Engine, TaskRegistry, get_broker, EXEC_TOPIC
+from tukio import TaskRegistry, get_broker, EXEC_TOPIC
+from tukio.utils import FutureState
 from tukio.workflow import Workflow, WorkflowExecState
 from tukio.task.factory import TaskExecState
 
 from nyuki import Nyuki
 from nyuki.utils import serialize_object, utcnow
+from nyuki.workflow.db.history import HistoryWriter
 from nyuki.workflow.db.storage import MongoStorage
-from nyuki.workflow.db.migrations import run_migrations
 from nyuki.workflow.db.task_instances import WS_FILTERS
 
+from .api.admission import ApiWorkflowAdmission
 from .api.factory import (
     ApiFactoryRegex, ApiFactoryRegexes, ApiFactoryLookup, ApiFactoryLookups,
     ApiFactoryLookupCSV
@@ -25,15 +25,22 @@ from .api.instances import (
     ApiWorkflow, ApiWorkflows, ApiWorkflowsHistory, ApiWorkflowHistory,
     ApiWorkflowTriggers, ApiWorkflowTrigger, ApiWorkflowHistoryTask,
     ApiWorkflowHistoryTaskData, ApiTaskReporting, ApiTaskReportingContact,
-    ApiTaskReportingContacts
+    ApiTaskReportingContacts, instance_router
 )
+from .api.interests import ApiWorkflowWatches, ApiWorkflowWatch
+from .api.stats import ApiWorkflowStats, ApiWorkflowTaskStats
 from .api.vars import (
     ApiVars, ApiVarsVersion, ApiVarsDraft
 )
 
 from .tasks import *
 from .tasks.utils import runtime, CONTACT_PROGRESS
-from .tukio import WorkflowSelector
+from .admission import AdmissionControl, AdmissionRejected, AdmissionTimeout
+from .interests import InterestRegistry
+from .invalidation import CacheInvalidation
+from .publisher import ExecPublisher
+from .stats import TaskTimings
+from .tukio import TemplatePool, WorkflowEngine, WorkflowSelector
 
 
 log = logging.getLogger(__name__)
@@ -51,32 +58,26 @@ def _serialize_workflow(wf):
     return wf.report()
 
 
-def sanitize_workflow_exec(obj):
-    """
-    Replace any object value by 'internal data' string to store in Mongo.
-    """
-    types = [dict, list, tuple, str, int, float, bool, type(None), datetime]
-    if type(obj) not in types:
-        obj = 'Internal server data: {}'.format(type(obj))
-    elif isinstance(obj, dict):
-        for key, value in obj.items():
-            obj[key] = sanitize_workflow_exec(value)
-    elif isinstance(obj, list):
-        for item in obj:
-            item = sanitize_workflow_exec(item)
-    return obj
-
-
 class WorkflowInstance:
 
     """
     Holds a workflow pair of template/instance.
     Allows retrieving a workflow exec state at any moment.
+    The template is shared between reports, and the exec part of the tasks
+    that cannot change anymore is cached until an exec event is received.
     """
 
-    __slots__ = ('_template', '_instance', '_exec')
+    __slots__ = ('_template', '_instance', '_exec', '_tasks')
 
     ALLOWED_EXEC_KEYS = ['requester', 'track']
+    # Task states in which the exec part only changes through an event
+    FINAL_STATES = [
+        FutureState.finished.value,
+        FutureState.skipped.value,
+        FutureState.exception.value,
+        FutureState.timeout.value,
+        FutureState.cancelled.value,
+    ]
 
     def __init__(self, template, instance, **kwargs):
         self._template = template
@@ -86,6 +87,8 @@ class WorkflowInstance:
             for key in kwargs
             if key in self.ALLOWED_EXEC_KEYS
         }
+        # {<task template id>: <task exec dict>}
+        self._tasks = {}
 
     @property
     def template(self):
@@ -99,54 +102,101 @@ class WorkflowInstance:
     def exec(self):
         return self._exec
 
+    def invalidate(self, task_id=None):
+        """
+        Drop the cached exec part of a task, or of all tasks.
+        """
+        if task_id is None:
+            self._tasks.clear()
+        else:
+            self._tasks.pop(task_id, None)
+
+    def _task_exec(self, task_id):
+        """
+        Return the exec part of a task, from the cache if possible.
+        """
+        try:
+            return self._tasks[task_id]
+        except KeyError:
+            pass
+
+        try:
+            task = self._instance._tasks_by_id[task_id]
+        except KeyError:
+            # Task was never started, create dummy exec dict.
+            task_exec = {
+                'id': str(uuid4()),
+                'start': None,
+                'end': None,
+                'state': 'not-started',
+                'inputs': None,
+                'outputs': None,
+                'reporting': None
+            }
+            # No task can start anymore
+            if self._instance.done():
+                self._tasks[task_id] = task_exec
+            return task_exec
+
+        task_exec = task.as_dict()
+        # If the task is linked to a task holder, try to use its own report
+        holder = getattr(task, 'holder', None)
+        if hasattr(holder, 'report'):
+            try:
+                task_exec['reporting'] = holder.report()
+            except Exception as exc:
+                # Unexpected error from task reporting.
+                log.error('Exception on task reporting: %s', exc)
+                self._instance._internal_exc = exc
+                self._instance._try_mark_done()
+
+        if task_exec['state'] in self.FINAL_STATES:
+            self._tasks[task_id] = task_exec
+        return task_exec
+
     def report(self, tasks=True, data=True):
         """
         Merge a workflow exec instance report and its template.
         """
-        template = deepcopy(self._template)
-        inst = self._instance.report()
-        inst['exec'].update(self._exec)
-
+        instance = self._instance
         result = {
-            **inst['exec'],
-            'template': template,
+            'id': instance.uid,
+            'start': instance._start,
+            'end': instance._end,
+            'state': FutureState.get(instance).value,
+            **self._exec,
         }
 
         if tasks is False:
-            del result['template']['graph']
-            del result['template']['tasks']
+            result['template'] = {
+                key: value
+                for key, value in self._template.items()
+                if key not in ('graph', 'tasks')
+            }
             return result
 
-        tasks = {task['id']: {'template': task} for task in template['tasks']}
-        for task_dict in inst['tasks']:
-            if not task_dict.get('exec'):
-                # Task was never started, create dummy exec dict.
-                task_dict['exec'] = {
-                    'id': str(uuid4()),
-                    'start': None,
-                    'end': None,
-                    'state': 'not-started',
-                    'inputs': None,
-                    'outputs': None,
-                    'reporting': None
-                }
-
+        template = dict(self._template)
+        template['tasks'] = []
+        for task in self._template['tasks']:
+            task_exec = self._task_exec(task['id'])
             # Filter out reporting/data if not necessary
             if data is False:
-                del task_dict['exec']['reporting']
-                del task_dict['exec']['inputs']
+                task_exec = {
+                    key: value
+                    for key, value in task_exec.items()
+                    if key not in ('reporting', 'inputs')
+                }
                 # Leave the necessary task-end informations available
-                if task_dict['exec']['outputs']:
-                    task_dict['exec']['outputs'] = {
-                        key: task_dict['exec']['outputs'][key]
+                if task_exec['outputs']:
+                    task_exec['outputs'] = {
+                        key: task_exec['outputs'][key]
                         for key in WS_FILTERS
-                        if key in task_dict['exec']['outputs']
+                        if key in task_exec['outputs']
                     }
-
             # Add execution informations to each task.
-            tasks[task_dict['id']].update(task_dict['exec'])
+            template['tasks'].append({'template': task, **task_exec})
 
-        result['template']['tasks'] = list(tasks.values())
+        result['template'] = template
         return result
 
 
@@ -169,11 +219,58 @@ class WorkflowNyuki(Nyuki):
                     'host': {'type': 'string', 'minLength': 1},
                     'database': {'type': 'string', 'minLength': 1},
                     'validate_on_start': {'type': 'boolean', 'default': True},
+                    'history_max_size': {'type': 'integer', 'minimum': 1},
                 }
             },
             'topics': {
                 'type': 'array',
                 'items': {'type': 'string', 'minLength': 1}
+            },
+            'cache': {
+                'type': 'object',
+                'properties': {
+                    'check_interval': {'type': 'number', 'minimum': 1},
+                }
+            },
+            'admission': {
+                'type': 'object',
+                'properties': {
+                    'max_running': {'type': 'integer', 'minimum': 0},
+                    'max_per_template': {'type': 'integer', 'minimum': 0},
+                    'max_pending': {'type': 'integer', 'minimum': 0},
+                    'pending_timeout': {'type': 'number', 'minimum': 0},
+                    'priorities': {
+                        'type': 'object',
+                        'additionalProperties': {'type': 'integer'},
+                    },
+                }
+            },
+            'websocket': {
+                'type': 'object',
+                'properties': {
+                    'flush_interval': {'type': 'number', 'minimum': 0},
+                    'demand_driven': {'type': 'boolean', 'default': False},
+                    'lease_ttl': {'type': 'number', 'minimum': 1},
+                }
+            },
+            'history': {
+                'type': 'object',
+                'properties': {
+                    'batch_size': {'type': 'integer', 'minimum': 1},
+                    'flush_interval': {'type': 'number', 'minimum': 0},
+                    'max_pending': {'type': 'integer', 'minimum': 1},
+                    'retention': {'type': 'integer', 'minimum': 1},
+                }
+            },
+            'archive': {
+                'type': 'object',
+                'required': ['path'],
+                'properties': {
+                    'path': {'type': 'string', 'minLength': 1},
+                    'after': {'type': 'integer', 'minimum': 1},
+                    'interval': {'type': 'number', 'minimum': 1},
+                    'segment_size': {'type': 'integer', 'minimum': 1},
+                }
             }
         }
     }
@@ -202,6 +299,11 @@ class WorkflowNyuki(Nyuki):
         ApiVars,                    # /v1/workflow/vars/{uid}
         ApiVarsVersion,             # /v1/workflow/vars/{uid}/{version}
         ApiVarsDraft,               # /v1/workflow/data/{uid}/draft
+        ApiWorkflowStats,           # /v1/workflow/stats
+        ApiWorkflowTaskStats,       # /v1/workflow/stats/tasks
+        ApiWorkflowAdmission,       # /v1/workflow/admission
+        ApiWorkflowWatches,         # /v1/workflow/watch
+        ApiWorkflowWatch,           # /v1/workflow/watch/{lease_id}
     ]
 
     DEFAULT_POLICY = None
@@ -213,6 +315,14 @@ class WorkflowNyuki(Nyuki):
         self.schema = 1
         self.engine = None
         self.storage = MongoStorage()
+        self.invalidation = CacheInvalidation(self)
+        self.history = HistoryWriter(self.storage)
+        self.admission = AdmissionControl()
+        self.publisher = ExecPublisher(self.bus)
+        self.interests = InterestRegistry()
+        # Templates shared by the running instances
+        self.templates = TemplatePool()
+        self.timings = TaskTimings()
 
         self.AVAILABLE_TASKS = {}
         for name, value in TaskRegistry.all().items():
@@ -224,6 +334,12 @@ class WorkflowNyuki(Nyuki):
         runtime.bus = self.bus
         runtime.config = self.config
         runtime.workflows = self.running_workflows
+        runtime.nyuki = self
+        runtime.http_client = self.http_client
+        runtime.completions = CompletionListener()
+
+        # Requests on instances owned by another worker process
+        self.api.add_middleware(instance_router(self))
 
     @property
     def mongo_config(self):
@@ -237,9 +353,24 @@ class WorkflowNyuki(Nyuki):
         self.storage.configure(**self.mongo_config)
         # Blocks until connection to Mongo is done.
         await self.storage.index()
-        await run_migrations(**self.mongo_config)
-        selector = WorkflowSelector(self.storage)
-        self.engine = Engine(selector=selector, loop=self.loop)
+        await self.storage.migrate()
+        self.history.configure(**self.config.get('history', {}))
+        self.history.start()
+        self.storage.archive.configure(**self.config.get('archive', {}))
+        await self.storage.archive.start()
+        selector = WorkflowSelector(self.storage, self.templates)
+        await selector.reload()
+        self.engine = WorkflowEngine(selector=selector, loop=self.loop)
+        self.admission.configure(**self.config.get('admission', {}))
+        self.configure_websocket()
+        # Keep in-memory caches consistent between replicas
+        self.invalidation.configure(**self.config.get('cache', {}))
+        self.invalidation.register('templates', selector.refresh)
+        self.invalidation.register('regexes', self.storage.regexes.evict)
+        self.invalidation.register('lookups', self.storage.lookups.evict)
+        await self.invalidation.start()
+        # Completions of the workflows triggered on other nyukis
+        asyncio.ensure_future(runtime.completions.start())
         for topic in self.topics:
             asyncio.ensure_future(self.bus.subscribe(
                 topic, self.workflow_event
@@ -249,15 +380,41 @@ class WorkflowNyuki(Nyuki):
 
     async def reload(self):
         self.storage.configure(**self.mongo_config)
+        self.invalidation.configure(**self.config.get('cache', {}))
+        self.history.configure(**self.config.get('history', {}))
+        self.admission.configure(**self.config.get('admission', {}))
+        self.configure_websocket()
+
+    def configure_websocket(self):
+        config = self.config.get('websocket', {})
+        self.publisher.configure(
+            flush_interval=config.get(
+                'flush_interval', ExecPublisher.FLUSH_INTERVAL
+            ),
+        )
+        self.interests.configure(
+            enabled=config.get('demand_driven', False),
+            lease_ttl=config.get('lease_ttl', InterestRegistry.LEASE_TTL),
+        )
 
     async def teardown(self):
-        if self.engine:
-            await self.engine.stop()
+        try:
+            await self.invalidation.stop()
+            await runtime.completions.stop()
+            if self.engine:
+                await self.engine.stop()
+            await self.publisher.stop()
+        finally:
+            # Write the remaining finished workflows, whatever failed above
+            await self.history.stop()
+            await self.storage.archive.stop()
+            await self.storage.stop()
 
     def new_workflow(self, template, instance, **kwargs):
         """
         Keep in memory a workflow template/instance pair.
         """
+        template = self.templates.intern(template)
         wflow = WorkflowInstance(template, instance, **kwargs)
         self.running_workflows[instance.uid] = wflow
         return wflow
@@ -274,6 +431,12 @@ class WorkflowNyuki(Nyuki):
             log.debug('Outdated event to report: %s', event)
             return
 
+        # Any exec event may change the report of its task (or all of them)
+        task_id = source.get('task_template_id')
+        wflow.invalidate(task_id)
+        if task_id is not None:
+            self.timings.record(event.data['type'], task_id, wflow)
+
         topic = 'workflow/exec/{}'.format(instance_id)
         payload = {
             'type': event.data['type'],
@@ -292,6 +455,10 @@ class WorkflowNyuki(Nyuki):
         # and a more precise topic.
         task_exec_id = source.get('task_exec_id')
         if task_exec_id:
+            # Task updates are only published if a client watches them
+            if not self.interests.watched(instance_id, wflow.template['id']):
+                return
+
             topic = '{}/tasks/{}'.format(topic, task_exec_id)
             payload['template'] = {'id': source['task_template_id']}
 
@@ -299,6 +466,10 @@ class WorkflowNyuki(Nyuki):
             if event.data['type'] == TaskExecState.PROGRESS.value:
                 payload['data'] = event.data.get('content') or {}
                 topic = '{}/reporting'.format(topic)
+                payload['topic'] = topic
+                # Progress updates are merged before being published
+                await self.publisher.progress(instance_id, topic, payload)
+                return
 
             # Custom event type for single contact updates
             elif event.data['type'] == CONTACT_PROGRESS:
@@ -307,7 +478,14 @@ class WorkflowNyuki(Nyuki):
                     topic, payload['data']['uid'],
                 )
                 # Remove contact uid (available in topic)
-                del payload['data']['uid']
+                payload['data'] = {
+                    key: value
+                    for key, value in payload['data'].items()
+                    if key != 'uid'
+                }
+                payload['topic'] = topic
+                await self.publisher.progress(instance_id, topic, payload)
+                return
 
             elif event.data['type'] in (
                 TaskExecState.TIMEOUT.value,
@@ -334,28 +512,51 @@ class WorkflowNyuki(Nyuki):
             WorkflowExecState.ERROR.value
         ]:
             payload['data'] = event.data.get('content') or {}
-            # Sanitize objects to store the finished workflow instance
-            asyncio.ensure_future(self.storage.insert_instance(
-                sanitize_workflow_exec(wflow.report())
-            ))
             del self.running_workflows[instance_id]
+            # Store the finished workflow instance, written in bulk (waits if
+            # too many are pending)
+            await self.history.put(wflow.report())
 
-        await self.bus.publish(payload, 'websocket/{}'.format(topic))
+        await self.publisher.publish(instance_id, topic, payload)
 
     async def workflow_event(self, topic, data):
         """
         New bus event received, trigger workflows if needed.
         """
-        templates = {}
-        # Retrieve full workflow templates
-        # TODO: Better way to fetch the full template details
-        # (this does may more requests than it should)
-        wf_templates = await self.engine.selector.select(topic)
-        for wftmpl in wf_templates:
-            templates[wftmpl.uid] = await self.storage.get_template(
-                wftmpl.uid, draft=False
-            )
-        # Trigger workflows
-        instances = await self.engine.data_received(data, topic)
-        for instance in instances:
-            self.new_workflow(templates[instance.template.uid], instance)
+        event = self.engine.dispatch(data, topic)
+        # With several worker processes, every one of them receives the
+        # events, but only one starts the new workflows
+        if not self.workers.owns_event(topic, data):
+            return
+
+        # Templates are selected from the in-memory index of the selector
+        for wf_tmpl in self.engine.selector.select(topic):
+            template = self.engine.selector.get_dict(wf_tmpl.uid)
+            if self.admission.try_acquire(wf_tmpl.uid):
+                await self._start_workflow(template, wf_tmpl, event)
+            else:
+                asyncio.ensure_future(
+                    self._admit_workflow(template, wf_tmpl, event)
+                )
+
+    async def _admit_workflow(self, template, wf_tmpl, event):
+        """
+        Wait for an admission slot, or shed the event.
+        """
+        try:
+            await self.admission.acquire(wf_tmpl.uid)
+        except (AdmissionRejected, AdmissionTimeout) as exc:
+            log.warning('Workflow %s not started: %s', wf_tmpl.uid[:8], exc)
+            return
+        await self._start_workflow(template, wf_tmpl, event)
+
+    async def _start_workflow(self, template, wf_tmpl, event):
+        """
+        Start a workflow once its admission slot is taken.
+        """
+        wflow = await self.engine.start(wf_tmpl, event)
+        if wflow is None:
+            self.admission.release(wf_tmpl.uid)
+            return
+        self.admission.release_on_done(wf_tmpl.uid, wflow)
+        self.new_workflow(template, wflow)
@@ -34,7 +34,10 @@ setup(
     author_email='rand@surycat.com',
     version=version,
     install_requires=reqs,
-    packages=find_packages(exclude=['tests']),
+    extras_require={
+        'uvloop': ['uvloop>=0.12'],
+    },
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     license='Apache 2.0',
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
@@ -0,0 +1,80 @@
+import asyncio
+from asynctest import TestCase
+from nose.tools import eq_, assert_true, assert_false, assert_raises
+
+from nyuki.workflow.admission import (
+    AdmissionControl, AdmissionRejected, AdmissionTimeout
+)
+
+
+class AdmissionControlTest(TestCase):
+
+    def setUp(self):
+        self.admission = AdmissionControl()
+
+    async def test_001_unlimited(self):
+        for _ in range(100):
+            assert_true(self.admission.try_acquire('a'))
+        eq_(self.admission.stats()['running'], 100)
+
+    async def test_002_global_limit_and_priority(self):
+        self.admission.configure(max_running=1, priorities={'high': 10})
+        await self.admission.acquire('a')
+        order = []
+
+        async def wait(tid):
+            await self.admission.acquire(tid)
+            order.append(tid)
+
+        futures = [
+            asyncio.ensure_future(wait(tid))
+            for tid in ('low', 'high', 'low2')
+        ]
+        await asyncio.sleep(0)
+        eq_(len(self.admission.stats()['pending']), 3)
+        eq_(self.admission.stats()['pending'][0]['template_id'], 'high')
+
+        for tid in ('a', 'high', 'low'):
+            self.admission.release(tid)
+            await asyncio.sleep(0)
+        await asyncio.gather(*futures)
+        eq_(order, ['high', 'low', 'low2'])
+
+    async def test_003_per_template_limit(self):
+        self.admission.configure(max_per_template=1)
+        assert_true(self.admission.try_acquire('a'))
+        assert_false(self.admission.try_acquire('a'))
+        # Another template is not blocked by a pending one
+        pending = asyncio.ensure_future(self.admission.acquire('a'))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(self.admission.acquire('b'), 1)
+        self.admission.release('a')
+        await pending
+        eq_(self.admission.stats()['running_per_template'], {'a': 1, 'b': 1})
+
+    async def test_004_reject_and_timeout(self):
+        self.admission.configure(
+            max_running=1, max_pending=1, pending_timeout=0.01
+        )
+        await self.admission.acquire('a')
+        pending = asyncio.ensure_future(self.admission.acquire('a'))
+        await asyncio.sleep(0)
+        with assert_raises(AdmissionRejected):
+            await self.admission.acquire('a')
+        with assert_raises(AdmissionTimeout):
+            await pending
+        eq_(self.admission.stats()['pending'], [])
+        eq_(self.admission.stats()['rejected'], 1)
+        eq_(self.admission.stats()['timeouts'], 1)
+
+    async def test_005_merge(self):
+        other = AdmissionControl()
+        self.admission.try_acquire('a')
+        other.try_acquire('a')
+        other.try_acquire('b')
+        stats = AdmissionControl.merge([
+            self.admission.stats(), other.stats(),
+        ])
+        eq_(stats['running'], 3)
+        eq_(stats['running_per_template'], {'a': 2, 'b': 1})
+        eq_(stats['admitted'], 3)
@@ -0,0 +1,286 @@
+import os
+import tempfile
+from asynctest import TestCase
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+from collections import defaultdict
+from copy import deepcopy
+from datetime import datetime, timezone
+from nose.tools import eq_, assert_is_none, assert_not_in, assert_raises
+from threading import Thread
+from unittest.mock import MagicMock, Mock
+
+from nyuki.workflow.db.archive import SegmentStore, project
+from nyuki.workflow.db.storage import MongoStorage
+from nyuki.workflow.db.task_instances import TaskInstancesCollection
+
+from tests import AsyncMock
+
+
+def instance(wid, tasks=1):
+    return {
+        'id': wid,
+        'start': datetime(2018, 1, 2, tzinfo=timezone.utc),
+        'template': {
+            'title': wid,
+            'graph': {'t{}'.format(index): [] for index in range(tasks)},
+            'tasks': [
+                {
+                    'id': '{}-t{}'.format(wid, index),
+                    'template': {'id': 't{}'.format(index), 'name': 'task'},
+                    'inputs': {'index': index},
+                    'outputs': {'quorum': 1, 'index': index},
+                }
+                for index in range(tasks)
+            ],
+        },
+    }
+
+
+def mongo_project(document, fields):
+    """
+    Apply a mongo projection, inclusion or exclusion, to a document.
+    """
+    if any(value for key, value in fields.items() if key != '_id'):
+        return project(document, fields)
+    document = deepcopy(document)
+    for field in fields:
+        *parents, key = field.split('.')
+        target = document
+        for parent in parents:
+            target = target.get(parent, {})
+        target.pop(key, None)
+    return document
+
+
+class TaskCollection:
+
+    """
+    Task instances bucket, applying the projections.
+    """
+
+    def __init__(self):
+        self.documents = []
+
+    def insert(self, workflows):
+        for workflow in workflows:
+            for task in workflow['template'].pop('tasks'):
+                self.documents.append(
+                    {**task, 'workflow_instance_id': workflow['id']}
+                )
+
+    def find(self, query, fields):
+        wids = query['workflow_instance_id']['$in']
+        return Cursor([
+            RawBSONDocument(BSON.encode(mongo_project(document, fields)))
+            for document in self.documents
+            if document['workflow_instance_id'] in wids
+        ])
+
+    async def find_one(self, query, fields):
+        return None
+
+    async def delete_many(self, query):
+        wids = query['workflow_instance_id']['$in']
+        self.documents = [
+            document for document in self.documents
+            if document['workflow_instance_id'] not in wids
+        ]
+
+    async def count_documents(self, query):
+        return len(self.documents)
+
+
+class Cursor:
+
+    def __init__(self, documents):
+        self._documents = iter(documents)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class SegmentStoreTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SegmentStore(self.directory.name, segment_size=100)
+        self.store.load()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def test_001_append(self):
+        eq_(self.store.append([instance('w1'), instance('w2')]), 2)
+        # Already archived
+        eq_(self.store.append([instance('w2'), instance('w3')]), 1)
+        eq_(self.store.get('w2'), instance('w2'))
+        eq_(self.store.get('w3'), instance('w3'))
+        assert_is_none(self.store.get('w4'))
+        # Segments over `segment_size` are not appended to
+        eq_(sorted(os.listdir(self.directory.name)), [
+            'history-000001.idx', 'history-000001.ndjson.gz',
+            'history-000002.idx', 'history-000002.ndjson.gz', 'lock',
+        ])
+
+    async def test_002_shared(self):
+        other = SegmentStore(self.directory.name)
+        other.load()
+        self.store.append([instance('w1')])
+        eq_(other.get('w1'), instance('w1'))
+        eq_(len(other), 1)
+
+    async def test_003_threads(self):
+        # Appends and reads run in the executor threads
+        def append(start):
+            for index in range(start, start + 20):
+                self.store.append([instance('w{}'.format(index))])
+                self.store.get('w{}'.format(index - 1))
+        threads = [Thread(target=append, args=(i * 20,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(len(self.store), 80)
+        eq_(self.store.get('w42'), instance('w42'))
+
+    async def test_004_partial_index(self):
+        self.store.append([instance('w1')])
+        with open(os.path.join(self.directory.name, 'history-000001.idx'),
+                  'a') as file:
+            file.write('w2 12')
+        store = SegmentStore(self.directory.name, segment_size=10 ** 6)
+        store.load()
+        eq_(len(store), 1)
+        store.append([instance('w3')])
+        eq_(store.get('w3'), instance('w3'))
+        eq_(len(store), 2)
+
+
+class HistoryArchiveTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.storage = MongoStorage()
+        self.storage._workflow_instances = MagicMock()
+        self.workflows = self.storage._workflow_instances.buckets
+        self.workflows.names = AsyncMock(return_value=[
+            'workflow_instances_201801', 'workflow_instances',
+        ])
+        self.workflows.month.side_effect = lambda name: (
+            datetime(2018, 1, 1, tzinfo=timezone.utc)
+            if name.endswith('201801') else None
+        )
+        self.workflows.drop = AsyncMock()
+        self.collection = self.workflows.collection.return_value
+        self.collection.delete_many = AsyncMock()
+        self.collection.count_documents = AsyncMock(return_value=0)
+
+        self.task_collections = defaultdict(TaskCollection)
+        self.task_collection = self.task_collections['task_instances_201801']
+        self.db = MagicMock()
+        self.db.list_collection_names = AsyncMock(return_value=[
+            'task_instances_201801', 'task_instances',
+        ])
+        self.db.drop_collection = AsyncMock()
+        self.db.__getitem__.side_effect = lambda name: Mock(**{
+            'with_options.return_value': self.task_collections[name],
+        })
+        self.storage._task_instances = TaskInstancesCollection(self.db)
+        self.archive = self.storage.archive
+        self.archive.configure(path=self.directory.name, after=3)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def test_001_archive(self):
+        documents = [instance('w1', 2), instance('w2', 1)]
+        self.task_collection.insert(documents[:1])
+        self.task_collections['task_instances'].insert(documents[1:])
+        self.collection.find.side_effect = [
+            Cursor(documents[:1]), Cursor(documents[1:]),
+        ]
+        eq_(await self.archive.archive(), 2)
+
+        # Archived instances are deleted, emptied buckets are dropped
+        self.workflows.drop.assert_called_once_with(
+            'workflow_instances_201801'
+        )
+        self.db.drop_collection.assert_called_once_with(
+            'task_instances_201801'
+        )
+        query, _ = self.collection.find.call_args_list[1][0]
+        eq_(list(query), ['start'])
+        eq_(self.collection.delete_many.call_args_list[1][0][0], {
+            'id': {'$in': ['w2']},
+        })
+        eq_(self.task_collection.documents, [])
+        eq_(self.task_collections['task_instances'].documents, [])
+
+        # Read back by id, with the whole tasks
+        instances = self.storage._workflow_instances
+        instances.get_one = AsyncMock(return_value=None)
+        workflow = await self.storage.get_instance('w1', full=True)
+        eq_(workflow['template']['tasks'], instance('w1', 2)['template'][
+            'tasks'
+        ])
+        workflow = await self.storage.get_instance('w1')
+        eq_(workflow['template']['tasks'][0], {
+            'id': 'w1-t0',
+            'template': {'id': 't0', 'name': 'task'},
+            'outputs': {'quorum': 1},
+        })
+        task = await self.storage.get_instance_task('w1-t1', False, 'w1')
+        eq_(task['id'], 'w1-t1')
+        assert_not_in('inputs', task)
+        data = await self.storage.get_instance_task_data('w1-t1', 'w1')
+        eq_(data['inputs'], {'index': 1})
+        assert_is_none(await self.storage.get_instance('w3'))
+
+    async def test_002_late_report(self):
+        # Reported to the bucket while it was archived
+        self.workflows.names.return_value = ['workflow_instances_201801']
+        self.collection.find.side_effect = [Cursor([instance('w1', 0)])]
+        self.collection.count_documents.return_value = 1
+        eq_(await self.archive.archive(), 1)
+        self.workflows.drop.assert_not_called()
+        self.db.drop_collection.assert_called_once_with(
+            'task_instances_201801'
+        )
+        self.collection.delete_many.assert_called_once_with(
+            {'id': {'$in': ['w1']}}
+        )
+
+    async def test_003_missing_tasks(self):
+        documents = [instance('w1', 2), instance('w2', 1)]
+        self.task_collection.insert(documents)
+        # One task of w1 not found
+        del self.task_collection.documents[1]
+        self.workflows.names.return_value = ['workflow_instances_201801']
+        self.collection.find.side_effect = [Cursor(documents)]
+        self.collection.count_documents.return_value = 1
+        eq_(await self.archive.archive(), 1)
+        self.collection.delete_many.assert_called_once_with(
+            {'id': {'$in': ['w2']}}
+        )
+        eq_([task['id'] for task in self.task_collection.documents], [
+            'w1-t0',
+        ])
+        assert_is_none(await self.archive.get_instance('w1'))
+
+    async def test_004_configure(self):
+        for after in (0, -1):
+            with assert_raises(ValueError):
+                self.archive.configure(path=self.directory.name, after=after)
+
+    async def test_005_project(self):
+        eq_(project(
+            {'a': {'b': 1, 'c': 2}, 'd': 3, 'e': 4},
+            {'_id': 0, 'a.b': 1, 'd': 1, 'f.g': 1},
+        ), {'a': {'b': 1}, 'd': 3})
@@ -0,0 +1,34 @@
+from asynctest import TestCase
+from unittest.mock import MagicMock
+
+from nyuki.bus import MqttBus
+
+from tests import AsyncMock
+
+
+class MqttBusTest(TestCase):
+
+    def setUp(self):
+        self.bus = MqttBus(MagicMock(), loop=self.loop)
+        self.bus.client = MagicMock()
+        self.bus.client.subscribe = AsyncMock()
+        self.bus.client.unsubscribe = AsyncMock()
+
+    async def callback(self, topic, data):
+        pass
+
+    async def test_001_unsubscribe(self):
+        await self.bus.subscribe('nyuki/async/+', self.callback)
+        await self.bus.subscribe('nyuki/cache', self.callback)
+        await self.bus.unsubscribe('nyuki/async/+', self.callback)
+        self.bus.client.unsubscribe.assert_called_once_with(['nyuki/async/+'])
+
+    async def test_002_unsubscribe_disconnected(self):
+        await self.bus.subscribe('nyuki/async/+', self.callback)
+        await self.bus.subscribe('nyuki/cache', self.callback)
+        # Stopped bus, only the local callbacks are dropped
+        self.bus.client._connected_state.is_set.return_value = False
+        await self.bus.unsubscribe('nyuki/async/+', self.callback)
+        await self.bus.unsubscribe('nyuki/cache', self.callback)
+        self.bus.client.unsubscribe.assert_not_called()
+        self.assertEqual(self.bus.topics, [])
@@ -0,0 +1,56 @@
+from aiohttp import web
+from asynctest import TestCase, Mock
+from nose.tools import eq_, assert_is_none
+
+from nyuki.client import HttpClient
+
+
+class HttpClientTest(TestCase):
+
+    async def setUp(self):
+        app = web.Application()
+        app.router.add_get('/', lambda request: web.Response(text='ok'))
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = 'http://127.0.0.1:{}/'.format(port)
+
+        self.client = HttpClient(Mock())
+        self.client.configure(limit_per_host=5)
+        await self.client.start()
+
+    async def tearDown(self):
+        await self.client.stop()
+        await self.runner.cleanup()
+
+    async def test_001_keep_alive(self):
+        for _ in range(3):
+            async with self.client.session.get(self.url) as response:
+                eq_(await response.text(), 'ok')
+
+        stats = self.client.stats()
+        eq_(stats['requests'], 3)
+        eq_(stats['connections_created'], 1)
+        eq_(stats['connections_reused'], 2)
+        eq_(stats['idle'], 1)
+        eq_(stats['limit_per_host'], 5)
+
+    async def test_002_stop(self):
+        session = self.client.session
+        await self.client.stop()
+        assert_is_none(self.client.session)
+        eq_(session.closed, True)
+
+    async def test_003_borrow(self):
+        async with self.client.borrow() as session:
+            eq_(session, self.client.session)
+        eq_(session.closed, False)
+
+        # Short-lived session while the pool is stopped
+        await self.client.stop()
+        async with self.client.borrow() as session:
+            async with session.get(self.url) as response:
+                eq_(await response.text(), 'ok')
+        eq_(session.closed, True)
@@ -14,6 +14,8 @@ class TestCommand(TestCase):
         args.server = '127.0.0.1:5555'
         args.api = 'localhost:8082'
         args.logging = 'DEBUG'
+        args.workers = 4
+        args.loop = 'uvloop'
         _build_args.return_value = args
 
         # Result
@@ -27,6 +29,10 @@ class TestCommand(TestCase):
                 'host': 'localhost',
                 'port': 8082
             },
+            'event_loop': 'uvloop',
+            'workers': {
+                'count': 4,
+            },
             'config': 'config.json',
             'log': {
                 'root': {
@@ -0,0 +1,58 @@
+from asynctest import TestCase
+from nose.tools import eq_, assert_false, assert_true, assert_raises
+from unittest.mock import MagicMock
+
+from nyuki.workflow.tasks.trigger_workflow import CompletionListener
+from nyuki.workflow.tasks.utils import runtime
+
+from tests import AsyncMock
+
+
+class CompletionListenerTest(TestCase):
+
+    def setUp(self):
+        runtime.bus = AsyncMock()
+        runtime.bus.name = 'nyuki'
+        runtime.nyuki = None
+        self.listener = CompletionListener()
+
+    async def test_001_route_to_future(self):
+        await self.listener.start()
+        runtime.bus.subscribe.assert_called_once_with(
+            'nyuki/async/+', self.listener._received
+        )
+        first = self.listener.wait('uid1')
+        second = self.listener.wait('uid2')
+        await self.listener._received('nyuki/async/uid2', {'type': 'end'})
+        eq_(second.result(), {'type': 'end'})
+        assert_false(first.done())
+
+    async def test_002_early_completion(self):
+        await self.listener._received('nyuki/async/uid1', {'type': 'end'})
+        future = self.listener.wait('uid1')
+        eq_(future.result(), {'type': 'end'})
+        # Consumed once
+        assert_false(self.listener.wait('uid1').done())
+
+    async def test_003_early_completion_expires(self):
+        self.listener.EARLY_TTL = 0
+        await self.listener._received('nyuki/async/uid1', {'type': 'end'})
+        await self.listener._received('nyuki/async/uid2', {'type': 'end'})
+        eq_(list(self.listener._early), ['uid2'])
+
+    async def test_004_replica_topic(self):
+        runtime.nyuki = MagicMock(id='a1b2c3d4')
+        runtime.nyuki.workers.enabled = False
+        eq_(self.listener.topic, 'nyuki/async/a1b2c3d4/+')
+        eq_(self.listener.task_topic('uid1'), 'nyuki/async/a1b2c3d4/uid1')
+        runtime.nyuki.workers.enabled = True
+        runtime.nyuki.workers.index = 2
+        eq_(self.listener.topic, 'nyuki/async/a1b2c3d4/2/+')
+
+    async def test_005_stop(self):
+        future = self.listener.wait('uid1')
+        runtime.bus.unsubscribe.side_effect = ConnectionError
+        with assert_raises(ConnectionError):
+            await self.listener.stop()
+        # Waiting tasks are released whatever the state of the bus
+        assert_true(future.cancelled())
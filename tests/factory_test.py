@@ -0,0 +1,50 @@
+from aiohttp import web
+from asynctest import TestCase
+from nose.tools import eq_, assert_in
+from unittest.mock import Mock
+
+from nyuki.client import HttpClient
+from nyuki.workflow.tasks.factory import FactoryTask
+from nyuki.workflow.tasks.utils import runtime
+
+
+class FactoryTaskTest(TestCase):
+
+    async def setUp(self):
+        self.requested = []
+
+        async def regex(request):
+            self.requested.append(request.match_info['rid'])
+            return web.json_response({'pattern': '(?P<x>b)'})
+
+        app = web.Application()
+        app.router.add_get('/v1/workflow/regexes/{rid}', regex)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        runtime.config = {'api': {'port': port}}
+        runtime.http_client = HttpClient(Mock())
+        runtime.http_client.configure()
+
+    async def tearDown(self):
+        await runtime.http_client.stop()
+        await self.runner.cleanup()
+
+    async def execute(self):
+        task = FactoryTask({'rules': [
+            {'type': 'extract', 'fieldname': 'a', 'regex_id': 'r1'},
+        ]})
+        return await task.execute(Mock(data={'a': 'abc'}))
+
+    async def test_001_pool_stopped(self):
+        # Configuration reload, the pool session is None
+        data = await self.execute()
+        eq_(self.requested, ['r1'])
+        assert_in('diff', data)
+
+    async def test_002_pool(self):
+        await runtime.http_client.start()
+        await self.execute()
+        eq_(runtime.http_client.stats()['requests'], 1)
@@ -0,0 +1,73 @@
+import asyncio
+from asynctest import TestCase
+from nose.tools import eq_
+from nose.tools import assert_raises
+from pymongo.errors import AutoReconnect
+from unittest.mock import MagicMock
+
+from nyuki.workflow.db.history import HistoryWriter
+from nyuki.workflow.tasks.utils import runtime
+from nyuki.workflow.workflow import WorkflowNyuki
+from nyuki.workflow.db.utils.buckets import months_before
+
+from tests import AsyncMock
+
+
+class HistoryWriterTest(TestCase):
+
+    def setUp(self):
+        self.storage = AsyncMock()
+        self.writer = HistoryWriter(self.storage)
+        self.writer.RETRY_DELAY = 0
+
+    async def test_001_batch_size(self):
+        self.writer.configure(batch_size=2, flush_interval=10)
+        self.writer.start()
+        for i in range(5):
+            await self.writer.put({'id': i})
+        await asyncio.sleep(0.01)
+        eq_(self.storage.insert_instances.call_count, 2)
+        # Remaining instance written on stop
+        await self.writer.stop()
+        eq_(self.storage.insert_instances.call_count, 3)
+        self.storage.insert_instances.assert_called_with([{'id': 4}])
+        eq_(self.writer.stats()['flushed'], 5)
+
+    async def test_002_flush_interval(self):
+        self.writer.configure(batch_size=100, flush_interval=0.01)
+        self.writer.start()
+        await self.writer.put({'id': 1})
+        await asyncio.sleep(0.05)
+        self.storage.insert_instances.assert_called_once_with([{'id': 1}])
+        await self.writer.stop()
+
+    async def test_003_retry(self):
+        self.storage.insert_instances.side_effect = [AutoReconnect, None]
+        await self.writer.put({'id': 1})
+        await self.writer.stop()
+        eq_(self.storage.insert_instances.call_count, 2)
+        eq_(self.writer.stats()['retries'], 1)
+        eq_(self.writer.stats()['flushed'], 1)
+
+    async def test_004_retention(self):
+        self.writer.configure(retention=2)
+        self.writer.start()
+        await asyncio.sleep(0.01)
+        await self.writer.stop()
+        eq_(self.storage.expire_history.call_count, 1)
+        before = self.storage.expire_history.call_args[0][0]
+        eq_(before, months_before(None, 2))
+
+    async def test_005_teardown(self):
+        # A failing component does not prevent the last history write
+        nyuki = MagicMock()
+        nyuki.invalidation.stop = AsyncMock(side_effect=AutoReconnect)
+        nyuki.history = self.writer
+        nyuki.storage.archive.stop = AsyncMock()
+        nyuki.storage.stop = AsyncMock()
+        runtime.completions = AsyncMock()
+        await self.writer.put({'id': 1})
+        with assert_raises(AutoReconnect):
+            await WorkflowNyuki.teardown(nyuki)
+        self.storage.insert_instances.assert_called_once_with([{'id': 1}])
+        nyuki.storage.stop.assert_called_once_with()
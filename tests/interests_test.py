@@ -0,0 +1,121 @@
+import json
+from asynctest import TestCase as AsyncTestCase
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from nose.tools import eq_, assert_true, assert_false, assert_raises
+
+from nyuki.workflow.api.interests import ApiWorkflowWatch, ApiWorkflowWatches
+from nyuki.workflow.interests import InterestRegistry, LeaseNotFound
+
+from tests import AsyncMock
+
+
+class InterestRegistryTest(TestCase):
+
+    def setUp(self):
+        self.interests = InterestRegistry()
+        self.interests.configure(enabled=True)
+
+    def test_001_watch(self):
+        assert_false(self.interests.watched('wf1', 'tmpl1'))
+        lease = self.interests.watch(instances=['wf1'], templates=['tmpl2'])
+        assert_true(self.interests.watched('wf1', 'tmpl1'))
+        assert_true(self.interests.watched('wf2', 'tmpl2'))
+        assert_false(self.interests.watched('wf2', 'tmpl1'))
+        self.interests.cancel(lease['id'])
+        assert_false(self.interests.watched('wf1', 'tmpl1'))
+        with assert_raises(LeaseNotFound):
+            self.interests.cancel(lease['id'])
+
+    def test_002_shared_interests(self):
+        lease1 = self.interests.watch(instances=['wf1'])
+        self.interests.watch(instances=['wf1'])
+        self.interests.cancel(lease1['id'])
+        assert_true(self.interests.watched('wf1', 'tmpl1'))
+
+    @patch('nyuki.workflow.interests.time')
+    def test_003_expiration(self, time):
+        time.time.return_value = 0
+        lease = self.interests.watch(instances=['wf1'], ttl=10)
+        self.interests.watch(instances=['wf2'], ttl=20)
+        time.time.return_value = 8
+        self.interests.renew(lease['id'], ttl=10)
+        time.time.return_value = 15
+        # The first lease was renewed
+        assert_true(self.interests.watched('wf1', 'tmpl1'))
+        time.time.return_value = 19
+        assert_false(self.interests.watched('wf1', 'tmpl1'))
+        assert_true(self.interests.watched('wf2', 'tmpl1'))
+        eq_(len(self.interests.stats()['leases']), 1)
+
+    def test_004_disabled(self):
+        # Opt-in, clients unaware of the leases receive every update
+        assert_true(InterestRegistry().watched('wf1', 'tmpl1'))
+        self.interests.configure(enabled=False)
+        assert_true(self.interests.watched('wf1', 'tmpl1'))
+
+    def test_005_create_with_id(self):
+        # Leases replicated from another worker process keep their id
+        with assert_raises(LeaseNotFound):
+            self.interests.watch(instances=['wf1'], lease_id='l1')
+        lease = self.interests.watch(
+            instances=['wf1'], lease_id='l1', create=True
+        )
+        eq_(lease['id'], 'l1')
+        assert_true(self.interests.watched('wf1', 'tmpl1'))
+        self.interests.watch(instances=['wf2'], lease_id='l1', create=True)
+        assert_false(self.interests.watched('wf1', 'tmpl1'))
+        eq_(len(self.interests.stats()['leases']), 1)
+
+
+class ApiWorkflowWatchTest(AsyncTestCase):
+
+    def setUp(self):
+        self.nyuki = Mock()
+        self.nyuki.interests = InterestRegistry()
+        self.nyuki.interests.configure(enabled=True)
+        self.nyuki.workers.forwarded.return_value = False
+        self.nyuki.workers.broadcast = AsyncMock(return_value={})
+
+    def request(self, path, body=None):
+        request = Mock()
+        request.rel_url.path = path
+        request.can_read_body = body is not None
+        request.json = AsyncMock(return_value=body)
+        return request
+
+    async def test_001_replicated_lease(self):
+        # Events are produced by the worker owning the instance
+        api = ApiWorkflowWatches()
+        api.nyuki = self.nyuki
+        response = await api.put(self.request(
+            '/v1/workflow/watch', {'instances': ['wf1']}
+        ))
+        lease_id = json.loads(response.body.decode())['id']
+        _, path, body = self.nyuki.workers.broadcast.call_args[0]
+        eq_(path, '/v1/workflow/watch/{}'.format(lease_id))
+        eq_(json.loads(body), {'instances': ['wf1']})
+
+        # Replicated in a sibling worker
+        self.nyuki.interests = InterestRegistry()
+        self.nyuki.interests.configure(enabled=True)
+        self.nyuki.workers.forwarded.return_value = True
+        api = ApiWorkflowWatch()
+        api.nyuki = self.nyuki
+        await api.put(self.request(path, {'instances': ['wf1']}), lease_id)
+        assert_true(self.nyuki.interests.watched('wf1', 'tmpl1'))
+        eq_(self.nyuki.workers.broadcast.call_count, 1)
+
+    async def test_002_lease_of_another_worker(self):
+        api = ApiWorkflowWatch()
+        api.nyuki = self.nyuki
+        self.nyuki.workers.broadcast.return_value = {
+            1: (200, 'application/json', b'{}'),
+        }
+        request = self.request('/v1/workflow/watch/l1')
+        response = await api.delete(request, 'l1')
+        eq_(response.status, 200)
+        self.nyuki.workers.broadcast.return_value = {}
+        request = self.request('/v1/workflow/watch/l1')
+        response = await api.delete(request, 'l1')
+        eq_(response.status, 404)
@@ -0,0 +1,96 @@
+import asyncio
+from asynctest import TestCase
+from nose.tools import eq_
+from pymongo.errors import AutoReconnect
+from unittest.mock import MagicMock
+
+from nyuki.workflow.db.data_processing import DataProcessingCollection
+from nyuki.workflow.invalidation import CacheInvalidation
+
+from tests import AsyncMock
+
+
+class CacheInvalidationTest(TestCase):
+
+    def setUp(self):
+        self.nyuki = MagicMock(id='self')
+        self.nyuki.bus.name = 'nyuki'
+        self.nyuki.bus.subscribe = AsyncMock()
+        self.nyuki.bus.unsubscribe = AsyncMock()
+        self.nyuki.bus.publish = AsyncMock()
+        self.versions = self.nyuki.storage.cache_versions
+        self.versions.get = AsyncMock(return_value={'templates': 2})
+        self.versions.bump = AsyncMock(return_value=3)
+        self.evicted = []
+        self.invalidation = CacheInvalidation(self.nyuki)
+        self.invalidation.register('templates', self.evict)
+
+    async def tearDown(self):
+        await self.invalidation.stop()
+
+    async def evict(self, key):
+        self.evicted.append(key)
+
+    async def received(self, **data):
+        await self.invalidation._received(self.invalidation.topic, {
+            'origin': 'other', 'kind': 'templates', 'key': 't1', **data,
+        })
+
+    async def test_001_own_origin(self):
+        await self.invalidation.start()
+        await self.received(origin='self', version=3)
+        eq_(self.evicted, [])
+        await self.received(version=3)
+        eq_(self.evicted, ['t1'])
+
+    async def test_002_sequence_gap(self):
+        await self.invalidation.start()
+        # Version 3 was missed, the whole cache is flushed
+        await self.received(version=4)
+        eq_(self.evicted, [None])
+        await self.received(version=5)
+        eq_(self.evicted, [None, 't1'])
+        # Older, or without a version
+        await self.received(version=2)
+        await self.received()
+        eq_(self.evicted, [None, 't1', 't1', 't1'])
+
+    async def test_003_check_versions(self):
+        self.invalidation.configure(check_interval=0.01)
+        await self.invalidation.start()
+        await asyncio.sleep(0.03)
+        eq_(self.evicted, [])
+        self.versions.get.return_value = {'templates': 3}
+        await asyncio.sleep(0.03)
+        # Flushed once
+        eq_(self.evicted, [None])
+
+    async def test_004_invalidate(self):
+        await self.invalidation.invalidate('templates', 't1')
+        message, topic = self.nyuki.bus.publish.call_args[0]
+        eq_(topic, 'nyuki/cache')
+        eq_(message['version'], 3)
+
+        # Still notified without a version, caught by the periodic check
+        self.versions.bump.side_effect = AutoReconnect
+        await self.invalidation.invalidate('templates', 't2')
+        message, _ = self.nyuki.bus.publish.call_args[0]
+        eq_(message, {
+            'origin': 'self', 'kind': 'templates', 'key': 't2',
+            'version': None,
+        })
+        eq_(self.invalidation._versions, {'templates': 3})
+
+
+class DataProcessingCacheTest(TestCase):
+
+    async def test_001_copies(self):
+        db = MagicMock()
+        rule = {'id': 'l1', 'table': [{'value': 'a', 'replace': 'b'}]}
+        db['lookups'].find_one = AsyncMock(return_value=rule)
+        collection = DataProcessingCollection(db, 'lookups')
+        (await collection.get_one('l1'))['table'].append({})
+        (await collection.get_one('l1'))['table'][0]['value'] = 'x'
+        eq_(await collection.get_one('l1'), {
+            'id': 'l1', 'table': [{'value': 'a', 'replace': 'b'}],
+        })
@@ -0,0 +1,171 @@
+import os
+import tempfile
+from asynctest import TestCase
+from bson import ObjectId
+from nose.tools import eq_, assert_is_none
+from pymongo.errors import DuplicateKeyError
+from textwrap import dedent
+from unittest.mock import MagicMock
+
+from nyuki.workflow.db.migrations import (
+    MigrationRunner, checksum, load_migration,
+)
+from nyuki.workflow.db.utils.search import ngrams
+
+from tests import AsyncMock
+
+
+FOREGROUND = '''
+class Migration:
+
+    def __init__(self, db):
+        self._db = db
+
+    async def run(self):
+        self._db.applied.append('foreground')
+'''
+
+BACKGROUND = '''
+class Migration:
+
+    BACKGROUND = True
+
+    def __init__(self, db):
+        self._db = db
+
+    async def run_batch(self, position):
+        self._db.applied.append(position)
+        position = (position or 0) + 1
+        return position if position < 3 else None
+'''
+
+
+class Cursor:
+
+    def __init__(self, documents):
+        self._documents = iter(documents)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class MigrationRunnerTest(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        for name, source in (
+            ('__init__', ''),
+            ('0002_background', BACKGROUND),
+            ('0001_foreground', FOREGROUND),
+        ):
+            path = os.path.join(self.folder.name, name + '.py')
+            with open(path, 'w') as file:
+                file.write(dedent(source))
+
+        self.db = MagicMock()
+        self.db.applied = []
+        self.records = self.db['migrations']
+        self.records.list_indexes.return_value = Cursor([])
+        self.records.create_indexes = AsyncMock()
+        self.records.find.return_value = Cursor([])
+        self.records.find_one_and_update = AsyncMock(return_value={})
+        self.records.update_one = AsyncMock()
+        self.records.find_one = AsyncMock(return_value={'state': 'running'})
+        self.runner = MigrationRunner(self.db)
+        self.runner.FOLDER = self.folder.name
+        self.runner.POLL = 0
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.folder.name, name + '.py')
+
+    def states(self):
+        return [
+            call[0][1]['$set'].get('state')
+            for call in self.records.update_one.call_args_list
+        ]
+
+    async def test_001_run(self):
+        await self.runner.run()
+        # Foreground migrations are applied before returning
+        eq_(self.db.applied, ['foreground'])
+        await self.runner._future
+        eq_(self.db.applied, ['foreground', None, 1, 2])
+        query, update = self.records.find_one_and_update.call_args[0]
+        eq_(query['name'], '0002_background')
+        digest = checksum(self.path('0002_background'))
+        eq_(update['$set']['checksum'], digest)
+        eq_(self.states(), ['applied', None, None, 'applied'])
+
+    async def test_002_applied(self):
+        with open(self.path('0001_foreground'), 'a') as file:
+            file.write('raise RuntimeError\n')
+        self.records.find.return_value = Cursor([{
+            'name': '0001_foreground', 'state': 'applied', 'checksum': '',
+        }])
+        await self.runner.run()
+        await self.runner._future
+        eq_(self.db.applied, [None, 1, 2])
+
+    async def test_003_resume(self):
+        self.records.find_one_and_update.side_effect = [
+            {},
+            # Leased by another replica until its lease expired
+            DuplicateKeyError('duplicate'),
+            DuplicateKeyError('duplicate'),
+            {'name': '0002_background', 'position': 1},
+        ]
+        await self.runner.run()
+        await self.runner._future
+        eq_(self.db.applied, ['foreground', 1, 2])
+        eq_(self.records.find_one.call_count, 2)
+
+    async def test_004_applied_by_another_replica(self):
+        self.records.find_one_and_update.side_effect = [
+            DuplicateKeyError('duplicate'),
+            DuplicateKeyError('duplicate'),
+            {},
+        ]
+        self.records.find_one.side_effect = [
+            {'state': 'running'}, {'state': 'applied'},
+        ]
+        await self.runner.run()
+        # Startup waited for the foreground migration of the other replica
+        eq_(self.db.applied, [])
+        await self.runner._future
+        eq_(self.db.applied, [None, 1, 2])
+
+
+class TitleGramsMigrationTest(TestCase):
+
+    async def test_001_run_batch(self):
+        path = os.path.join(MigrationRunner.FOLDER, '0001_title_grams.py')
+        db = MagicMock()
+        collection = db['workflow_instances']
+        collection.bulk_write = AsyncMock()
+        cursor = collection.find.return_value.sort.return_value.limit
+        cursor = cursor.return_value
+        ids = [ObjectId(), ObjectId()]
+        cursor.to_list = AsyncMock(return_value=[
+            {'_id': ids[0], 'template': {'title': 'Ab'}},
+            {'_id': ids[1], 'template': {}},
+        ])
+
+        migration = load_migration('0001_title_grams', path, db)
+        eq_(await migration.run_batch(None), ids[1])
+        updates = collection.bulk_write.call_args[0][0]
+        eq_(updates[0]._doc, {'$set': {'title_grams': ngrams('Ab')}})
+        eq_(await migration.run_batch(ids[1]), ids[1])
+        query, _ = collection.find.call_args[0]
+        eq_(query, {'title_grams': None, '_id': {'$gt': ids[1]}})
+
+        cursor.to_list.return_value = []
+        assert_is_none(await migration.run_batch(ids[1]))
@@ -0,0 +1,64 @@
+import asyncio
+import time
+from asynctest import TestCase, ignore_loop
+from unittest.mock import Mock
+from nose.tools import eq_, assert_true
+
+from nyuki.debugging import LoopMonitor, percentiles
+
+
+def blocking():
+    time.sleep(0.05)
+
+
+async def blocking_task():
+    time.sleep(0.05)
+
+
+class LoopMonitorTest(TestCase):
+
+    async def setUp(self):
+        self.monitor = LoopMonitor(Mock())
+        self.monitor.configure(enabled=True, interval=0.01, threshold=0.02)
+        await self.monitor.start()
+
+    async def tearDown(self):
+        await self.monitor.stop()
+
+    async def test_001_slow_callbacks(self):
+        self.loop.call_soon(blocking)
+        await asyncio.sleep(0.01)
+        await asyncio.ensure_future(blocking_task())
+        stats = self.monitor.stats()
+        eq_(stats['slow_callbacks'], 2)
+        eq_(stats['slow'][0]['callback'], 'blocking')
+        eq_(stats['slow'][1]['callback'], 'task blocking_task')
+        # Stack captured while the loop was blocked
+        assert_true('blocking' in stats['slow'][0]['stack'][-1])
+
+    async def test_002_lag(self):
+        await asyncio.sleep(0.05)
+        stats = self.monitor.stats()
+        assert_true(stats['lag']['samples'] > 0)
+        assert_true(stats['lag']['p99'] is not None)
+
+    @ignore_loop
+    def test_003_percentiles(self):
+        eq_(percentiles(list(range(100))), {'p50': 50, 'p90': 90, 'p99': 99})
+        eq_(percentiles([]), {'p50': None, 'p90': None, 'p99': None})
+
+    @ignore_loop
+    def test_004_merge(self):
+        def stats(lag, slow):
+            return {
+                'interval': 0.5, 'threshold': 0.1,
+                'lag': {'samples': 2, 'last': lag, 'max': lag,
+                        'p50': lag, 'p90': lag, 'p99': lag},
+                'slow_callbacks': len(slow),
+                'slow': [{'callback': 'f', 'time': t} for t in slow],
+            }
+        merged = LoopMonitor.merge([stats(0.1, [2]), stats(None, [1, 3])])
+        eq_(merged['lag']['samples'], 4)
+        eq_(merged['lag']['max'], 0.1)
+        eq_(merged['slow_callbacks'], 3)
+        eq_([entry['time'] for entry in merged['slow']], [1, 2, 3])
@@ -85,7 +85,7 @@ class TestNyuki(TestCase):
             }
         })
         # Base + API + Bus + custom
-        eq_(len(self.nyuki._schemas), 4)
+        eq_(len(self.nyuki._schemas), 7)
 
     async def test_005_stop(self):
         with patch.object(self.nyuki._services, 'stop') as mock:
@@ -95,6 +95,19 @@ class TestNyuki(TestCase):
             mock.assert_called_once_with()
         assert_true(self.nyuki.is_stopping)
 
+    @ignore_loop
+    def test_006_event_loop_policy(self):
+        self.nyuki._config['event_loop'] = 'uvloop'
+        uvloop = Mock()
+        with patch('asyncio.set_event_loop_policy') as set_policy:
+            # Not installed
+            with patch.dict('sys.modules', {'uvloop': None}):
+                self.nyuki._set_event_loop_policy()
+            eq_(set_policy.call_count, 0)
+            with patch.dict('sys.modules', {'uvloop': uvloop}):
+                self.nyuki._set_event_loop_policy()
+            set_policy.assert_called_once_with(uvloop.EventLoopPolicy())
+
 
 class TestNyukiWithConfig(TestCase):
 
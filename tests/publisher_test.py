@@ -0,0 +1,71 @@
+import asyncio
+from asynctest import TestCase
+from nose.tools import eq_
+
+from nyuki.workflow.publisher import ExecPublisher
+
+from tests import AsyncMock
+
+
+class ExecPublisherTest(TestCase):
+
+    def setUp(self):
+        self.bus = AsyncMock()
+        self.publisher = ExecPublisher(self.bus)
+
+    def published(self):
+        return [
+            (call[0][1], call[0][0]['data'])
+            for call in self.bus.publish.call_args_list
+        ]
+
+    async def test_001_coalesce(self):
+        self.publisher.configure(flush_interval=0.01)
+        for i in range(10):
+            await self.publisher.progress('wf1', 'a', {'data': {'count': i}})
+        await self.publisher.progress('wf1', 'b', {'data': {'x': 1}})
+        await self.publisher.progress('wf1', 'b', {'data': {'y': 2}})
+        eq_(self.bus.publish.call_count, 0)
+        await asyncio.sleep(0.05)
+        eq_(self.published(), [
+            ('websocket/a', {'count': 9}),
+            ('websocket/b', {'x': 1, 'y': 2}),
+        ])
+        eq_(self.publisher.stats()['coalesced'], 10)
+
+    async def test_002_transitions_in_order(self):
+        self.publisher.configure(flush_interval=10)
+        await self.publisher.progress('wf1', 'a', {'data': {'count': 1}})
+        await self.publisher.progress('wf2', 'b', {'data': {'count': 2}})
+        await self.publisher.publish('wf1', 'end', {'data': 'end'})
+        # Only the progress of the same instance is flushed first
+        eq_(self.published(), [
+            ('websocket/a', {'count': 1}),
+            ('websocket/end', 'end'),
+        ])
+        await self.publisher.stop()
+        eq_(self.published()[-1], ('websocket/b', {'count': 2}))
+
+    async def test_003_disabled(self):
+        self.publisher.configure(flush_interval=0)
+        await self.publisher.progress('wf1', 'a', {'data': {'count': 1}})
+        eq_(self.published(), [('websocket/a', {'count': 1})])
+
+    async def test_004_flush_then_end(self):
+        # Slow broker, the END is published while the flush is sending
+        async def publish(payload, topic):
+            await asyncio.sleep(0.01)
+        self.bus.publish.side_effect = publish
+        self.publisher.configure(flush_interval=10)
+        await self.publisher.progress('wf1', 'a', {'data': {'count': 1}})
+        await self.publisher.progress('wf1', 'b', {'data': {'count': 2}})
+        await asyncio.gather(
+            self.publisher.flush(),
+            self.publisher.publish('wf1', 'end', {'data': 'end'}),
+        )
+        eq_(self.published(), [
+            ('websocket/a', {'count': 1}),
+            ('websocket/b', {'count': 2}),
+            ('websocket/end', 'end'),
+        ])
+        eq_(self.publisher._locks, {})
@@ -0,0 +1,46 @@
+from datetime import datetime
+from unittest import TestCase
+from bson import BSON
+from nose.tools import eq_, assert_raises, assert_is_not
+from pymongo.errors import DocumentTooLarge
+
+from nyuki.workflow.db.utils.sanitize import sanitize_workflow_exec
+
+
+class Unsafe:
+    pass
+
+
+class SanitizeTest(TestCase):
+
+    def test_001_unsafe_objects(self):
+        now = datetime.utcnow()
+        obj = {
+            'list': [1, Unsafe(), [Unsafe()], (2, 'a')],
+            'dict': {1: None, 'date': now, 'float': 1.5},
+            'unsafe': Unsafe(),
+        }
+        result = sanitize_workflow_exec(obj)
+        internal = 'Internal server data: {}'.format(Unsafe)
+        eq_(result, {
+            'list': [1, internal, [internal], [2, 'a']],
+            'dict': {'1': None, 'date': now, 'float': 1.5},
+            'unsafe': internal,
+        })
+        # Input left untouched
+        assert_is_not(result['list'], obj['list'])
+        eq_(type(obj['unsafe']), Unsafe)
+
+    def test_002_circular_reference(self):
+        obj = {'shared': {'a': 1}}
+        obj['list'] = [obj['shared'], obj]
+        result = sanitize_workflow_exec(obj)
+        eq_(result['list'][0], {'a': 1})
+        eq_(result['list'][1], "Circular reference: <class 'dict'>")
+
+    def test_003_bson_size(self):
+        obj = {'a': [1, 2 ** 40, 'é', None, True], 'b': {'c': datetime.utcnow()}}
+        size = len(BSON.encode(obj))
+        eq_(sanitize_workflow_exec(obj, size), obj)
+        with assert_raises(DocumentTooLarge):
+            sanitize_workflow_exec(obj, size - 1)
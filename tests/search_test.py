@@ -0,0 +1,23 @@
+from unittest import TestCase
+from nose.tools import eq_
+
+from nyuki.workflow.db.utils.search import ngrams, search_query
+
+
+class SearchTest(TestCase):
+
+    def test_001_ngrams(self):
+        eq_(ngrams('Ab  c'), [
+            ' ', ' c', 'a', 'ab', 'ab ', 'b', 'b ', 'b c', 'c',
+        ])
+        eq_(ngrams(None), [])
+
+    def test_002_short_search(self):
+        eq_(search_query('title', 'grams', ' AB '), {'grams': 'ab'})
+        eq_(search_query('title', 'grams', '  '), {})
+
+    def test_003_long_search(self):
+        query = search_query('title', 'grams', 'a.*b  cd')
+        eq_(query['grams'], {'$all': ['a.*', '.*b', '*b ', 'b c', ' cd']})
+        # User input is escaped
+        eq_(query['title'], {'$regex': r'a\.\*b\s+cd', '$options': 'i'})
@@ -0,0 +1,123 @@
+from copy import deepcopy
+from asynctest import TestCase, ignore_loop
+from nose.tools import eq_, assert_is_none, assert_is, assert_is_not, assert_raises
+from tukio import UnknownTaskName
+from tukio.workflow import WorkflowTemplate
+from unittest.mock import patch
+
+from nyuki.workflow.tukio import TemplatePool, WorkflowSelector
+
+from tests import AsyncMock
+
+
+def template(tid, topics, state='active', title='title'):
+    return {
+        'id': tid,
+        'title': title,
+        'tags': [],
+        'topics': topics,
+        'state': state,
+        'version': 1,
+        'tasks': [{'id': 't1', 'name': 'sleep', 'config': {'time': 1}}],
+        'graph': {'t1': []},
+    }
+
+
+class TestWorkflowSelector(TestCase):
+
+    def setUp(self):
+        self.storage = AsyncMock()
+        self.selector = WorkflowSelector(self.storage)
+
+    async def test_001_reload_active_only(self):
+        self.storage.get_templates.return_value = [
+            template('1', ['a']),
+            template('2', None),
+            template('3', ['a'], state='draft'),
+        ]
+        await self.selector.reload()
+        self.storage.get_templates.assert_called_once_with(full=True)
+        eq_(sorted(t.uid for t in self.selector.select('a')), ['1', '2'])
+        eq_([t.uid for t in self.selector.select('b')], ['2'])
+        assert_is_none(self.selector.get('3'))
+
+    @ignore_loop
+    def test_002_load_replaces_previous_version(self):
+        self.selector.load(template('1', ['a']))
+        self.selector.load(template('1', ['b'], title='new'))
+        eq_(self.selector.select('a'), [])
+        eq_([t.uid for t in self.selector.select('b')], ['1'])
+        eq_(self.selector.get_dict('1')['title'], 'new')
+
+    @ignore_loop
+    def test_003_unload(self):
+        self.selector.load(template('1', ['a']))
+        self.selector.load(template('2', None))
+        self.selector.unload('1')
+        self.selector.unload('2')
+        self.selector.unload('unknown')
+        eq_(self.selector.select('a'), [])
+        assert_is_none(self.selector.get_dict('1'))
+
+    @ignore_loop
+    def test_004_update_metadata(self):
+        self.selector.load(template('1', []))
+        self.selector.update_metadata('1', {'title': 'new', 'tags': ['x']})
+        eq_(self.selector.get_dict('1')['title'], 'new')
+        eq_(self.selector.get_dict('1')['tags'], ['x'])
+        # Templates with an empty topic list are never selected
+        eq_(self.selector.select('a'), [])
+
+
+    @ignore_loop
+    def test_005_validate(self):
+        invalid = template('2', ['a'])
+        invalid['tasks'][0]['name'] = 'unknown'
+        with assert_raises(UnknownTaskName):
+            self.selector.load(invalid)
+        assert_is_none(self.selector.get('2'))
+
+        # Validated once per template version
+        with patch.object(WorkflowTemplate, 'validate') as validate:
+            first = self.selector.load(template('1', ['a']))
+            assert_is(self.selector.load(template('1', ['a'])), first)
+            self.selector.load(template('1', ['b']))
+        eq_(validate.call_count, 2)
+
+    async def test_006_reload_skips_invalid(self):
+        invalid = template('2', ['a'])
+        invalid['graph'] = {'t1': [], 't2': []}
+        invalid['tasks'].append({'id': 't2', 'name': 'sleep'})
+        self.storage.get_templates.return_value = [
+            template('1', ['a']), invalid,
+        ]
+        await self.selector.reload()
+        eq_([t.uid for t in self.selector.select('a')], ['1'])
+
+class TestTemplatePool(TestCase):
+
+    def setUp(self):
+        self.pool = TemplatePool()
+
+    @ignore_loop
+    def test_001_intern(self):
+        shared = self.pool.intern(template('1', []))
+        # Same version, other copy
+        assert_is(self.pool.intern(template('1', [])), shared)
+        assert_is(self.pool.intern(shared), shared)
+        # Changed draft or metadata
+        assert_is_not(self.pool.intern(template('1', [], title='new')), shared)
+        with assert_raises(TypeError):
+            shared['title'] = 'new'
+        # Copies can be modified
+        copy = deepcopy(shared)
+        copy['title'] = 'new'
+        eq_(type(copy), dict)
+
+    @ignore_loop
+    def test_002_stats(self):
+        shared = self.pool.intern(template('1', []))
+        stats = self.pool.stats([shared] * 10)
+        eq_(stats['references'], 10)
+        eq_(stats['distinct'], 1)
+        eq_(stats['saved'], 9 * stats['size'])
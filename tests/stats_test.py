@@ -0,0 +1,91 @@
+from asynctest import TestCase, ignore_loop
+from nose.tools import assert_is, eq_
+from tukio import Engine
+from tukio.workflow import WorkflowTemplate
+
+from nyuki.workflow.stats import Histogram, TaskTimings
+from nyuki.workflow.workflow import WorkflowInstance
+
+from tests.workflow_instance_test import TEMPLATE
+
+
+class HistogramTest(TestCase):
+
+    @ignore_loop
+    def test_001_buckets(self):
+        histogram = Histogram()
+        for value in (0.002, 0.002, 0.2, 7200):
+            histogram.add(value)
+        stats = histogram.as_dict()
+        eq_(stats['count'], 4)
+        eq_(stats['min'], 0.002)
+        eq_(stats['max'], 7200)
+        eq_(stats['p50'], 0.005)
+        eq_(stats['p90'], 7200)
+        counts = {b['le']: b['count'] for b in stats['buckets'] if b['count']}
+        eq_(counts, {0.005: 2, 0.5: 1, '+inf': 1})
+
+    @ignore_loop
+    def test_002_empty(self):
+        eq_(Histogram().as_dict()['p50'], None)
+
+    @ignore_loop
+    def test_003_merge(self):
+        first, second = Histogram(), Histogram()
+        for value in (0.002, 0.002):
+            first.add(value)
+        second.add(7200)
+        merged = Histogram()
+        for histogram in (first, second, Histogram()):
+            merged.update(Histogram.from_dict(histogram.as_dict()))
+        stats = merged.as_dict()
+        eq_(stats['count'], 3)
+        eq_(stats['min'], 0.002)
+        eq_(stats['max'], 7200)
+        eq_(stats['p50'], 0.005)
+
+
+class TaskTimingsTest(TestCase):
+
+    async def test_001_record(self):
+        engine = Engine(loop=self.loop)
+        wflow = await engine.run_once(WorkflowTemplate.from_dict(TEMPLATE), {})
+        await wflow
+        wfinst = WorkflowInstance(TEMPLATE, wflow)
+
+        timings = TaskTimings()
+        for task_id in ('t1', 't2'):
+            timings.record('task-begin', task_id, wfinst)
+            timings.record('task-progress', task_id, wfinst)
+            timings.record('task-end', task_id, wfinst)
+
+        stats = timings.stats()
+        sleep = stats['tasks']['sleep']
+        eq_(sleep['queue']['count'], 2)
+        eq_(sleep['duration']['count'], 2)
+        eq_(sleep['outcomes'], {'end': 2})
+        eq_(stats['templates']['template']['outcomes'], {'end': 2})
+
+        # Stats of several worker processes
+        merged = TaskTimings.merge([stats, stats, {'tasks': {}}])
+        eq_(merged['tasks']['sleep']['duration']['count'], 4)
+        eq_(merged['templates']['template']['outcomes'], {'end': 4})
+
+        timings.reset()
+        eq_(timings.stats(), {'tasks': {}, 'templates': {}})
+
+    @ignore_loop
+    def test_002_parents(self):
+        timings = TaskTimings()
+        template = {
+            'id': 'template', 'version': 1,
+            'graph': {'t1': ['t2', 't3'], 't2': ['t3'], 't3': []},
+        }
+        parents = timings._parents_of(template)
+        eq_(parents, {'t2': ['t1'], 't3': ['t1', 't2']})
+        # Built once per template version
+        assert_is(timings._parents_of(dict(template)), parents)
+
+        # Draft modified without a new version
+        template = {**template, 'graph': {'t1': ['t2'], 't2': []}}
+        eq_(timings._parents_of(template), {'t2': ['t1']})
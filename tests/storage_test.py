@@ -0,0 +1,479 @@
+from asynctest import TestCase
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+from datetime import datetime, timedelta, timezone
+from nose.tools import eq_, assert_is_none, assert_not_in, assert_raises
+from tukio.utils import FutureState
+from pymongo import DESCENDING, IndexModel
+from pymongo.collation import Collation
+from pymongo.errors import CollectionInvalid
+from unittest.mock import MagicMock
+
+from nyuki.workflow.db.storage import MongoStorage
+from nyuki.workflow.db.task_instances import TaskInstancesCollection
+from nyuki.workflow.db.task_templates import TaskTemplatesCollection
+from nyuki.workflow.db.utils.buckets import month, months_before
+from nyuki.workflow.db.utils.errors import PayloadTooLarge
+from nyuki.workflow.db.utils.indexes import ensure_indexes
+from nyuki.workflow.db.workflow_instances import (
+    InvalidPageToken, Ordering, PageToken, WorkflowInstancesCollection,
+)
+
+from tests import AsyncMock
+
+
+class Cursor:
+
+    def __init__(self, documents):
+        self._documents = iter(documents)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class TemplatesStorageTest(TestCase):
+
+    def setUp(self):
+        self.storage = MongoStorage()
+        self.storage._workflow_templates = AsyncMock()
+        self.storage._workflow_metadata = AsyncMock()
+        self.storage._task_templates = AsyncMock()
+        self.storage._workflow_templates.get.return_value = [
+            {'id': '1', 'version': 2},
+            {'id': '2', 'version': 1},
+        ]
+        self.storage._workflow_metadata.get_many.return_value = {
+            '1': {'title': 'one', 'tags': []},
+            '2': {'title': 'two', 'tags': ['tag']},
+        }
+        self.storage._task_templates.get_many.return_value = {
+            ('1', 2): [{'id': 't1'}],
+            ('2', 1): [{'id': 't2'}, {'id': 't3'}],
+        }
+
+    async def test_001_get_templates(self):
+        templates = await self.storage.get_templates()
+        eq_(templates, [
+            {'id': '1', 'version': 2, 'title': 'one', 'tags': []},
+            {'id': '2', 'version': 1, 'title': 'two', 'tags': ['tag']},
+        ])
+        self.storage._workflow_metadata.get_many.assert_called_once_with(
+            {'1', '2'}
+        )
+        self.storage._workflow_metadata.get_one.assert_not_called()
+        self.storage._task_templates.get_many.assert_not_called()
+
+    async def test_002_get_templates_full(self):
+        templates = await self.storage.get_templates(full=True)
+        eq_(templates[0]['tasks'], [{'id': 't1'}])
+        eq_(templates[1]['tasks'], [{'id': 't2'}, {'id': 't3'}])
+        eq_(self.storage._task_templates.get_many.call_count, 1)
+        self.storage._task_templates.get.assert_not_called()
+
+    async def test_003_get_many_tasks(self):
+        db = MagicMock()
+        db['task_templates'].find.return_value = Cursor([
+            {'id': 't1', 'workflow_template': {'id': '1', 'version': 2}},
+            {'id': 't2', 'workflow_template': {'id': '2', 'version': 1}},
+        ])
+        collection = TaskTemplatesCollection(db)
+        tasks = await collection.get_many([
+            {'id': '1', 'version': 2},
+            {'id': '2', 'version': 1},
+            {'id': '3', 'version': 1},
+        ])
+        eq_(tasks, {
+            ('1', 2): [{'id': 't1'}],
+            ('2', 1): [{'id': 't2'}],
+            ('3', 1): [],
+        })
+        # Only the requested (id, version) pairs
+        query, _ = db['task_templates'].find.call_args[0]
+        eq_(query, {'$or': [
+            {'workflow_template.id': '1', 'workflow_template.version': 2},
+            {'workflow_template.id': '2', 'workflow_template.version': 1},
+            {'workflow_template.id': '3', 'workflow_template.version': 1},
+        ]})
+
+        db['task_templates'].find.reset_mock()
+        eq_(await collection.get_many([]), {})
+        db['task_templates'].find.assert_not_called()
+
+
+class HistoryStorageTest(TestCase):
+
+    def setUp(self):
+        self.storage = MongoStorage()
+        self.storage._workflow_instances = AsyncMock()
+        self.storage._task_instances = AsyncMock()
+        self.storage._workflow_instances.get.return_value = (2, [
+            {'id': 'w1', 'template': {}},
+            {'id': 'w2', 'template': {}},
+        ], None)
+        self.storage._task_instances.get_many.return_value = {
+            'w1': [{'id': 't1'}],
+            'w2': [],
+        }
+
+    async def test_001_get_history_full(self):
+        count, workflows, _ = await self.storage.get_history(full=True)
+        eq_(count, 2)
+        eq_(workflows[0]['template']['tasks'], [{'id': 't1'}])
+        eq_(workflows[1]['template']['tasks'], [])
+        self.storage._task_instances.get_many.assert_called_once_with(
+            ['w1', 'w2'], full=True, max_size=MongoStorage.HISTORY_MAX_SIZE,
+            since=None, until=None,
+        )
+        self.storage._task_instances.get.assert_not_called()
+
+    async def test_002_get_history(self):
+        await self.storage.get_history(full=False)
+        self.storage._task_instances.get_many.assert_not_called()
+
+
+class TaskInstancesTest(TestCase):
+
+    def setUp(self):
+        self.db = MagicMock()
+        self.db.list_collection_names = AsyncMock(return_value=[])
+        self.tasks = [
+            {'id': 't1', 'workflow_instance_id': 'w1', 'outputs': 'x' * 100},
+            {'id': 't2', 'workflow_instance_id': 'w2', 'outputs': 'x' * 100},
+            {'id': 't3', 'workflow_instance_id': 'w1', 'outputs': 'x' * 100},
+        ]
+        self.cursor = Cursor([
+            RawBSONDocument(BSON.encode(task)) for task in self.tasks
+        ])
+        self.cursor.close = AsyncMock()
+        self.collection = self.db['task_instances'].with_options.return_value
+        self.collection.find.return_value = self.cursor
+
+    async def test_001_get_many(self):
+        tasks = await TaskInstancesCollection(self.db).get_many(
+            ['w1', 'w2', 'w3'], full=True,
+        )
+        eq_([task['id'] for task in tasks['w1']], ['t1', 't3'])
+        eq_([task['id'] for task in tasks['w2']], ['t2'])
+        eq_(tasks['w3'], [])
+        assert_not_in('workflow_instance_id', tasks['w1'][0])
+        query, filters = self.collection.find.call_args[0]
+        eq_(query, {'workflow_instance_id': {'$in': ['w1', 'w2', 'w3']}})
+        # Exclusion projection, whole documents are returned
+        eq_(filters, {'_id': 0})
+
+        await TaskInstancesCollection(self.db).get_many(['w1'])
+        _, filters = self.collection.find.call_args[0]
+        eq_(filters['workflow_instance_id'], 1)
+        eq_(filters['template.name'], 1)
+
+    async def test_002_max_size(self):
+        with assert_raises(PayloadTooLarge):
+            await TaskInstancesCollection(self.db).get_many(
+                ['w1', 'w2'], full=True, max_size=250,
+            )
+        self.cursor.close.assert_called_once_with()
+
+
+class WorkflowInstancesTest(TestCase):
+
+    def setUp(self):
+        db = MagicMock()
+        db.list_collection_names = AsyncMock(return_value=[])
+        self.collection = db['workflow_instances'].with_options.return_value
+        self.collection.count_documents = AsyncMock(return_value=3)
+        self.collection.estimated_document_count = AsyncMock(return_value=10)
+        self.cursor = self.collection.find.return_value
+        self.cursor.to_list = AsyncMock()
+        self.instances = WorkflowInstancesCollection(db)
+
+    async def test_001_page_token(self):
+        end = month()
+        self.cursor.to_list.return_value = [
+            {'id': 'w1', 'end': end}, {'id': 'w2', 'end': end},
+        ]
+        count, _, next_page = await self.instances.get(limit=2)
+        eq_(count, 10)
+        self.cursor.sort.assert_called_once_with([('end', -1), ('id', -1)])
+
+        # Next page from the last instance
+        self.cursor.to_list.return_value = [{'id': 'w3', 'end': end}]
+        _, _, last_page = await self.instances.get(limit=2, after=next_page)
+        assert_is_none(last_page)
+        query, _ = self.collection.find.call_args[0]
+        eq_(query, {'$and': [{}, {'$or': [
+            {'end': {'$lt': end}},
+            {'end': end, 'id': {'$lt': 'w2'}},
+        ]}]})
+        self.cursor.skip.assert_not_called()
+
+    async def test_002_invalid_page_token(self):
+        with assert_raises(InvalidPageToken):
+            await self.instances.get(after='invalid')
+        token = PageToken.dump({'id': 'w1', 'end': None}, 'end', -1)
+        with assert_raises(InvalidPageToken):
+            await self.instances.get(
+                after=token, order=Ordering.start_asc.value,
+            )
+
+    async def test_003_cached_counts(self):
+        self.cursor.to_list.return_value = []
+        state = FutureState.finished
+        for _ in range(2):
+            count, _, _ = await self.instances.get(state=state)
+            eq_(count, 3)
+        self.collection.count_documents.assert_called_once_with(
+            {'state': 'finished'}
+        )
+        self.collection.estimated_document_count.assert_not_called()
+
+    async def test_004_search(self):
+        self.cursor.to_list.return_value = []
+        await self.instances.get(search='Alert')
+        query, filters = self.collection.find.call_args[0]
+        eq_(query['title_grams'], {'$all': ['ale', 'ler', 'ert']})
+        eq_(filters, {'_id': 0, 'title_grams': 0})
+
+    async def test_005_insert_grams(self):
+        self.collection.list_indexes.return_value = Cursor([])
+        self.collection.create_indexes = AsyncMock()
+        self.collection.insert_many = AsyncMock()
+        workflow = {'id': 'w1', 'template': {'title': 'Ab'}}
+        await self.instances.insert_many([workflow])
+        documents = self.collection.insert_many.call_args[0][0]
+        eq_(documents[0]['title_grams'], ['a', 'ab', 'b'])
+        # Reports are left untouched, for the retries
+        assert_not_in('title_grams', workflow)
+
+    async def test_006_null_page_token(self):
+        # Page boundary on instances without an end date
+        self.cursor.to_list.return_value = [{'id': 'w2', 'end': None}]
+        _, _, next_page = await self.instances.get(
+            limit=1, order=Ordering.end_asc.value,
+        )
+        self.cursor.to_list.return_value = []
+        await self.instances.get(
+            limit=1, after=next_page, order=Ordering.end_asc.value,
+        )
+        query, _ = self.collection.find.call_args[0]
+        eq_(query, {'$and': [{}, {'$or': [
+            {'end': {'$ne': None}},
+            {'end': None, 'id': {'$gt': 'w2'}},
+        ]}]})
+
+        # Null values are the last ones in descending order
+        token = PageToken.dump({'id': 'w2', 'end': None}, 'end', -1)
+        await self.instances.get(limit=1, after=token)
+        query, _ = self.collection.find.call_args[0]
+        eq_(query, {'$and': [{}, {'end': None, 'id': {'$lt': 'w2'}}]})
+
+
+class Database(dict):
+
+    """
+    Collections by name, the buckets listed from `names`.
+    """
+
+    def __init__(self, names):
+        super().__init__()
+        self.names = set(names)
+        self.list_collection_names = AsyncMock(side_effect=self._list)
+        self.drop_collection = AsyncMock(side_effect=self.names.discard)
+
+    def _list(self, filter=None):
+        return list(self.names)
+
+    def __missing__(self, name):
+        collection = MagicMock()
+        collection.name = name
+        collection.with_options.return_value = collection
+        collection.list_indexes.return_value = Cursor([])
+        collection.create_indexes = AsyncMock()
+        collection.insert_many = AsyncMock()
+        self[name] = collection
+        return collection
+
+
+class BucketsTest(TestCase):
+
+    def setUp(self):
+        self.db = Database([
+            'workflow_instances',
+            'workflow_instances_201801',
+            'workflow_instances_201803',
+            'workflow_instances_201712',
+        ])
+        self.current = 'workflow_instances_{:%Y%m}'.format(month())
+        self.instances = WorkflowInstancesCollection(self.db)
+
+    def page(self, name, workflows):
+        cursor = self.db[name].find.return_value
+        cursor.to_list = AsyncMock(return_value=workflows)
+        self.db[name].count_documents = AsyncMock(return_value=len(workflows))
+        self.db[name].estimated_document_count = AsyncMock(
+            return_value=len(workflows)
+        )
+
+    async def test_001_months(self):
+        offset = timezone(timedelta(hours=-2))
+        eq_(month(datetime(2018, 3, 31, 23, tzinfo=offset)),
+            datetime(2018, 4, 1, tzinfo=timezone.utc))
+        eq_(months_before(datetime(2018, 2, 5), 3),
+            datetime(2017, 11, 1, tzinfo=timezone.utc))
+
+    async def test_002_names(self):
+        buckets = self.instances.buckets
+        eq_(await buckets.names(), [
+            self.current,
+            'workflow_instances_201803',
+            'workflow_instances_201801',
+            'workflow_instances_201712',
+            'workflow_instances',
+        ])
+        eq_(await buckets.names(
+            since=datetime(2018, 1, 15), until=datetime(2018, 2, 1)
+        ), ['workflow_instances_201801', 'workflow_instances'])
+
+    async def test_003_insert_many(self):
+        await self.instances.insert_many([
+            {'id': 'w1', 'start': datetime(2018, 1, 2), 'template': {}},
+            {'id': 'w2', 'start': datetime(2018, 2, 2), 'template': {}},
+            {'id': 'w3', 'start': datetime(2018, 1, 3), 'template': {}},
+        ])
+        documents = self.db['workflow_instances_201801'].insert_many
+        eq_([w['id'] for w in documents.call_args[0][0]], ['w1', 'w3'])
+        # New bucket, indexed on its first insert
+        bucket = self.db['workflow_instances_201802']
+        eq_(bucket.insert_many.call_args[0][0][0]['id'], 'w2')
+        eq_(len(bucket.create_indexes.call_args[0][0]), 7)
+        await self.instances.insert_many([
+            {'id': 'w4', 'start': datetime(2018, 2, 4), 'template': {}},
+        ])
+        eq_(bucket.create_indexes.call_count, 1)
+
+    async def test_004_merged_page(self):
+        def workflow(wid, day):
+            return {'id': wid, 'end': datetime(2018, 3, day)}
+
+        self.page(self.current, [])
+        self.page('workflow_instances_201803', [
+            workflow('w1', 20), workflow('w3', 10),
+        ])
+        self.page('workflow_instances_201801', [
+            workflow('w2', 15), workflow('w4', 5),
+        ])
+        self.page('workflow_instances_201712', [])
+        self.page('workflow_instances', [])
+        count, workflows, next_page = await self.instances.get(
+            limit=2, since=datetime(2018, 1, 1),
+        )
+        eq_(count, 4)
+        eq_([w['id'] for w in workflows], ['w1', 'w2'])
+        self.db['workflow_instances_201712'].find.assert_not_called()
+
+        # Instances ending before the 15th of March started before April
+        self.page('workflow_instances_201803', [workflow('w3', 10)])
+        self.page('workflow_instances_201801', [workflow('w4', 5)])
+        _, workflows, _ = await self.instances.get(limit=2, after=next_page)
+        eq_([w['id'] for w in workflows], ['w3', 'w4'])
+        eq_(self.db[self.current].find.call_count, 1)
+
+    async def test_005_drop_before(self):
+        dropped = await self.instances.buckets.drop_before(
+            datetime(2018, 3, 5)
+        )
+        eq_(dropped, [
+            'workflow_instances_201712', 'workflow_instances_201801',
+        ])
+        eq_(self.db.names, {
+            'workflow_instances', 'workflow_instances_201803',
+        })
+
+
+class IndexesTest(TestCase):
+
+    def setUp(self):
+        self.collection = MagicMock()
+        self.collection.create_indexes = AsyncMock()
+        self.collection.drop_indexes = AsyncMock()
+        self.indexes = [
+            IndexModel('id', unique=True, name='unique_id'),
+            IndexModel([('end', DESCENDING), ('id', DESCENDING)], name='end'),
+        ]
+
+    def existing(self, *indexes):
+        self.collection.list_indexes.return_value = Cursor([
+            {'name': '_id_', 'key': {'_id': 1}}, *indexes,
+        ])
+
+    async def test_001_skip_existing(self):
+        self.existing(
+            {'name': 'unique_id', 'key': {'id': 1}, 'unique': True},
+            {'name': 'end', 'key': {'end': -1, 'id': -1}},
+        )
+        await ensure_indexes(self.collection, self.indexes)
+        self.collection.create_indexes.assert_not_called()
+        self.collection.drop_indexes.assert_not_called()
+
+    async def test_002_missing(self):
+        self.existing({'name': 'unique_id', 'key': {'id': 1}, 'unique': True})
+        await ensure_indexes(self.collection, self.indexes)
+        self.collection.create_indexes.assert_called_once_with(
+            self.indexes[1:]
+        )
+        self.collection.drop_indexes.assert_not_called()
+
+    async def test_003_rebuild(self):
+        # Same name, not unique anymore
+        self.existing({'name': 'unique_id', 'key': {'id': 1}})
+        await ensure_indexes(self.collection, self.indexes)
+        self.collection.drop_indexes.assert_called_once_with()
+        self.collection.create_indexes.assert_called_once_with(self.indexes)
+
+    async def test_004_options(self):
+        self.indexes = [IndexModel(
+            'end', name='end', sparse=True, expireAfterSeconds=60,
+            partialFilterExpression={'state': 'done'},
+            collation=Collation('fr', strength=2),
+        )]
+        index = {
+            'name': 'end', 'key': {'end': 1}, 'sparse': True,
+            'expireAfterSeconds': 60,
+            'partialFilterExpression': {'state': 'done'},
+            # Filled in by the server
+            'collation': {'locale': 'fr', 'strength': 2, 'caseLevel': False},
+        }
+        self.existing(index)
+        await ensure_indexes(self.collection, self.indexes)
+        self.collection.drop_indexes.assert_not_called()
+
+        for key, value in (
+            ('sparse', False),
+            ('expireAfterSeconds', 3600),
+            ('partialFilterExpression', {'state': 'error'}),
+            ('collation', {'locale': 'fr', 'strength': 3}),
+        ):
+            self.collection.drop_indexes.reset_mock()
+            self.existing({**index, key: value})
+            await ensure_indexes(self.collection, self.indexes)
+            self.collection.drop_indexes.assert_called_once_with()
+
+
+class ValidationTest(TestCase):
+
+    async def test_001_validate(self):
+        storage = MongoStorage()
+        storage._db = MagicMock()
+        storage._db.list_collection_names = AsyncMock(
+            return_value=['one', 'two'],
+        )
+        storage._db.validate_collection = AsyncMock(
+            side_effect=[CollectionInvalid('invalid'), {'valid': True}],
+        )
+        await storage.validate()
+        eq_(storage._db.validate_collection.call_count, 2)
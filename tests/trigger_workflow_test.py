@@ -0,0 +1,149 @@
+import asyncio
+from asynctest import TestCase
+from nose.tools import eq_, assert_raises, assert_true, assert_false
+from tukio import get_broker, EXEC_TOPIC
+from tukio.workflow import Workflow, WorkflowExecState
+from unittest.mock import Mock, patch
+
+from nyuki.workflow.admission import AdmissionControl
+from nyuki.workflow.tasks.trigger_workflow import TriggerWorkflowTask
+from nyuki.workflow.tasks.utils import runtime
+
+
+class ChildWorkflow(asyncio.Future):
+
+    def __init__(self, uid):
+        super().__init__()
+        self.uid = uid
+
+
+class ProgressTask(asyncio.Task):
+
+    """
+    Task reporting the progress of its holder, like a tukio task.
+    """
+
+    def __init__(self, coro, *, loop=None):
+        super().__init__(coro, loop=loop)
+        self.progress = []
+        self.timed_out = False
+
+    def dispatch_progress(self, data):
+        self.progress.append(data)
+
+
+class TriggerLocalTest(TestCase):
+
+    def setUp(self):
+        runtime.bus = Mock()
+        runtime.bus.name = 'nyuki'
+        runtime.config = {}
+        runtime.nyuki = Mock()
+        runtime.nyuki.admission = AdmissionControl()
+        self.child = ChildWorkflow('child-uid')
+        runtime.nyuki.engine.selector.get_dict.return_value = {'id': 'child'}
+
+        async def trigger(tid, data):
+            return self.child
+
+        runtime.nyuki.engine.trigger = trigger
+        self.parent = Mock()
+        self.parent.exec = {'track': []}
+        self.parent.instance = Mock(spec=['template', 'uid'])
+        self.parent.instance.template.uid = 'parent'
+        self.parent.instance.uid = 'parent-uid'
+        runtime.workflows = {'parent-uid': self.parent}
+        patcher = patch.object(
+            Workflow, 'current_workflow', return_value=Mock(uid='parent-uid')
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch(
+            'nyuki.workflow.tasks.trigger_workflow.DataInspector'
+            '.template_keys', return_value=['a'],
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def holder(self, blocking=True):
+        return TriggerWorkflowTask({
+            'template': {'service': 'nyuki', 'id': 'child'},
+            'blocking': blocking,
+        })
+
+    def execute(self, holder):
+        event = Mock(data={'a': 1, 'b': 2})
+        return ProgressTask(holder.execute(event), loop=self.loop)
+
+    def end_child(self):
+        get_broker().dispatch(
+            {'type': WorkflowExecState.END.value},
+            topics='/'.join((EXEC_TOPIC, self.child.uid)),
+        )
+
+    async def test_001_blocking(self):
+        holder = self.holder()
+        task = self.execute(holder)
+        await asyncio.sleep(0)
+        assert_true(holder.local)
+        eq_(holder.triggered_id, 'child-uid')
+        eq_(runtime.nyuki.admission.stats()['running'], 1)
+        args, kwargs = runtime.nyuki.new_workflow.call_args
+        eq_(kwargs['requester'], 'nyuki://parent@nyuki/parent-uid')
+        assert_false(task.done())
+
+        self.end_child()
+        eq_(await asyncio.wait_for(task, 1), {'a': 1, 'b': 2})
+        eq_(task.progress[-1], {'status': 'done'})
+        # Tearing down once the child ended
+        holder.teardown()
+        self.child.set_result(None)
+        await asyncio.sleep(0)
+        eq_(runtime.nyuki.admission.stats()['running'], 0)
+
+    async def test_002_non_blocking(self):
+        holder = self.holder(blocking=False)
+        await self.execute(holder)
+        eq_(holder.async_future, None)
+        eq_(holder.status, 'running')
+        runtime.nyuki.new_workflow.assert_called_once_with(
+            {'id': 'child'}, self.child, track=[],
+            requester='nyuki://parent@nyuki/parent-uid',
+        )
+
+    async def test_003_cancelled_parent(self):
+        holder = self.holder()
+        task = self.execute(holder)
+        await asyncio.sleep(0)
+        child = Mock()
+        runtime.workflows['child-uid'] = child
+        task.cancel()
+        holder.teardown()
+        child.instance.cancel.assert_called_once_with()
+        # The child ends after the teardown, twice torn down
+        self.end_child()
+        await asyncio.sleep(0)
+        holder.teardown()
+        assert_true(holder.async_future.cancelled())
+        assert_true(task.cancelled())
+
+    async def test_004_loop(self):
+        # The child template already triggered this workflow
+        self.parent.exec = {
+            'requester': 'nyuki://child@nyuki/ancestor-uid',
+            'track': ['nyuki://other@nyuki/other-uid'],
+        }
+        holder = self.holder()
+        with assert_raises(RuntimeError):
+            await self.execute(holder)
+        runtime.nyuki.new_workflow.assert_not_called()
+        eq_(runtime.nyuki.admission.stats()['running'], 0)
+        # A workflow of the same template on another nyuki is not a loop
+        self.parent.exec['requester'] = 'nyuki://child@other/ancestor-uid'
+        await self.execute(self.holder(blocking=False))
+        runtime.nyuki.new_workflow.assert_called_once_with(
+            {'id': 'child'}, self.child,
+            track=['nyuki://other@nyuki/other-uid',
+                   'nyuki://child@other/ancestor-uid'],
+            requester='nyuki://parent@nyuki/parent-uid',
+        )
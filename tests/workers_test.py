@@ -0,0 +1,160 @@
+import json
+import os
+import shutil
+import tempfile
+from aiohttp import web
+from asynctest import TestCase as AsyncTestCase
+from collections import Counter
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from nose.tools import eq_, assert_true, assert_false
+
+from nyuki.workers import Workers
+
+from tests import AsyncMock
+
+
+class WorkersTest(TestCase):
+
+    def setUp(self):
+        self.workers = Workers(Mock())
+
+    def test_001_single_process(self):
+        self.workers.configure()
+        assert_false(self.workers.supervisor)
+        assert_false(self.workers.enabled)
+        assert_true(self.workers.owns_event('topic', {'a': 1}))
+
+    def test_002_supervisor(self):
+        self.workers.configure(count=4)
+        assert_true(self.workers.supervisor)
+        assert_false(self.workers.enabled)
+
+    @patch.dict('os.environ', {
+        Workers.ENV_INDEX: '1',
+        Workers.ENV_COUNT: '3',
+        Workers.ENV_DIRECTORY: '/tmp/nyuki',
+    })
+    def test_003_worker(self):
+        self.workers.configure(count=1)
+        assert_true(self.workers.enabled)
+        eq_(self.workers.siblings, [0, 2])
+        eq_(self.workers.socket_path(2), '/tmp/nyuki/2.sock')
+        eq_(self.workers.socket_path(), '/tmp/nyuki/1.sock')
+
+    @patch.dict('os.environ', {
+        Workers.ENV_INDEX: '0',
+        Workers.ENV_COUNT: '3',
+        Workers.ENV_DIRECTORY: '/tmp/nyuki',
+    })
+    def test_004_partition(self):
+        self.workers.configure()
+        owners = Counter(
+            self.workers.owner('topic:{}'.format(i)) for i in range(3000)
+        )
+        eq_(set(owners), {0, 1, 2})
+        for count in owners.values():
+            assert_true(800 < count < 1200)
+        # Stable, whatever the order of the keys
+        eq_(
+            self.workers.owns_event('topic', {'a': 1, 'b': 2}),
+            self.workers.owns_event('topic', {'b': 2, 'a': 1}),
+        )
+
+
+class WorkersForwardTest(AsyncTestCase):
+
+    async def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.runners = []
+        # Worker 1 owns 'wf1', worker 2 owns nothing
+        for index, owned in ((1, {'wf1'}), (2, set())):
+            async def instance(request, owned=owned, index=index):
+                eq_(request.headers[Workers.FORWARDED_HEADER], '0')
+                if request.match_info['iid'] not in owned:
+                    return web.Response(status=404)
+                return web.json_response({'worker': index})
+
+            async def instances(request, owned=owned):
+                return web.json_response(sorted(owned))
+
+            async def stats(request, index=index):
+                return web.json_response({'worker': index})
+
+            async def lease(request):
+                return web.json_response({
+                    'id': request.match_info['lease_id'],
+                    **await request.json(),
+                })
+
+            app = web.Application()
+            app.router.add_get('/v1/stats', stats)
+            app.router.add_put('/v1/watch/{lease_id}', lease)
+            app.router.add_get('/v1/instances', instances)
+            app.router.add_get('/v1/instances/{iid}', instance)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.UnixSite(runner, os.path.join(
+                self.directory, '{}.sock'.format(index)
+            )).start()
+            self.runners.append(runner)
+
+        env = {
+            Workers.ENV_INDEX: '0',
+            Workers.ENV_COUNT: '3',
+            Workers.ENV_DIRECTORY: self.directory,
+        }
+        with patch.dict('os.environ', env):
+            self.workers = Workers(Mock())
+            self.workers.configure()
+
+    async def tearDown(self):
+        await self.workers.stop()
+        for runner in self.runners:
+            await runner.cleanup()
+        shutil.rmtree(self.directory)
+
+    def request(self, path):
+        request = Mock()
+        request.method = 'GET'
+        request.rel_url = path
+        request.headers = {}
+        request.read = AsyncMock(return_value=b'')
+        return request
+
+    async def test_001_find(self):
+        status, ctype, body = await self.workers.find(
+            self.request('/v1/instances/wf1')
+        )
+        eq_(status, 200)
+        eq_(json.loads(body.decode()), {'worker': 1})
+        eq_(await self.workers.find(self.request('/v1/instances/wf2')), None)
+
+    async def test_002_collect(self):
+        eq_(await self.workers.collect(self.request('/v1/instances')), ['wf1'])
+
+    async def test_003_aggregate(self):
+        request = self.request('/v1/stats')
+        eq_(await self.workers.gather(request), {
+            1: {'worker': 1}, 2: {'worker': 2},
+        })
+        merged = await self.workers.aggregate(
+            request, {'worker': 0}, lambda results: results
+        )
+        eq_(merged, [{'worker': 0}, {'worker': 1}, {'worker': 2}])
+        # Forwarded requests only return the local object
+        request.headers[Workers.FORWARDED_HEADER] = '1'
+        eq_(await self.workers.aggregate(request, {'worker': 0}, None), {
+            'worker': 0,
+        })
+
+    async def test_004_broadcast_to_path(self):
+        request = self.request('/v1/watch')
+        request.method = 'PUT'
+        responses = await self.workers.broadcast(
+            request, path='/v1/watch/l1', body=json.dumps({'ttl': 5})
+        )
+        eq_(sorted(responses), [1, 2])
+        for status, _, body in responses.values():
+            eq_(status, 200)
+            eq_(json.loads(body.decode()), {'id': 'l1', 'ttl': 5})
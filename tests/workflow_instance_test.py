@@ -0,0 +1,68 @@
+from asynctest import TestCase
+from nose.tools import eq_, assert_is, assert_not_in
+from tukio import Engine
+from tukio.workflow import WorkflowTemplate
+
+from nyuki.workflow.workflow import WorkflowInstance
+
+
+TEMPLATE = {
+    'id': 'template',
+    'title': 'title',
+    'tags': [],
+    'version': 1,
+    'policy': 'start-new',
+    'tasks': [
+        {'id': 't1', 'name': 'sleep', 'config': {'time': 0}},
+        {'id': 't2', 'name': 'sleep', 'config': {'time': 0}},
+    ],
+    'graph': {'t1': ['t2'], 't2': []},
+}
+
+
+class WorkflowInstanceTest(TestCase):
+
+    async def setUp(self):
+        engine = Engine(loop=self.loop)
+        wflow = await engine.run_once(
+            WorkflowTemplate.from_dict(TEMPLATE), {'key': 'value'}
+        )
+        await wflow
+        self.wfinst = WorkflowInstance(TEMPLATE, wflow, requester='me')
+
+    async def test_001_report(self):
+        report = self.wfinst.report()
+        eq_(report['id'], self.wfinst.instance.uid)
+        eq_(report['state'], 'finished')
+        eq_(report['requester'], 'me')
+        eq_(
+            [task['template']['id'] for task in report['template']['tasks']],
+            ['t1', 't2'],
+        )
+        eq_(report['template']['tasks'][1]['state'], 'finished')
+        # Static parts are shared
+        assert_is(report['template']['tasks'][0]['template'], TEMPLATE['tasks'][0])
+        assert_is(report['template']['graph'], TEMPLATE['graph'])
+
+    async def test_002_cached_exec(self):
+        first = self.wfinst.report()['template']['tasks'][0]
+        second = self.wfinst.report()['template']['tasks'][0]
+        eq_(first, second)
+        # Reports never share their task entries
+        second['state'] = 'changed'
+        eq_(self.wfinst.report()['template']['tasks'][0]['state'], 'finished')
+        # Invalidation forces a new exec report
+        self.wfinst._tasks['t1']['state'] = 'changed'
+        self.wfinst.invalidate('t1')
+        eq_(self.wfinst.report()['template']['tasks'][0]['state'], 'finished')
+
+    async def test_003_report_without_tasks(self):
+        report = self.wfinst.report(tasks=False)
+        assert_not_in('tasks', report['template'])
+        assert_not_in('graph', report['template'])
+        eq_(TEMPLATE['tasks'][0]['id'], 't1')
+
+    async def test_004_report_without_data(self):
+        task = self.wfinst.report(data=False)['template']['tasks'][0]
+        assert_not_in('inputs', task)
+        assert_not_in('reporting', task)